@@ -1,34 +1,309 @@
-from fastapi import FastAPI, Request, Form, HTTPException, Query
-from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse
+from fastapi import FastAPI, Request, Form, HTTPException, Query, BackgroundTasks
+from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse, Response, StreamingResponse
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
-from datetime import datetime, timedelta, timezone, date
+from fastapi.middleware.gzip import GZipMiddleware
+from starlette.middleware.gzip import DEFAULT_EXCLUDED_CONTENT_TYPES
+from uvicorn.middleware.proxy_headers import ProxyHeadersMiddleware
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse
+from starlette.staticfiles import NotModifiedResponse
+from fastapi.encoders import jsonable_encoder
+from datetime import datetime, timedelta, timezone, date, time as dt_time
+from email.message import EmailMessage
 from pydantic import BaseModel
 from typing import Optional
+from enum import Enum
+from contextlib import asynccontextmanager, suppress
 from argon2 import PasswordHasher
+from markupsafe import Markup
+from xml.sax.saxutils import escape as xml_escape
 from argon2.exceptions import VerifyMismatchError
 from openai import OpenAI
+import openai
 import os
+import io
+import unicodedata
+import re
+import csv
+import zlib
+import zipfile
+import asyncio
+import json
+import math
+import threading
+import time
+import mimetypes
+import heapq
+import hashlib
+import smtplib
 import pymongo
+import pymongo.errors
+import pymongo.monitoring
 import sqlalchemy
+import sqlite3
 import secrets
 import httpx
+import numpy as np
 from google.cloud import secretmanager
-
-app = FastAPI()
+from google.api_core import exceptions as google_exceptions
+
+# Start background work when the app starts and stop it on shutdown
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await asyncio.to_thread(warm_pools)
+
+    background = []
+    if OUTBOX_RELAY_ENABLED:
+        background.append(asyncio.create_task(run_outbox_relay()))
+    if REMINDERS_ENABLED:
+        reload_seconds = REMINDER_RELOAD_SECONDS if WEB_CONCURRENCY > 1 else None
+        background.append(asyncio.create_task(run_as_leader(REMINDER_LEADER_LOCK, lambda: reminders.run(reload_seconds))))
+    if ENRICHMENT_ENABLED:
+        background.append(asyncio.create_task(run_as_leader(ENRICHMENT_LEADER_LOCK, run_enrichment_worker)))
+    yield
+
+    # Let requests that are already running finish before their connections go away
+    deadline = time.monotonic() + DRAIN_TIMEOUT_SECONDS
+    while InFlightRequests.count and time.monotonic() < deadline:
+        await asyncio.sleep(0.1)
+
+    for task in background:
+        task.cancel()
+        with suppress(asyncio.CancelledError):
+            await task
+
+    database.dispose()
+    if read_database is not database:
+        read_database.dispose()
+    myclient.close()
+
+app = FastAPI(lifespan=lifespan)
 
 PROJECT_ID = os.getenv("GOOGLE_CLOUD_PROJECT", "sd-coursework")
 
+# Where secrets come from, "google" for Secret Manager or "env" for environment variables named after the secret
+# env lets tests and local runs start without Google credentials
+SECRET_PROVIDER = os.getenv("SECRET_PROVIDER", "google")
+
 def googleSecret(secret_id: str) -> str:
+    if SECRET_PROVIDER == "env":
+        value = os.getenv(secret_id)
+        if value is None:
+            raise RuntimeError(f"Secret {secret_id} is not set in the environment")
+        return value.strip()
+
     client = secretmanager.SecretManagerServiceClient()
     name = f"projects/{PROJECT_ID}/secrets/{secret_id}/versions/latest"
     response = client.access_secret_version(request={"name": name})
     return response.payload.data.decode("UTF-8").strip()
 
+# Secrets that don't have to exist
+def optionalGoogleSecret(secret_id: str) -> Optional[str]:
+    if SECRET_PROVIDER == "env":
+        return os.getenv(secret_id)
+    try:
+        return googleSecret(secret_id)
+    except google_exceptions.NotFound:
+        return None
+
 # Store html in templates and mount app
 templates = Jinja2Templates(directory='frontend/static')
 
-app.mount("/frontend", StaticFiles(directory="frontend", html=True), name="frontend")
+# Templates are compiled once and reused, only check the files for changes while developing
+templates.env.auto_reload = os.getenv("TEMPLATE_AUTO_RELOAD") == "1"
+
+# Hashed asset names written by tools/build-assets.py, the plain files are served if the build hasn't been run
+def load_asset_manifest() -> dict:
+    try:
+        with open("frontend/dist/manifest.json") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+asset_manifest = load_asset_manifest()
+
+# Link to a frontend file, e.g. asset_url('javascript/dashboard.js') in a template
+def asset_url(path: str) -> str:
+    return "/frontend/" + asset_manifest.get(path, path)
+
+templates.env.globals["asset_url"] = asset_url
+
+# Pick which pre-compressed encodings the browser accepts from the Accept-Encoding header
+def accepted_encodings(accept_encoding: str) -> set:
+    accepted = set()
+    for part in accept_encoding.split(","):
+        encoding, _, params = part.strip().partition(";")
+        if params.strip().replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            continue
+        accepted.add(encoding.strip().lower())
+    return accepted
+
+# Serve the .br or .gz copy made by the build when the browser accepts it
+# Hashed files under dist never change so they are cached for a year, everything else is revalidated
+class PrecompressedStaticFiles(StaticFiles):
+    def file_response(self, full_path, stat_result, scope, status_code=200):
+        request_headers = Headers(scope=scope)
+        encodings = accepted_encodings(request_headers.get("accept-encoding", ""))
+
+        headers = {}
+        if os.path.relpath(full_path, os.path.realpath(self.directory)).startswith("dist" + os.sep):
+            headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        else:
+            headers["Cache-Control"] = "no-cache"
+
+        # Only files the build compressed vary here, GZipMiddleware adds its own Vary when it compresses the others
+        if any(os.path.exists(f"{full_path}{suffix}") for suffix in (".br", ".gz")):
+            headers["Vary"] = "Accept-Encoding"
+
+        response = None
+        for encoding, suffix in (("br", ".br"), ("gzip", ".gz")):
+            if encoding not in encodings:
+                continue
+            compressed_path = f"{full_path}{suffix}"
+            try:
+                compressed_stat = os.stat(compressed_path)
+            except FileNotFoundError:
+                continue
+            response = FileResponse(
+                compressed_path,
+                status_code=status_code,
+                stat_result=compressed_stat,
+                media_type=mimetypes.guess_type(str(full_path))[0],
+                headers={**headers, "Content-Encoding": encoding},
+            )
+            break
+
+        if response is None:
+            response = FileResponse(full_path, status_code=status_code, stat_result=stat_result, headers=headers)
+
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+        return response
+
+app.mount("/frontend", PrecompressedStaticFiles(directory="frontend", html=True), name="frontend")
+
+# Requests a client may send with an Idempotency-Key header, a retry with the same key gets the first response back
+# instead of saving the leads again
+IDEMPOTENT_ROUTES = {("POST", "/api/leads"), ("POST", "/api/leads/import")}
+# How long a response is kept for replays, and how long a key stays claimed by a request that is still running
+IDEMPOTENCY_KEY_SECONDS = 24 * 3600
+IDEMPOTENCY_PENDING_SECONDS = 30
+# How long a retry waits for the first request to finish before it is told to try again later
+IDEMPOTENCY_WAIT_SECONDS = 10
+
+# Stores the response to the first request with each key and replays it for retries
+# Keys are per session, so two users picking the same key don't see each other's responses
+# Entries are {"h": body fingerprint} while the first request runs, then also "s", "t" and "b" for its status, type and body
+class IdempotencyKeys:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or (scope["method"], scope["path"]) not in IDEMPOTENT_ROUTES:
+            await self.app(scope, receive, send)
+            return
+
+        request = Request(scope, receive)
+        key = request.headers.get("idempotency-key")
+        if key is None:
+            await self.app(scope, receive, send)
+            return
+        if not key or len(key) > 255:
+            await JSONResponse({"detail": "Idempotency-Key must be 1 to 255 characters"}, status_code=400)(scope, receive, send)
+            return
+
+        # The body is read here to fingerprint it, then handed to the route as if it hadn't been
+        body = await request.body()
+        fingerprint = hashlib.sha256(body).hexdigest()[:16]
+        store_key = hashlib.sha256(f"{request.cookies.get('id', '')}\0{scope['path']}\0{key}".encode()).hexdigest()
+
+        deadline = time.monotonic() + IDEMPOTENCY_WAIT_SECONDS
+        while not idempotency_store.add(store_key, {"h": fingerprint}, IDEMPOTENCY_PENDING_SECONDS):
+            stored = idempotency_store.get(store_key)
+            if stored is None:
+                # Released or expired since add looked, try to claim it again
+                continue
+            if stored["h"] != fingerprint:
+                response = JSONResponse({"detail": "Idempotency-Key was already used with a different request"}, status_code=422)
+            elif "s" in stored:
+                response = Response(stored["b"], status_code=stored["s"], media_type=stored["t"], headers={"Idempotent-Replayed": "true"})
+            elif time.monotonic() >= deadline:
+                response = JSONResponse({"detail": "A request with this Idempotency-Key is still running"}, status_code=409, headers={"Retry-After": "1"})
+            else:
+                await asyncio.sleep(0.1)
+                continue
+            await response(scope, receive, send)
+            return
+
+        body_sent = False
+        async def replay_body():
+            nonlocal body_sent
+            if not body_sent:
+                body_sent = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            return await receive()
+
+        captured = {"b": b""}
+        async def capture(message):
+            if message["type"] == "http.response.start":
+                captured["s"] = message["status"]
+                captured["t"] = Headers(raw=message["headers"]).get("content-type")
+            elif message["type"] == "http.response.body":
+                captured["b"] += message.get("body", b"")
+            await send(message)
+
+        try:
+            await self.app(scope, replay_body, capture)
+        finally:
+            # Failures and responses that depend on when the request came (session, rate limit) are not kept,
+            # so a retry runs again
+            status = captured.get("s", 500)
+            if status < 500 and status not in (401, 429):
+                idempotency_store.set(
+                    store_key,
+                    {"h": fingerprint, "s": status, "t": captured["t"], "b": captured["b"].decode("utf-8")},
+                    IDEMPOTENCY_KEY_SECONDS,
+                )
+            else:
+                idempotency_store.delete(store_key)
+
+# Added before GZipMiddleware so it sits inside it, bodies are stored uncompressed and compressed for whoever asks again
+app.add_middleware(IdempotencyKeys)
+
+# Compress JSON and html responses, static files above and xlsx exports are already compressed
+app.add_middleware(
+    GZipMiddleware,
+    minimum_size=1000,
+    exclude_content_types=DEFAULT_EXCLUDED_CONTENT_TYPES + ("application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",),
+)
+
+# How long shutdown waits for running requests, keep it below gunicorn's graceful_timeout
+DRAIN_TIMEOUT_SECONDS = float(os.getenv("DRAIN_TIMEOUT_SECONDS", "20"))
+
+# Count requests being handled by this worker, including the body of streamed responses
+class InFlightRequests:
+    count = 0
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        InFlightRequests.count += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            InFlightRequests.count -= 1
+
+app.add_middleware(InFlightRequests)
+
+# Only these proxies may say who the client is through X-Forwarded-For, added last so it runs first
+# Behind Cloud Run every request comes from Google's front end, so without it every client shares the proxy's address
+FORWARDED_ALLOW_IPS = os.getenv("FORWARDED_ALLOW_IPS", "127.0.0.1")
+app.add_middleware(ProxyHeadersMiddleware, trusted_hosts=FORWARDED_ALLOW_IPS)
 
 # Secrets
 DATABASE_URL = googleSecret("DATABASE_URL")
@@ -36,23 +311,1337 @@ MONGODB_URL = googleSecret("MONGODB_URL")
 #OPENAI_API_KEY = googleSecret("OPENAI_API_KEY")
 OPENAI_API_KEY = "123"
 
+# Worker processes started by gunicorn.conf.py, each one has its own pools and in-memory caches
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))
+
+# Cache kept in this process, only safe to rely on when there is a single worker
+class MemoryCache:
+    def __init__(self, max_keys: int = 10000):
+        # key -> (expires at on the monotonic clock, value)
+        self.entries = {}
+        self.max_keys = max_keys
+        self.lock = threading.Lock()
+
+    def get(self, key: str):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic():
+                del self.entries[key]
+                return None
+            return entry[1]
+
+    def set(self, key: str, value, ttl: float):
+        now = time.monotonic()
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (now + ttl, value)
+
+            # Drop expired entries first, then the oldest ones if that wasn't enough
+            if len(self.entries) > self.max_keys:
+                self.entries = {k: e for k, e in self.entries.items() if e[0] > now}
+                while len(self.entries) > self.max_keys:
+                    del self.entries[next(iter(self.entries))]
+
+    # Set only if the key isn't there yet, returns whether it was set
+    def add(self, key: str, value, ttl: float) -> bool:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                return False
+        self.set(key, value, ttl)
+        return True
+
+    def delete(self, key: str):
+        with self.lock:
+            self.entries.pop(key, None)
+
+# Cache in Redis (or anything that speaks its protocol) so every worker sees the same entries
+# Values are stored as JSON
+class RedisCache:
+    def __init__(self, redis_client, prefix: str = "cache:"):
+        self.redis = redis_client
+        self.prefix = prefix
+
+    def get(self, key: str):
+        value = self.redis.get(self.prefix + key)
+        return None if value is None else json.loads(value)
+
+    def set(self, key: str, value, ttl: float):
+        self.redis.set(self.prefix + key, json.dumps(value), px=max(1, int(ttl * 1000)))
+
+    def add(self, key: str, value, ttl: float) -> bool:
+        return bool(self.redis.set(self.prefix + key, json.dumps(value), px=max(1, int(ttl * 1000)), nx=True))
+
+    def delete(self, key: str):
+        self.redis.delete(self.prefix + key)
+
+# Used when several workers have no shared cache, caching a value in one worker would let the others serve it stale
+class NullCache:
+    def get(self, key: str):
+        return None
+
+    def set(self, key: str, value, ttl: float):
+        pass
+
+    def add(self, key: str, value, ttl: float) -> bool:
+        return False
+
+    def delete(self, key: str):
+        pass
+
+# Shared by the caches below and the rate limiter, RATE_LIMIT_REDIS_URL is still read for older deployments
+REDIS_URL = os.getenv("REDIS_URL") or os.getenv("RATE_LIMIT_REDIS_URL")
+if REDIS_URL:
+    import redis
+    redis_client = redis.Redis.from_url(REDIS_URL)
+    cache = RedisCache(redis_client)
+else:
+    redis_client = None
+    cache = MemoryCache() if WEB_CONCURRENCY == 1 else NullCache()
+
+# Idempotency keys and the responses they replay, a worker's own copy is still safe without Redis,
+# a retry that lands on another worker just runs again as it would without a key
+idempotency_store = RedisCache(redis_client, prefix="idem:") if redis_client else MemoryCache()
+
+# How long a session id is trusted without asking the database again
+SESSION_CACHE_SECONDS = 60
+
+# How long cached metrics and dashboard fragments live, they are also dropped whenever the user's leads change
+LEAD_CACHE_SECONDS = 3600
+
+# SQL connection pools are per worker, so DB_MAX_CONNECTIONS is split between the workers to stay under the server's limit
+# DB_POOL_SIZE and DB_MAX_OVERFLOW set the pool directly instead
+# Connections are replaced after DB_POOL_RECYCLE seconds, keep it below any idle timeout between here and the server
+def pool_options() -> dict:
+    max_connections = int(os.getenv("DB_MAX_CONNECTIONS", "0"))
+    if max_connections:
+        # One connection is kept back for the reminder leader lock
+        per_worker = max(2, max_connections // WEB_CONCURRENCY - 1)
+        pool_size, max_overflow = max(1, per_worker // 2), per_worker - max(1, per_worker // 2)
+    else:
+        pool_size, max_overflow = 5, 10
+    return {
+        "pool_size": int(os.getenv("DB_POOL_SIZE", pool_size)),
+        "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", max_overflow)),
+        "pool_timeout": float(os.getenv("DB_POOL_TIMEOUT", "30")),
+        "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", "1800")),
+    }
+
+# When a pooled Postgres connection is tested before use
+# always pings on every checkout, idle only pings connections unused for DB_PING_IDLE_SECONDS,
+# never leaves it to pool_recycle and to SQLAlchemy dropping the pool after a disconnect error
+DB_PRE_PING = os.getenv("DB_PRE_PING", "idle")
+DB_PING_IDLE_SECONDS = float(os.getenv("DB_PING_IDLE_SECONDS", "60"))
+
+# psycopg 3 (postgresql+psycopg:// URLs) prepares a statement once a connection has run it DB_PREPARE_THRESHOLD times
+# and keeps DB_PREPARED_MAX of them per connection. Set DB_PREPARE_THRESHOLD=off behind PgBouncer in transaction mode
+DB_PREPARE_THRESHOLD = os.getenv("DB_PREPARE_THRESHOLD", "2")
+DB_PREPARED_MAX = int(os.getenv("DB_PREPARED_MAX", "100"))
+
+# Slowest statements kept for /api/debug/pools, by their SQL with placeholder lists folded together
+STATEMENT_STATS_MAX = 200
+
+# Ways /api/debug/pools can rank statements, entries are (statement, calls, total seconds, max seconds)
+SLOW_STATEMENT_ORDER = {
+    "total": lambda entry: entry[2],
+    "mean": lambda entry: entry[2] / entry[1],
+    "max": lambda entry: entry[3],
+    "calls": lambda entry: entry[1],
+}
+
+# Pool and statement timings for one engine, reported by /api/debug/pools
+class PoolStats:
+    def __init__(self, name: str):
+        self.name = name
+        self.lock = threading.Lock()
+        self.waits = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.timeouts = 0
+        self.pings = 0
+        # statement -> [calls, total seconds, max seconds]
+        self.statements = {}
+
+    def record_wait(self, seconds: float, timed_out: bool):
+        with self.lock:
+            self.waits += 1
+            self.wait_total += seconds
+            self.wait_max = max(self.wait_max, seconds)
+            self.timeouts += timed_out
+
+    def record_statement(self, statement: str, seconds: float):
+        statement = normalize_statement(statement)
+        with self.lock:
+            entry = self.statements.get(statement)
+            if entry is None:
+                # Make room by forgetting the statements that have taken the least time overall
+                if len(self.statements) >= STATEMENT_STATS_MAX:
+                    for key in heapq.nsmallest(STATEMENT_STATS_MAX // 10, self.statements, key=lambda k: self.statements[k][1]):
+                        del self.statements[key]
+                entry = self.statements[statement] = [0, 0.0, 0.0]
+            entry[0] += 1
+            entry[1] += seconds
+            entry[2] = max(entry[2], seconds)
+
+    def report(self, pool) -> dict:
+        with self.lock:
+            report = {
+                "waits": self.waits,
+                "wait_avg_ms": round(self.wait_total / self.waits * 1000, 3) if self.waits else 0,
+                "wait_max_ms": round(self.wait_max * 1000, 3),
+                "timeouts": self.timeouts,
+                "pings": self.pings,
+            }
+        if isinstance(pool, sqlalchemy.pool.QueuePool):
+            report.update(size=pool.size(), checked_out=pool.checkedout(), checked_in=pool.checkedin(), overflow=max(0, pool.overflow()))
+        return report
+
+    def slowest(self, limit: int, by: str) -> list:
+        with self.lock:
+            entries = [(statement, *entry) for statement, entry in self.statements.items()]
+        ranked = heapq.nlargest(limit, entries, key=SLOW_STATEMENT_ORDER[by])
+        return [
+            {
+                "engine": self.name,
+                "statement": statement,
+                "calls": calls,
+                "total_ms": round(total * 1000, 3),
+                "mean_ms": round(total / calls * 1000, 3),
+                "max_ms": round(longest * 1000, 3),
+            }
+            for statement, calls, total, longest in ranked
+        ]
+
+    def reset(self):
+        with self.lock:
+            self.waits, self.wait_total, self.wait_max, self.timeouts, self.pings = 0, 0.0, 0.0, 0, 0
+            self.statements = {}
+
+# Engine name -> its PoolStats, the pool finds its own by logging name because engine.dispose() replaces the pool object
+database_stats = {}
+
+# Lists of placeholders (IN lists, multi-row VALUES) vary in length, fold them so each statement is counted once
+PLACEHOLDER = r"(?:\?|%s|%\(\w+\)s|\$\d+|:\w+|__\[POSTCOMPILE_\w+\])"
+def normalize_statement(statement: str) -> str:
+    statement = " ".join(statement.split())
+    statement = re.sub(rf"\(\s*{PLACEHOLDER}(?:\s*,\s*{PLACEHOLDER})*\s*\)", "(...)", statement)
+    return re.sub(r"\(\.\.\.\)(?:\s*,\s*\(\.\.\.\))+", "(...), ...", statement)[:1000]
+
+# QueuePool that times how long each checkout waited for a connection
+class TimedQueuePool(sqlalchemy.pool.QueuePool):
+    def _do_get(self):
+        started = time.perf_counter()
+        timed_out = False
+        try:
+            return super()._do_get()
+        except sqlalchemy.exc.TimeoutError:
+            timed_out = True
+            raise
+        finally:
+            stats = database_stats.get(self.logging_name)
+            if stats is not None:
+                stats.record_wait(time.perf_counter() - started, timed_out)
+
+# Time every statement and, with DB_PRE_PING=idle, ping connections that sat unused in the pool
+def instrument_engine(engine, stats: PoolStats, ping_idle: bool):
+    @sqlalchemy.event.listens_for(engine, "before_cursor_execute")
+    def start_timer(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("statement_started", []).append(time.perf_counter())
+
+    @sqlalchemy.event.listens_for(engine, "after_cursor_execute")
+    def stop_timer(conn, cursor, statement, parameters, context, executemany):
+        stats.record_statement(statement, time.perf_counter() - conn.info["statement_started"].pop())
+
+    # A statement that raised never reaches after_cursor_execute
+    @sqlalchemy.event.listens_for(engine, "handle_error")
+    def drop_timer(context):
+        if context.connection is not None and context.connection.info.get("statement_started"):
+            context.connection.info["statement_started"].pop()
+
+    if not ping_idle:
+        return
+
+    @sqlalchemy.event.listens_for(engine, "checkin")
+    def remember_checkin(dbapi_connection, connection_record):
+        connection_record.info["checked_in_at"] = time.monotonic()
+
+    # Raising DisconnectionError makes the pool throw the connection away and check out another one
+    @sqlalchemy.event.listens_for(engine, "checkout")
+    def ping_if_idle(dbapi_connection, connection_record, connection_proxy):
+        checked_in_at = connection_record.info.get("checked_in_at")
+        if checked_in_at is None or time.monotonic() - checked_in_at < DB_PING_IDLE_SECONDS:
+            return
+        with stats.lock:
+            stats.pings += 1
+        try:
+            engine.dialect.do_ping(dbapi_connection)
+        except Exception as e:
+            raise sqlalchemy.exc.DisconnectionError() from e
+
+# SQLite hands back TIMESTAMP and DATE columns as text, convert them like psycopg2 does
+# CURRENT_TIMESTAMP is UTC without an offset, so naive values are read as UTC to compare with timestamptz ones
+def sqlite_timestamp(value: bytes) -> datetime:
+    parsed = datetime.fromisoformat(value.decode())
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+# Computed timestamps (MIN, CURRENT_TIMESTAMP) have no declared type, so SQLite still hands those back as UTC text
+def utc_timestamp(value) -> datetime:
+    if isinstance(value, str):
+        return sqlite_timestamp(value.encode())
+    return value
+
+sqlite3.register_converter("TIMESTAMP", sqlite_timestamp)
+sqlite3.register_converter("TIMESTAMPTZ", sqlite_timestamp)
+# Postgres casts a datetime written to a DATE column, SQLite keeps the time so drop it on the way out
+sqlite3.register_converter("DATE", lambda value: datetime.fromisoformat(value.decode()).date())
+sqlite3.register_adapter(datetime, lambda value: value.isoformat(" "))
+sqlite3.register_adapter(date, lambda value: value.isoformat())
+
+# Postgres in production, a SQLite file (sqlite:///path) also works for tests and local runs
+# after tools/migrate.py has built its schema
+def create_database_engine(url: str, name: str):
+    stats = database_stats[name] = PoolStats(name)
+    options = {**pool_options(), "poolclass": TimedQueuePool, "pool_logging_name": name}
+
+    if not url.startswith("sqlite"):
+        connect_args = {}
+        if url.startswith("postgresql+psycopg://"):
+            connect_args["prepare_threshold"] = None if DB_PREPARE_THRESHOLD == "off" else int(DB_PREPARE_THRESHOLD)
+        engine = sqlalchemy.create_engine(url, pool_pre_ping=DB_PRE_PING == "always", connect_args=connect_args, **options)
+
+        # prepared_max is a connection attribute rather than a connect argument
+        if url.startswith("postgresql+psycopg://"):
+            @sqlalchemy.event.listens_for(engine, "connect")
+            def limit_prepared(dbapi_connection, connection_record):
+                dbapi_connection.prepared_max = DB_PREPARED_MAX
+
+        instrument_engine(engine, stats, ping_idle=DB_PRE_PING == "idle")
+        return engine
+
+    engine = sqlalchemy.create_engine(
+        url,
+        connect_args={"detect_types": sqlite3.PARSE_DECLTYPES, "check_same_thread": False, "timeout": 30},
+        **options,
+    )
+
+    # Enforce ON DELETE CASCADE like Postgres
+    @sqlalchemy.event.listens_for(engine, "connect")
+    def enable_foreign_keys(dbapi_connection, connection_record):
+        dbapi_connection.execute("PRAGMA foreign_keys = ON")
+
+    instrument_engine(engine, stats, ping_idle=False)
+    return engine
+
 # SQL Database connector
-database = sqlalchemy.create_engine(DATABASE_URL, pool_pre_ping=True)
+database = create_database_engine(DATABASE_URL, "primary")
+
+# Read replica for listing and reporting queries, from DATABASE_READ_URL in the environment or Secret Manager
+# Without one every read goes to the primary as before
+DATABASE_READ_URL = os.getenv("DATABASE_READ_URL") or optionalGoogleSecret("DATABASE_READ_URL")
+read_database = create_database_engine(DATABASE_READ_URL, "replica") if DATABASE_READ_URL else database
+
+# After a user changes a lead their reads go to the primary for this long, so the replica's lag never hides their own change
+READ_YOUR_WRITES_SECONDS = float(os.getenv("READ_YOUR_WRITES_SECONDS", "5"))
+
+# Pick the engine for a user's read-only query
+def reader_for(request: Optional[Request], user_id: int):
+    if read_database is database:
+        return database
+
+    # The cookie covers this browser, the cache covers the user's other devices
+    wrote_at = cache.get(f"lastwrite:{user_id}") or 0
+    if request is not None:
+        with suppress(ValueError):
+            wrote_at = max(wrote_at, float(request.cookies.get("last_write", 0)))
+
+    if time.time() - wrote_at < READ_YOUR_WRITES_SECONDS:
+        return database
+    return read_database
+
+# Checkouts from the MongoDB connection pool, reported by /api/debug/pools
+class MongoPoolStats(pymongo.monitoring.ConnectionPoolListener):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.checked_out = 0
+        self.open = 0
+        self.reset()
+
+    # Counts and timings start again, connections in use are still counted
+    def reset(self):
+        with self.lock:
+            self.waits = 0
+            self.wait_total = 0.0
+            self.wait_max = 0.0
+            self.failures = 0
+
+    def connection_checked_out(self, event):
+        with self.lock:
+            self.checked_out += 1
+            self.waits += 1
+            self.wait_total += event.duration or 0
+            self.wait_max = max(self.wait_max, event.duration or 0)
+
+    def connection_checked_in(self, event):
+        with self.lock:
+            self.checked_out -= 1
+
+    def connection_check_out_failed(self, event):
+        with self.lock:
+            self.failures += 1
+
+    def connection_created(self, event):
+        with self.lock:
+            self.open += 1
+
+    def connection_closed(self, event):
+        with self.lock:
+            self.open -= 1
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def report(self) -> dict:
+        with self.lock:
+            return {
+                "max_pool_size": MONGO_MAX_POOL_SIZE,
+                "open": self.open,
+                "checked_out": self.checked_out,
+                "waits": self.waits,
+                "wait_avg_ms": round(self.wait_total / self.waits * 1000, 3) if self.waits else 0,
+                "wait_max_ms": round(self.wait_max * 1000, 3),
+                "failures": self.failures,
+            }
 
 # NoSQL
-myclient = pymongo.MongoClient(MONGODB_URL)
+# Like the SQL pool this is per worker, mongomock:// keeps the data in memory for tests
+# Connections idle for MONGO_MAX_IDLE_MS are closed, a checkout waiting longer than MONGO_WAIT_QUEUE_TIMEOUT_MS fails
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "100"))
+mongo_stats = MongoPoolStats()
+if MONGODB_URL.startswith("mongomock://"):
+    import mongomock
+    myclient = mongomock.MongoClient()
+else:
+    myclient = pymongo.MongoClient(
+        MONGODB_URL,
+        maxPoolSize=MONGO_MAX_POOL_SIZE,
+        minPoolSize=int(os.getenv("MONGO_MIN_POOL_SIZE", "0")),
+        maxIdleTimeMS=int(os.getenv("MONGO_MAX_IDLE_MS", "300000")),
+        waitQueueTimeoutMS=int(os.getenv("MONGO_WAIT_QUEUE_TIMEOUT_MS", "10000")),
+        event_listeners=[mongo_stats],
+    )
 nosql_database = myclient["mydatabase"]
 activity_log = nosql_database["activities_log"]
 
+# Open the pool's connections before the first request instead of during it
+def warm_pools():
+    engines = [database] if read_database is database else [database, read_database]
+    for engine in engines:
+        connections = []
+        try:
+            for _ in range(engine.pool.size() if isinstance(engine.pool, sqlalchemy.pool.QueuePool) else 1):
+                conn = engine.connect()
+                connections.append(conn)
+                conn.execute(sqlalchemy.text("SELECT 1"))
+        except Exception as e:
+            print(f"Could not warm connection pool: {e}")
+        finally:
+            for conn in connections:
+                conn.close()
+
+    try:
+        myclient.admin.command("ping")
+    except Exception as e:
+        print(f"Could not reach MongoDB: {e}")
+
 # Password hasher
 ph = PasswordHasher()
 
 # Email validator
-EMAIL_VALIDATOR_CLOUD_FUNCTION = "https://europe-west2-sd-coursework.cloudfunctions.net/email-validator"
+EMAIL_VALIDATOR_CLOUD_FUNCTION = os.getenv("EMAIL_VALIDATOR_URL", "https://europe-west2-sd-coursework.cloudfunctions.net/email-validator")
+
+# HTTP client for the validator, tests swap in one that answers without the network
+def email_validator_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient()
+
+# Number of recent activities sent with the dashboard bootstrap
+BOOTSTRAP_ACTIVITY_LIMIT = 50
+
+# Serve the dashboard with today's tasks and metrics already rendered in, ?render=client|server overrides per request
+SERVER_RENDERED_DASHBOARD = os.getenv("SERVER_RENDERED_DASHBOARD") == "1"
+
+# Maximum rows shown in today's tasks
+DASHBOARD_TASK_LIMIT = 5
 
 # Open AI client
 client = OpenAI(api_key=OPENAI_API_KEY)
 
+# Activity documents are written to the activity_outbox table inside the same transaction as the change they describe
+# A background relay copies them to MongoDB afterwards, so a slow or down Mongo never holds up a request
+OUTBOX_BATCH_SIZE = 200
+OUTBOX_POLL_SECONDS = 0.5
+OUTBOX_MAX_BACKOFF_SECONDS = 30
+OUTBOX_RETENTION = timedelta(days=7)
+OUTBOX_RELAY_ENABLED = os.getenv("OUTBOX_RELAY_ENABLED", "1") == "1"
+
+# Relay counters reported by /api/activity/outbox
+outbox_stats = {"shipped": 0, "failures": 0, "last_error": None, "last_shipped_at": None, "last_pruned_at": None}
+
+# Activity documents are stored compactly and turned into display text when read
+# v schema version, u user id, e event type, t time (set when shipped), l lead id, c company name,
+# b value before the change, a value after it or the event's other details, d text of an event the parser didn't recognise
+ACTIVITY_SCHEMA_VERSION = 2
+
+class ActivityEvent(str, Enum):
+    LOGIN = "login"
+    LOGOUT = "logout"
+    REGISTER = "register"
+    LEAD_CREATE = "lead_create"
+    LEAD_IMPORT = "lead_import"
+    LEAD_TASK = "lead_task"
+    LEAD_STAGE = "lead_stage"
+    LEAD_COMPLETE = "lead_complete"
+    LEAD_RESCHEDULE = "lead_reschedule"
+    LEAD_DELETE = "lead_delete"
+    REMINDER_DUE = "reminder_due"
+    REMINDER_OVERDUE = "reminder_overdue"
+    NOTE = "note"
+
+# Queue an activity for MongoDB as part of the caller's transaction, returns the document
+def record_activity(conn, user_id: int, event: ActivityEvent, lead_id: Optional[int] = None, company: Optional[str] = None, before=None, after=None) -> dict:
+    document = {"v": ACTIVITY_SCHEMA_VERSION, "u": user_id, "e": event.value}
+    for field, value in (("l", lead_id), ("c", company), ("b", before), ("a", after)):
+        if value is not None:
+            document[field] = value
+
+    conn.execute(
+        sqlalchemy.text("INSERT INTO activity_outbox (document, created_at) VALUES (:document, :created_at)"),
+        {"document": json.dumps(document, default=str), "created_at": datetime.now(timezone.utc)},
+    )
+    return document
+
+# Show an ISO date the way the activity log always has, older documents already hold display text
+def activity_date(value) -> str:
+    try:
+        return date.fromisoformat(str(value)).strftime("%x")
+    except ValueError:
+        return str(value)
+
+# The sentence shown in the activity log
+def activity_details(document: dict) -> str:
+    user_id, company, before, after = document.get("u"), document.get("c"), document.get("b"), document.get("a")
+    match document.get("e"):
+        case ActivityEvent.LOGIN:
+            return f"User {user_id} logged in"
+        case ActivityEvent.LOGOUT:
+            return f"User {user_id} logged out"
+        case ActivityEvent.REGISTER:
+            return f"User {user_id} registered"
+        case ActivityEvent.LEAD_CREATE:
+            return f"Lead created by user {user_id} for {company} with agent {after['agent']} to {after['task']} for {activity_date(after['date'])}"
+        case ActivityEvent.LEAD_IMPORT:
+            return f"User {user_id} imported {after['imported']} leads, skipped {after['skipped']} duplicates"
+        case ActivityEvent.LEAD_TASK:
+            return f"User updated lead {company} task from {before} to {after}"
+        case ActivityEvent.LEAD_STAGE:
+            return f"User updated lead {company} stage from {before} to {after}"
+        case ActivityEvent.LEAD_COMPLETE:
+            return f"User completed lead {company}"
+        case ActivityEvent.LEAD_RESCHEDULE:
+            return f"User rescheduled lead: {company} from {before} to {after}"
+        case ActivityEvent.LEAD_DELETE:
+            return f"User deleted lead: {company}"
+        case ActivityEvent.REMINDER_DUE:
+            return f"Reminder: {after['task']} {company} is due today"
+        case ActivityEvent.REMINDER_OVERDUE:
+            return f"Reminder: {after['task']} {company} is overdue since {after['date']}"
+        case _:
+            return document.get("d", "")
+
+# The display fields the frontend has always received, worked out from a stored document
+def render_activity(document: dict) -> dict:
+    if "v" not in document:
+        document = compact_legacy_activity(document)
+    timestamp = document.get("t")
+    return {
+        "event_type": document.get("e"),
+        "lead_id": document.get("l"),
+        "timestamp": timestamp,
+        "time": timestamp.strftime("%X") if timestamp else "",
+        "date": timestamp.strftime("%x") if timestamp else "",
+        "details": activity_details(document),
+    }
+
+# The sentences written by schema version 1, named groups c, b and a fill those fields and any others go into a
+LEGACY_ACTIVITY_PATTERNS = [
+    (re.compile(r"User \d+ logged in"), ActivityEvent.LOGIN),
+    (re.compile(r"User \d+ logged out"), ActivityEvent.LOGOUT),
+    (re.compile(r"User \d+ registered"), ActivityEvent.REGISTER),
+    (re.compile(r"Lead created by user \d+ for (?P<c>.*) with agent (?P<agent>.*) to (?P<task>.*) for (?P<date>.*)"), ActivityEvent.LEAD_CREATE),
+    (re.compile(r"User \d+ imported (?P<imported>\d+) leads, skipped (?P<skipped>\d+) duplicates"), ActivityEvent.LEAD_IMPORT),
+    (re.compile(r"User updated lead (?P<c>.*) task from (?P<b>.*) to (?P<a>.*)"), ActivityEvent.LEAD_TASK),
+    (re.compile(r"User updated lead (?P<c>.*) stage from (?P<b>.*) to (?P<a>.*)"), ActivityEvent.LEAD_STAGE),
+    (re.compile(r"User completed lead (?P<c>.*)"), ActivityEvent.LEAD_COMPLETE),
+    (re.compile(r"User rescheduled lead: (?P<c>.*) from (?P<b>.*) to (?P<a>.*)"), ActivityEvent.LEAD_RESCHEDULE),
+    (re.compile(r"User deleted lead: (?P<c>.*)"), ActivityEvent.LEAD_DELETE),
+    (re.compile(r"Reminder: (?P<task>\S+) (?P<c>.*) is due today"), ActivityEvent.REMINDER_DUE),
+    (re.compile(r"Reminder: (?P<task>\S+) (?P<c>.*) is overdue since (?P<date>.*)"), ActivityEvent.REMINDER_OVERDUE),
+]
+
+# Turn a schema version 1 document ({user_id, time, date, details, timestamp}) into the compact form
+def compact_legacy_activity(document: dict) -> dict:
+    compact = {"v": ACTIVITY_SCHEMA_VERSION, "u": document.get("user_id")}
+    if "_id" in document:
+        compact["_id"] = document["_id"]
+
+    # Documents from before the outbox have no timestamp, only the display strings and their ObjectId
+    timestamp = document.get("timestamp")
+    if timestamp is None:
+        try:
+            timestamp = datetime.strptime(f"{document.get('date')} {document.get('time')}", "%x %X")
+        except ValueError:
+            timestamp = getattr(document.get("_id"), "generation_time", None)
+    if timestamp is not None:
+        compact["t"] = timestamp
+
+    details = document.get("details", "")
+    for pattern, event in LEGACY_ACTIVITY_PATTERNS:
+        match = pattern.fullmatch(details)
+        if match:
+            compact["e"] = event.value
+            fields = match.groupdict()
+            for field in ("c", "b", "a"):
+                if field in fields:
+                    compact[field] = fields.pop(field)
+            if fields:
+                compact["a"] = fields
+            return compact
+
+    compact["e"] = ActivityEvent.NOTE.value
+    compact["d"] = details
+    return compact
+
+# Insert documents in order, skipping any that an earlier attempt already delivered
+def insert_activity_batch(documents: list):
+    while documents:
+        try:
+            activity_log.insert_many(documents, ordered=True)
+            return
+        except pymongo.errors.BulkWriteError as e:
+            first_error = e.details["writeErrors"][0]
+            # Anything other than a duplicate outbox id is a real failure, leave the batch to be retried
+            if first_error["code"] != 11000:
+                raise
+            documents = documents[first_error["index"] + 1:]
+
+# The Mongo document for an outbox row, the outbox id becomes the Mongo _id so shipping the same row twice never duplicates it
+def outbox_activity(outbox_id: int, document: str, created_at: datetime) -> dict:
+    document = json.loads(document)
+    # Queued by a worker still running schema version 1
+    if "v" not in document:
+        document = compact_legacy_activity(document)
+    return {**document, "_id": outbox_id, "t": created_at}
+
+# Ship the oldest unshipped outbox rows to MongoDB, returns how many were shipped
+def ship_outbox_batch() -> int:
+    with database.begin() as conn:
+        # SKIP LOCKED lets relays in other workers take the next batch instead of waiting on this one
+        # SQLite has no row locks, it only allows one writer at a time anyway
+        rows = conn.execute(
+            sqlalchemy.text(f"""
+                SELECT id, document, created_at FROM activity_outbox
+                WHERE shipped_at IS NULL
+                ORDER BY id
+                LIMIT :limit
+                {"FOR UPDATE SKIP LOCKED" if database.dialect.name == "postgresql" else ""}
+            """),
+            {"limit": OUTBOX_BATCH_SIZE},
+        ).fetchall()
+
+        if not rows:
+            return 0
+
+        # The outbox id becomes the Mongo _id, so shipping the same row twice never duplicates it
+        insert_activity_batch([outbox_activity(*row) for row in rows])
+
+        conn.execute(
+            sqlalchemy.text("UPDATE activity_outbox SET shipped_at = CURRENT_TIMESTAMP WHERE id IN :ids")
+            .bindparams(sqlalchemy.bindparam("ids", expanding=True)),
+            {"ids": [row[0] for row in rows]},
+        )
+
+    outbox_stats["shipped"] += len(rows)
+    outbox_stats["last_shipped_at"] = datetime.now(timezone.utc)
+    return len(rows)
+
+# Shipped rows are kept for a while so tools/outbox-replay.py can send them again
+def prune_outbox():
+    with database.begin() as conn:
+        conn.execute(
+            sqlalchemy.text("DELETE FROM activity_outbox WHERE shipped_at < :cutoff"),
+            {"cutoff": datetime.now(timezone.utc) - OUTBOX_RETENTION},
+        )
+    outbox_stats["last_pruned_at"] = datetime.now(timezone.utc)
+
+# Keep shipping batches, backing off while MongoDB or Postgres is failing
+async def run_outbox_relay():
+    delay = OUTBOX_POLL_SECONDS
+    while True:
+        try:
+            shipped = await asyncio.to_thread(ship_outbox_batch)
+            delay = OUTBOX_POLL_SECONDS
+
+            # Prune about once an hour when there is nothing waiting
+            last_pruned_at = outbox_stats["last_pruned_at"]
+            if not shipped and (last_pruned_at is None or datetime.now(timezone.utc) - last_pruned_at > timedelta(hours=1)):
+                await asyncio.to_thread(prune_outbox)
+                await asyncio.to_thread(prune_lead_tombstones)
+        except Exception as e:
+            outbox_stats["failures"] += 1
+            outbox_stats["last_error"] = str(e)
+            print(f"Outbox relay error: {e}")
+            shipped = 0
+            delay = min(delay * 2, OUTBOX_MAX_BACKOFF_SECONDS)
+
+        # A full batch means more are waiting, so go again straight away
+        if shipped < OUTBOX_BATCH_SIZE:
+            await asyncio.sleep(delay)
+
+# How far behind the relay is
+def outbox_lag() -> dict:
+    with database.connect() as conn:
+        pending, oldest = conn.execute(
+            sqlalchemy.text("SELECT COUNT(*), MIN(created_at) FROM activity_outbox WHERE shipped_at IS NULL")
+        ).fetchone()
+
+    return {
+        "pending": pending,
+        "lag_seconds": (datetime.now(timezone.utc) - utc_timestamp(oldest)).total_seconds() if oldest else 0,
+        **outbox_stats,
+    }
+
+# Reminders fire at this hour (UTC) on a lead's action date, and again a day later if the lead is still open
+REMINDER_HOUR = int(os.getenv("REMINDER_HOUR", "8"))
+REMINDERS_ENABLED = os.getenv("REMINDERS_ENABLED", "1") == "1"
+
+# With several workers, leads changed in the others reach the reminder leader when it next reads the leads whose
+# updated_at has moved on since its last look, overlapping a little for transactions that committed late
+REMINDER_RELOAD_SECONDS = float(os.getenv("REMINDER_RELOAD_SECONDS", "60"))
+REMINDER_CHANGES_OVERLAP = timedelta(seconds=30)
+
+# Postgres advisory lock key held by the one worker that runs reminders, and how often the others check if it is free
+REMINDER_LEADER_LOCK = 71034
+REMINDER_LEADER_RETRY_SECONDS = 60
+
+# Write each reminder as a line of JSON, used locally and in tests
+class FileReminderNotifier:
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def send(self, reminder: dict):
+        with self.lock, open(self.path, "a") as f:
+            f.write(json.dumps(reminder, default=str) + "\n")
+
+# Email each reminder through an SMTP server
+class SmtpReminderNotifier:
+    def __init__(self, host: str, port: int, sender: str, recipient: str):
+        self.host = host
+        self.port = port
+        self.sender = sender
+        self.recipient = recipient
+
+    def send(self, reminder: dict):
+        message = EmailMessage()
+        message["From"] = self.sender
+        message["To"] = self.recipient
+        message["Subject"] = reminder["details"]
+        message.set_content(json.dumps(reminder, default=str, indent=2))
+        with smtplib.SMTP(self.host, self.port, timeout=10) as smtp:
+            smtp.send_message(message)
+
+# REMINDER_NOTIFIER=file:/path/to/reminders.log or smtp://host:port, leave unset to only log reminders as activity
+def reminder_notifier_from_env():
+    target = os.getenv("REMINDER_NOTIFIER", "")
+    if target.startswith("file:"):
+        return FileReminderNotifier(target[len("file:"):])
+    if target.startswith("smtp://"):
+        host, _, port = target[len("smtp://"):].partition(":")
+        return SmtpReminderNotifier(
+            host,
+            int(port or 25),
+            os.getenv("REMINDER_SMTP_FROM", "crm@localhost"),
+            os.getenv("REMINDER_SMTP_TO", "crm@localhost"),
+        )
+    return None
+
+# When the due and overdue reminders for an action date fire
+def reminder_time(action_date, kind: str) -> datetime:
+    action_date = date.fromisoformat(str(action_date)[:10])
+    due = datetime.combine(action_date, dt_time(REMINDER_HOUR), tzinfo=timezone.utc)
+    return due if kind == "due" else due + timedelta(days=1)
+
+# Keeps each user's upcoming action dates in a time ordered heap, loaded once at startup and kept up to date by lead changes
+# Moved or removed leads leave stale heap entries behind, they are skipped when popped rather than searched for
+class ReminderScheduler:
+    def __init__(self, notifier=None):
+        self.notifier = notifier
+        # user_id -> heap of (fire_at, lead_id, kind)
+        self.heaps = {}
+        # lead_id -> (fire_at, kind) for the reminder that is currently live
+        self.pending = {}
+        # heap of (fire_at, user_id), tells the loop which user's heap to look at next
+        self.wakeups = []
+        self.lock = threading.Lock()
+        self.loop = None
+        self.wake = None
+
+    # Queue the next reminder for an open lead, skipping any that would already be in the past
+    # A lead without an action date has nothing to remind about
+    def schedule_lead(self, lead_id: int, user_id: int, action_date):
+        if action_date is None:
+            self.unschedule(lead_id)
+            return
+        now = datetime.now(timezone.utc)
+        for kind in ("due", "overdue"):
+            fire_at = reminder_time(action_date, kind)
+            if fire_at > now:
+                self.schedule(lead_id, user_id, fire_at, kind)
+                return
+        self.unschedule(lead_id)
+
+    # Requests report the leads they change, but only the worker running the loop keeps heaps
+    # On any other worker the entries would never be popped, the leader's updated_at scan picks the change up anyway
+    def lead_changed(self, lead_id: int, user_id: int, action_date):
+        if self.loop is None:
+            return
+        self.schedule_lead(lead_id, user_id, action_date)
+
+    def schedule(self, lead_id: int, user_id: int, fire_at: datetime, kind: str):
+        with self.lock:
+            # Already queued, happens on every reload
+            if self.pending.get(lead_id) == (fire_at, kind):
+                return
+            self.pending[lead_id] = (fire_at, kind)
+            heapq.heappush(self.heaps.setdefault(user_id, []), (fire_at, lead_id, kind))
+            heapq.heappush(self.wakeups, (fire_at, user_id))
+
+        # Wake the loop in case this reminder is sooner than the one it is sleeping until
+        if self.loop:
+            self.loop.call_soon_threadsafe(self.wake.set)
+
+    def unschedule(self, lead_id: int):
+        with self.lock:
+            self.pending.pop(lead_id, None)
+
+    # Take every live reminder that is due by now
+    def pop_due(self, now: datetime) -> list:
+        due = []
+        with self.lock:
+            while self.wakeups and self.wakeups[0][0] <= now:
+                _, user_id = heapq.heappop(self.wakeups)
+                heap = self.heaps.get(user_id, [])
+                while heap and heap[0][0] <= now:
+                    fire_at, lead_id, kind = heapq.heappop(heap)
+                    if self.pending.get(lead_id) == (fire_at, kind):
+                        del self.pending[lead_id]
+                        due.append((user_id, lead_id, fire_at, kind))
+                if not heap:
+                    self.heaps.pop(user_id, None)
+        return due
+
+    def seconds_until_next(self, now: datetime) -> float:
+        with self.lock:
+            if not self.wakeups:
+                return 3600
+            return min(max((self.wakeups[0][0] - now).total_seconds(), 0), 3600)
+
+    # Load every open lead once at startup, returns the database time to look for changes after
+    def load(self) -> datetime:
+        with database.connect() as conn:
+            loaded_at = utc_timestamp(conn.execute(sqlalchemy.text("SELECT CURRENT_TIMESTAMP")).scalar())
+            rows = conn.execute(
+                sqlalchemy.text("""
+                    SELECT id, user_id, action_date FROM leads
+                    WHERE (task_status IS NULL OR task_status <> 'done')
+                    AND stage NOT IN ('Lost', 'Won')
+                    AND action_date IS NOT NULL
+                """)
+            ).fetchall()
+        for lead_id, user_id, action_date in rows:
+            self.schedule_lead(lead_id, user_id, action_date)
+        return loaded_at
+
+    # Apply leads changed or deleted since the last look, through leads_updated_at_idx, returns the time to look from next
+    def load_changes(self, since: datetime) -> datetime:
+        with database.connect() as conn:
+            loaded_at = utc_timestamp(conn.execute(sqlalchemy.text("SELECT CURRENT_TIMESTAMP")).scalar())
+            params = {"since": since - REMINDER_CHANGES_OVERLAP}
+            changed = conn.execute(
+                sqlalchemy.text("SELECT id, user_id, action_date, task_status, stage FROM leads WHERE updated_at > :since"),
+                params,
+            ).fetchall()
+            deleted = conn.execute(
+                sqlalchemy.text("SELECT lead_id FROM lead_tombstones WHERE deleted_at > :since"),
+                params,
+            ).scalars().all()
+
+        for lead_id, user_id, action_date, task_status, stage in changed:
+            if task_status == 'done' or stage in ('Lost', 'Won') or action_date is None:
+                self.unschedule(lead_id)
+            else:
+                self.schedule_lead(lead_id, user_id, action_date)
+        for lead_id in deleted:
+            self.unschedule(lead_id)
+        return loaded_at
+
+    # Log and send a reminder if the lead is still open and still due at this time
+    def fire(self, user_id: int, lead_id: int, fire_at: datetime, kind: str):
+        with database.begin() as conn:
+            lead = conn.execute(
+                sqlalchemy.text("""
+                    SELECT company_name, task, action_date, task_status, stage FROM leads
+                    WHERE id = :lead_id AND user_id = :user_id
+                """),
+                {"lead_id": lead_id, "user_id": user_id},
+            ).fetchone()
+
+            if not lead or lead[3] == 'done' or lead[4] in ('Lost', 'Won') or reminder_time(lead[2], kind) != fire_at:
+                return
+
+            company_name, task, action_date = lead[0], lead[1], lead[2]
+            event = ActivityEvent.REMINDER_DUE if kind == "due" else ActivityEvent.REMINDER_OVERDUE
+            document = record_activity(conn, user_id, event, lead_id=lead_id, company=company_name, after={"task": task, "date": action_date})
+            details = activity_details(document)
+
+        # Remind again tomorrow if it is still open then
+        if kind == "due":
+            self.schedule(lead_id, user_id, reminder_time(action_date, "overdue"), "overdue")
+
+        if self.notifier:
+            self.notifier.send({
+                "user_id": user_id,
+                "lead_id": lead_id,
+                "kind": kind,
+                "company_name": company_name,
+                "task": task,
+                "action_date": action_date,
+                "details": details,
+            })
+
+    async def run(self, reload_seconds: Optional[float] = None):
+        self.loop = asyncio.get_running_loop()
+        self.wake = asyncio.Event()
+        try:
+            await self.run_loop(reload_seconds)
+        finally:
+            self.loop = None
+
+    async def run_loop(self, reload_seconds: Optional[float]):
+        since = await asyncio.to_thread(self.load)
+        loaded_at = time.monotonic()
+
+        while True:
+            self.wake.clear()
+            if reload_seconds and time.monotonic() - loaded_at >= reload_seconds:
+                try:
+                    since = await asyncio.to_thread(self.load_changes, since)
+                except Exception as e:
+                    print(f"Reminder reload error: {e}")
+                loaded_at = time.monotonic()
+
+            for user_id, lead_id, fire_at, kind in self.pop_due(datetime.now(timezone.utc)):
+                try:
+                    await asyncio.to_thread(self.fire, user_id, lead_id, fire_at, kind)
+                except Exception as e:
+                    print(f"Reminder error for lead {lead_id}: {e}")
+
+            # Sleep until the next reminder or until a new one is scheduled
+            with suppress(asyncio.TimeoutError):
+                timeout = self.seconds_until_next(datetime.now(timezone.utc))
+                if reload_seconds:
+                    timeout = min(timeout, max(reload_seconds - (time.monotonic() - loaded_at), 0))
+                await asyncio.wait_for(self.wake.wait(), timeout=timeout)
+
+reminders = ReminderScheduler(reminder_notifier_from_env())
+
+# Run the job in one worker only, holding a Postgres advisory lock on a connection kept open for as long as it runs
+# The other workers keep trying so one of them takes over if the leader exits
+async def run_as_leader(lock_key: int, job):
+    if database.dialect.name != "postgresql":
+        await job()
+        return
+
+    while True:
+        try:
+            conn = await asyncio.to_thread(database.connect)
+        except Exception as e:
+            print(f"Leader election error: {e}")
+            await asyncio.sleep(REMINDER_LEADER_RETRY_SECONDS)
+            continue
+
+        try:
+            leader = await asyncio.to_thread(
+                lambda: conn.execute(sqlalchemy.text("SELECT pg_try_advisory_lock(:key)"), {"key": lock_key}).scalar()
+            )
+            # The lock belongs to the session, so end the transaction rather than sit idle in one
+            await asyncio.to_thread(conn.commit)
+            if leader:
+                await job()
+                return
+        finally:
+            # Closing the real connection releases the lock, returning it to the pool would not
+            if not conn.closed:
+                conn.invalidate()
+                conn.close()
+        await asyncio.sleep(REMINDER_LEADER_RETRY_SECONDS)
+
+# Lead enrichment
+# A background worker asks the LLM for a suggested next task, a sector tag and a priority for each new or edited lead
+# A lead is waiting while its enriched_at is NULL, so creating or editing it is all it takes to queue it
+# Off unless ENRICHMENT_ENABLED=1, every request costs money
+ENRICHMENT_ENABLED = os.getenv("ENRICHMENT_ENABLED") == "1"
+ENRICHMENT_MODEL = os.getenv("ENRICHMENT_MODEL", "gpt-5-nano")
+ENRICHMENT_LEADER_LOCK = 71042
+
+# Leads per LLM request and requests in flight at once
+ENRICHMENT_BATCH_SIZE = int(os.getenv("ENRICHMENT_BATCH_SIZE", "20"))
+ENRICHMENT_CONCURRENCY = int(os.getenv("ENRICHMENT_CONCURRENCY", "4"))
+
+# Tries per request, waiting ENRICHMENT_RETRY_SECONDS then doubling. A lead the model keeps leaving out of its answer
+# is given up on after ENRICHMENT_MAX_ATTEMPTS answers
+ENRICHMENT_MAX_ATTEMPTS = 3
+ENRICHMENT_RETRY_SECONDS = float(os.getenv("ENRICHMENT_RETRY_SECONDS", "2"))
+
+# The worker looks for leads this often, and straight away when this worker creates one
+# After waking it waits a moment so leads created together go in the same request
+ENRICHMENT_POLL_SECONDS = 30
+ENRICHMENT_GATHER_SECONDS = 2
+enrichment_wakeup = asyncio.Event()
+
+LEAD_TASKS = ("contact", "follow_up", "reply")
+
+ENRICHMENT_PROMPT = """You help M&A sales reps decide which leads to work on. For each lead below give the next task
+(one of contact, follow_up, reply), a sector tag for the company of one to three words, and a priority from 0 (ignore)
+to 100 (work on it today).
+Reply with JSON only, one entry per lead using the lead's ref, like:
+{"leads": [{"ref": 0, "suggested_task": "contact", "sector": "Software", "priority": 50}]}
+
+Leads:
+"""
+
+# The details the LLM sees, anything else about the lead doesn't change its answer
+def enrichment_content(lead: dict) -> dict:
+    return {
+        "company": lead["company_name"],
+        "im": lead["im"],
+        "agent": lead["agent_name"],
+        "domain": (lead["email"] or "").rpartition("@")[2].lower(),
+        "task": lead["task"],
+        "stage": lead["stage"],
+    }
+
+def enrichment_content_hash(content: dict) -> str:
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode("utf-8")).hexdigest()[:32]
+
+# Pull ref -> result out of the model's answer, dropping entries that don't fit
+def parse_enrichment(text: str, count: int) -> dict:
+    # Models sometimes wrap the JSON in a code fence or a sentence
+    entries = json.loads(text[text.find("{"):text.rfind("}") + 1])["leads"]
+
+    results = {}
+    for entry in entries:
+        ref = entry.get("ref")
+        sector = str(entry.get("sector") or "").strip()[:60]
+        if not isinstance(ref, int) or not 0 <= ref < count or entry.get("suggested_task") not in LEAD_TASKS or not sector:
+            continue
+        try:
+            priority = min(100, max(0, int(entry.get("priority"))))
+        except (TypeError, ValueError):
+            continue
+        results[ref] = {"suggested_task": entry["suggested_task"], "sector": sector, "ai_priority": priority}
+    return results
+
+# One LLM request for a batch of leads, retries are done by the caller so the client's own are turned off
+def request_enrichment(contents: list) -> dict:
+    leads = [{"ref": ref, **content} for ref, content in enumerate(contents)]
+    response = client.with_options(max_retries=0).responses.create(
+        model=ENRICHMENT_MODEL,
+        input=ENRICHMENT_PROMPT + json.dumps(leads),
+    )
+    return parse_enrichment(response.output_text, len(contents))
+
+# Failures that say nothing about the leads themselves, worth retrying and not held against the leads
+TRANSIENT_ENRICHMENT_ERRORS = (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError)
+
+# Returns None if the API was unreachable on every try, and no results when the request or its answer was unusable,
+# so every lead in the batch has the failed attempt counted instead of being sent again forever
+async def enrich_with_retries(contents: list, semaphore: asyncio.Semaphore) -> Optional[dict]:
+    async with semaphore:
+        for attempt in range(ENRICHMENT_MAX_ATTEMPTS):
+            try:
+                return await asyncio.to_thread(request_enrichment, contents)
+            except TRANSIENT_ENRICHMENT_ERRORS as e:
+                print(f"Enrichment request failed: {e}")
+                if attempt + 1 < ENRICHMENT_MAX_ATTEMPTS:
+                    await asyncio.sleep(ENRICHMENT_RETRY_SECONDS * 2 ** attempt)
+            except Exception as e:
+                print(f"Enrichment answer unusable: {e}")
+                return {}
+    return None
+
+# The oldest leads waiting for enrichment, and cached results for any whose details have been seen before
+def load_pending_enrichment(limit: int) -> tuple:
+    with database.connect() as conn:
+        leads = [
+            dict(row) for row in conn.execute(
+                sqlalchemy.text("""
+                    SELECT id, user_id, version, im, company_name, agent_name, email, task, stage, enrichment_hash
+                    FROM leads
+                    WHERE enriched_at IS NULL AND enrichment_attempts < :max_attempts
+                    ORDER BY id
+                    LIMIT :limit
+                """),
+                {"max_attempts": ENRICHMENT_MAX_ATTEMPTS, "limit": limit},
+            ).mappings()
+        ]
+        for lead in leads:
+            lead["content_hash"] = enrichment_content_hash(enrichment_content(lead))
+
+        cached = {}
+        if leads:
+            rows = conn.execute(
+                sqlalchemy.text("SELECT content_hash, suggested_task, sector, ai_priority FROM enrichment_cache WHERE content_hash IN :hashes")
+                .bindparams(sqlalchemy.bindparam("hashes", expanding=True)),
+                {"hashes": list({lead["content_hash"] for lead in leads})},
+            )
+            cached = {row[0]: {"suggested_task": row[1], "sector": row[2], "ai_priority": row[3]} for row in rows}
+
+    return leads, cached
+
+# Write results back in one transaction
+# The version check skips leads edited since they were read, the edit queued them again with new details
+def save_enrichment(enriched: list, unchanged: list, failed: list, new_results: dict):
+    with database.begin() as conn:
+        if new_results:
+            conn.execute(
+                sqlalchemy.text("""
+                    INSERT INTO enrichment_cache (content_hash, suggested_task, sector, ai_priority)
+                    VALUES (:content_hash, :suggested_task, :sector, :ai_priority)
+                    ON CONFLICT (content_hash) DO NOTHING
+                """),
+                [{"content_hash": content_hash, **result} for content_hash, result in new_results.items()],
+            )
+        if enriched:
+            conn.execute(
+                sqlalchemy.text("""
+                    UPDATE leads
+                    SET suggested_task = :suggested_task, sector = :sector, ai_priority = :ai_priority,
+                        enrichment_hash = :content_hash, enriched_at = CURRENT_TIMESTAMP, enrichment_attempts = 0,
+                        updated_at = CURRENT_TIMESTAMP
+                    WHERE id = :id AND version = :version AND enriched_at IS NULL
+                """),
+                [
+                    {key: lead[key] for key in ("id", "version", "content_hash", "suggested_task", "sector", "ai_priority")}
+                    for lead in enriched
+                ],
+            )
+        if unchanged:
+            conn.execute(
+                sqlalchemy.text("UPDATE leads SET enriched_at = CURRENT_TIMESTAMP WHERE id = :id AND version = :version AND enriched_at IS NULL"),
+                [{"id": lead["id"], "version": lead["version"]} for lead in unchanged],
+            )
+        if failed:
+            conn.execute(
+                sqlalchemy.text("UPDATE leads SET enrichment_attempts = enrichment_attempts + 1 WHERE id IN :ids")
+                .bindparams(sqlalchemy.bindparam("ids", expanding=True)),
+                {"ids": [lead["id"] for lead in failed]},
+            )
+
+# Enrich one round of waiting leads, returns how many were settled
+# Leads from requests that couldn't reach the API are left as they were for the next round
+async def enrich_pending_leads() -> int:
+    leads, cached = await asyncio.to_thread(load_pending_enrichment, ENRICHMENT_BATCH_SIZE * ENRICHMENT_CONCURRENCY)
+
+    enriched, unchanged, failed = [], [], []
+    # content hash -> (content, leads with it), leads with the same details share one place in a request
+    waiting = {}
+    for lead in leads:
+        if lead["content_hash"] == lead["enrichment_hash"]:
+            unchanged.append(lead)
+        elif lead["content_hash"] in cached:
+            enriched.append({**lead, **cached[lead["content_hash"]]})
+        else:
+            waiting.setdefault(lead["content_hash"], (enrichment_content(lead), []))[1].append(lead)
+
+    hashes = list(waiting)
+    batches = [hashes[i:i + ENRICHMENT_BATCH_SIZE] for i in range(0, len(hashes), ENRICHMENT_BATCH_SIZE)]
+    semaphore = asyncio.Semaphore(ENRICHMENT_CONCURRENCY)
+    answers = await asyncio.gather(*(
+        enrich_with_retries([waiting[content_hash][0] for content_hash in batch], semaphore)
+        for batch in batches
+    ))
+
+    new_results = {}
+    for batch, results in zip(batches, answers):
+        if results is None:
+            continue
+        for ref, content_hash in enumerate(batch):
+            if ref in results:
+                new_results[content_hash] = results[ref]
+                enriched.extend({**lead, **results[ref]} for lead in waiting[content_hash][1])
+            else:
+                failed.extend(waiting[content_hash][1])
+
+    if enriched or unchanged or failed:
+        await asyncio.to_thread(save_enrichment, enriched, unchanged, failed, new_results)
+    # The model's priority is part of the score
+    if enriched:
+        await asyncio.to_thread(refresh_lead_priorities, [lead["id"] for lead in enriched])
+        for user_id in {lead["user_id"] for lead in enriched}:
+            on_lead_mutation(user_id)
+    return len(enriched) + len(unchanged) + len(failed)
+
+async def run_enrichment_worker():
+    while True:
+        try:
+            settled = await enrich_pending_leads()
+        except Exception as e:
+            print(f"Enrichment error: {e}")
+            settled = 0
+
+        # A full round means more are waiting, so go again straight away
+        if settled < ENRICHMENT_BATCH_SIZE * ENRICHMENT_CONCURRENCY:
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(enrichment_wakeup.wait(), ENRICHMENT_POLL_SECONDS)
+            enrichment_wakeup.clear()
+            await asyncio.sleep(ENRICHMENT_GATHER_SECONDS)
+
+# Requests allowed per client on the expensive routes: (tokens added per second, bucket size)
+RATE_LIMITS = {
+    "login": (5 / 60, 5),
+    "llm": (10 / 60, 5),
+    "create_lead": (30 / 60, 10),
+    "export": (6 / 60, 3),
+    "import": (6 / 60, 3),
+}
+
+# Token buckets kept in this process, fine for a single worker
+class MemoryTokenBuckets:
+    def __init__(self, max_keys: int = 10000):
+        self.buckets = {}
+        self.max_keys = max_keys
+        self.lock = threading.Lock()
+
+    # Take a token, returns 0 if allowed otherwise the seconds until a token is free
+    def take(self, key: str, rate: float, capacity: int) -> float:
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated = self.buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * rate)
+
+            if tokens >= 1:
+                self.buckets[key] = (tokens - 1, now)
+                wait = 0.0
+            else:
+                self.buckets[key] = (tokens, now)
+                wait = (1 - tokens) / rate
+
+            # Buckets that have been idle long enough to refill are the same as new ones, so drop them
+            if len(self.buckets) > self.max_keys:
+                self.buckets = {
+                    k: (t, u) for k, (t, u) in self.buckets.items()
+                    if (now - u) * rate + t < capacity
+                }
+
+            return wait
+
+# Token buckets in Redis so every worker shares the same limits
+class RedisTokenBuckets:
+    # Refill and take in one atomic step, using the Redis clock so workers agree on time
+    TAKE_SCRIPT = """
+        local rate = tonumber(ARGV[1])
+        local capacity = tonumber(ARGV[2])
+        local clock = redis.call('TIME')
+        local now = clock[1] + clock[2] / 1000000
+        local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+        local tokens = tonumber(state[1]) or capacity
+        local updated = tonumber(state[2]) or now
+        tokens = math.min(capacity, tokens + (now - updated) * rate)
+        local wait = 0
+        if tokens >= 1 then
+            tokens = tokens - 1
+        else
+            wait = (1 - tokens) / rate
+        end
+        redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated', now)
+        redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+        return tostring(wait)
+    """
+
+    def __init__(self, redis_client):
+        self.take_script = redis_client.register_script(self.TAKE_SCRIPT)
+
+    def take(self, key: str, rate: float, capacity: int) -> float:
+        return float(self.take_script(keys=[f"ratelimit:{key}"], args=[rate, capacity]))
+
+# Use Redis when several workers need to share limits, otherwise keep buckets in memory
+rate_limiter = RedisTokenBuckets(redis_client) if redis_client else MemoryTokenBuckets()
+
+# Turn away a client that has used up its requests for this route
+# Routes that authenticate first pass the user id, anything else (login) is limited per IP address and account name,
+# a cookie the client picks itself would let it start a fresh bucket with every request
+def enforce_rate_limit(request: Request, name: str, user_id: Optional[int] = None, account: Optional[str] = None):
+    rate, capacity = RATE_LIMITS[name]
+
+    if user_id is not None:
+        client_key = f"user:{user_id}"
+    else:
+        client_key = f"ip:{request.client.host if request.client else 'unknown'}"
+        if account is not None:
+            client_key += f":account:{account}"
+
+    wait = rate_limiter.take(f"{name}:{client_key}", rate, capacity)
+    if wait > 0:
+        raise HTTPException(
+            status_code=429,
+            detail="Too many requests",
+            headers={"Retry-After": str(math.ceil(wait))},
+        )
+
+# Reads in progress, identical requests that arrive together wait for the same query instead of running their own
+in_flight_reads = {}
+
+async def coalesce(key, fn, *args):
+    task = in_flight_reads.get(key)
+    if task is None:
+        task = asyncio.ensure_future(asyncio.to_thread(fn, *args))
+        in_flight_reads[key] = task
+
+        def forget(done_task):
+            if in_flight_reads.get(key) is done_task:
+                del in_flight_reads[key]
+        task.add_done_callback(forget)
+
+    # Shield so one client disconnecting doesn't cancel the query for everyone else waiting on it
+    return await asyncio.shield(task)
+
 # Redirect to login page
 @app.get("/")
 async def root():
@@ -66,6 +1655,9 @@ async def login(request: Request):
 # Log user function
 @app.post('/login')
 async def login(request: Request, user_name: str = Form(...), password: str = Form(...)):
+    # Argon2 is slow on purpose, don't let one client keep the CPU busy
+    enforce_rate_limit(request, "login", account=user_name)
+
     with database.begin() as connector:
         # See if user exists
         result = connector.execute(
@@ -77,8 +1669,9 @@ async def login(request: Request, user_name: str = Form(...), password: str = Fo
         # If user not found
         if not result:
             return templates.TemplateResponse(
+                request,
                 "login.html",
-                {"request": request, "error": "Invalid username or password"},
+                {"error": "Invalid username or password"},
                 status_code=400,
             )
     
@@ -89,8 +1682,9 @@ async def login(request: Request, user_name: str = Form(...), password: str = Fo
             ph.verify(password_hash, password)
         except VerifyMismatchError:
             return templates.TemplateResponse(
+                request,
                 "login.html",
-                {"request": request, "error": "Invalid username or password"},
+                {"error": "Invalid username or password"},
                 status_code=400,
             )
             
@@ -107,15 +1701,7 @@ async def login(request: Request, user_name: str = Form(...), password: str = Fo
         )
         
         # Send activity log to NoSQL DB
-        login_activity = {
-            'user_id': user_id,
-            'timestamp': datetime.now(timezone.utc),
-            'time': (datetime.now(timezone.utc).strftime('%X')),
-            'date': (datetime.now(timezone.utc).strftime('%x')),
-            'details': f'User {user_id} logged in'
-        }
-        
-        activity_log.insert_one(login_activity)
+        record_activity(connector, user_id, ActivityEvent.LOGIN)
 
         # Set cookie in response
         response = RedirectResponse(url="/dashboard", status_code=303)
@@ -148,7 +1734,7 @@ async def registerUser(request: Request, user_name: str = Form(...), password: s
         
         # if user exists return username already exists
         if result:
-            return templates.TemplateResponse("register.html", {"request": request, "error": "Username already exists"}, status_code=400)
+            return templates.TemplateResponse(request, "register.html", {"error": "Username already exists"}, status_code=400)
         
         # If user does not exist
         # Hash password
@@ -175,15 +1761,7 @@ async def registerUser(request: Request, user_name: str = Form(...), password: s
         )
         
         # Log activity
-        register_activity = {
-            'user_id': new_user,
-            'timestamp': datetime.now(timezone.utc),
-            'time': datetime.now(timezone.utc).strftime('%X'),
-            'date': datetime.now(timezone.utc).strftime('%x'),
-            'details': f'User {new_user} registered'
-        }
-        
-        activity_log.insert_one(register_activity)
+        record_activity(connector, new_user, ActivityEvent.REGISTER)
         
         # Set cookie and redirect new user to dashboard
         response = RedirectResponse(url="/dashboard", status_code=303)
@@ -203,6 +1781,11 @@ def require_user_id(request: Request) -> int:
     if not session_id:
         raise HTTPException(status_code=401, detail="Not logged in")
 
+    # Most requests come from a session that was checked a moment ago
+    user_id = cache.get(f"session:{session_id}")
+    if user_id is not None:
+        return user_id
+
     with database.begin() as conn:
         row = conn.execute(
             sqlalchemy.text("SELECT user_id FROM sessions WHERE id = :id"),
@@ -212,8 +1795,66 @@ def require_user_id(request: Request) -> int:
     if not row:
         raise HTTPException(status_code=401, detail="Invalid session")
 
+    cache.set(f"session:{session_id}", row[0], SESSION_CACHE_SECONDS)
     return row[0]
 
+# Changes whenever the user's leads do, cache keys and ETags built from it go stale on their own
+# None when there is no cache to keep it in, callers then skip caching
+def lead_generation(user_id: int) -> Optional[str]:
+    key = f"leadgen:{user_id}"
+    generation = cache.get(key)
+    if generation is None:
+        # Start from a random value so a restarted worker never reuses an old generation
+        cache.add(key, secrets.token_hex(8), LEAD_CACHE_SECONDS * 24)
+        generation = cache.get(key)
+    return generation
+
+
+# Render the dashboard's lead table and metric cards, reusing the cached html until the user's leads change
+def render_dashboard_fragments(user_id: int, request: Optional[Request] = None) -> dict:
+    # Metrics count against CURRENT_DATE so fragments from a previous day are stale
+    generation = lead_generation(user_id)
+    cache_key = f"fragments:{user_id}:{generation}:{date.today()}"
+    if generation is not None:
+        cached = cache.get(cache_key)
+        if cached:
+            return {name: Markup(html) for name, html in cached.items()}
+
+    # Same leads as today's tasks in dashboard.js, the highest priority open ones
+    engine = database if ensure_fresh_priorities(user_id, request) else reader_for(request, user_id)
+    with engine.connect() as conn:
+        leads = fetch_leads(conn, user_id, "top", DASHBOARD_TASK_LIMIT)
+        metrics = fetch_lead_metrics(conn, user_id)
+
+    fragments = {
+        "leads_html": Markup(templates.get_template("fragments/dashboard_leads.html").render(leads=leads)),
+        "metrics_html": Markup(templates.get_template("fragments/dashboard_metrics.html").render(metrics=metrics)),
+    }
+    if generation is not None:
+        cache.set(cache_key, {name: str(html) for name, html in fragments.items()}, LEAD_CACHE_SECONDS)
+    return fragments
+
+
+# Call after any change to a user's leads so cached views are rebuilt and their reads stick to the primary
+def on_lead_mutation(user_id: int):
+    cache.set(f"leadgen:{user_id}", secrets.token_hex(8), LEAD_CACHE_SECONDS * 24)
+    cache.set(f"lastwrite:{user_id}", time.time(), READ_YOUR_WRITES_SECONDS)
+
+# Mark the browser after any successful change so its next reads go to the primary whichever worker serves them
+@app.middleware("http")
+async def mark_recent_write(request: Request, call_next):
+    response = await call_next(request)
+    if request.method in ("POST", "PATCH", "PUT", "DELETE") and request.url.path.startswith("/api/") and response.status_code < 400:
+        response.set_cookie(
+            key="last_write",
+            value=str(time.time()),
+            max_age=math.ceil(READ_YOUR_WRITES_SECONDS),
+            httponly=True,
+            samesite="lax",
+            secure=False
+        )
+    return response
+
         
 # Get the dashboard to display
 @app.get('/dashboard', response_class=HTMLResponse)
@@ -221,10 +1862,18 @@ async def home(request: Request):
 
     # If user tries to type /dashboard without logging in, kick them out
     try:
-        require_user_id(request)
+        user_id = require_user_id(request)
     except HTTPException:
         return RedirectResponse(url="/login")  # redirect if not logged in [web:688]
-    return templates.TemplateResponse(request, "dashboard.html")
+
+    # Render today's tasks and metrics into the page when server rendering is on
+    # The page carries the user id so the browser's lead cache can tell whose leads it holds
+    render = request.query_params.get("render", "server" if SERVER_RENDERED_DASHBOARD else "client")
+    if render != "server":
+        return templates.TemplateResponse(request, "dashboard.html", {"user_id": user_id})
+
+    fragments = await asyncio.to_thread(render_dashboard_fragments, user_id, request)
+    return templates.TemplateResponse(request, "dashboard.html", {**fragments, "user_id": user_id})
     
 
 # When user logs out, delete session id from database for security and delete cookies from browser
@@ -247,50 +1896,62 @@ async def logout(request: Request):
         
         # Get user_id from result
         user_id = result[0]
+        cache.delete(f"session:{session_id}")
         
         # Send activity log to NoSQL DB
-        logout_activity = {
-            'user_id': user_id,
-            'timestamp': datetime.now(timezone.utc),
-            'time': (datetime.now(timezone.utc).strftime('%X')),
-            'date': (datetime.now(timezone.utc).strftime('%x')),
-            'details': f'User {user_id} logged out'
-        }
-        
-        activity_log.insert_one(logout_activity)
+        record_activity(connector, user_id, ActivityEvent.LOGOUT)
         
         # Delete cookies
         response.delete_cookie("id")
         
         return response
     
+# Legal forms dropped from the end of a company name, so "Acme Ltd" and "ACME Limited" get the same key
+LEGAL_SUFFIXES = {
+    "ltd", "limited", "plc", "llc", "llp", "lp", "inc", "incorporated", "corp", "corporation", "co", "company",
+    "gmbh", "ag", "kg", "sa", "sas", "sarl", "srl", "spa", "bv", "nv", "pty", "pte", "oy", "ab", "as",
+}
+
+# Normalized company name used to spot duplicate leads, stored in leads.company_key
+def company_key(name: Optional[str]) -> str:
+    # Drop accents but keep letters from other scripts
+    name = "".join(c for c in unicodedata.normalize("NFKD", name or "") if not unicodedata.combining(c)).casefold()
+    # "L.T.D." and "S.A." are the same as "ltd" and "sa"
+    name = name.replace(".", "").replace("&", " and ")
+    tokens = re.sub(r"[\W_]+", " ", name).split()
+
+    if len(tokens) > 1 and tokens[0] == "the":
+        tokens = tokens[1:]
+    while len(tokens) > 1 and (tokens[-1] in LEGAL_SUFFIXES or tokens[-1] == "and"):
+        tokens.pop()
+    return " ".join(tokens)
+
+def normalize_email(email: Optional[str]) -> str:
+    return (email or "").strip().lower()
+
+# Oldest of the user's leads with the same company key or email, uses the indexes from tools/migrate.py
+def find_duplicate_lead(conn, user_id: int, key: str, email: str):
+    return conn.execute(
+        sqlalchemy.text("""
+            SELECT id, company_name, email FROM leads
+            WHERE user_id = :user_id
+            AND (company_key = :company_key OR lower(email) = :email)
+            ORDER BY id
+            LIMIT 1
+        """),
+        {"user_id": user_id, "company_key": key or None, "email": normalize_email(email) or None},
+    ).fetchone()
+
 # Create leads from modal menu
 @app.post("/api/leads")
 async def create_lead(request: Request):
-    print("Cookies:", request.cookies)
-    data = await request.json()
-    
-    # Valdiate Email with gloud function
-    async with httpx.AsyncClient() as client:
-       try:
-            validation_email = await client.post( EMAIL_VALIDATOR_CLOUD_FUNCTION, json={"email": data["email"]}, timeout=4.0)
-            validation_result = validation_email.json()
-            
-            if not validation_result.get('valid'):
-                return JSONResponse(
-                    {"ok": False, "error": "Email format incorrect"},
-                    status_code=400
-                )
-       except Exception as e:
-           print(f"Cloud Function error: {e}")
-           
     # Get session_id from cookie
     session_id = request.cookies.get("id")
     if not session_id:
         return JSONResponse({"ok": False, "error": "Not logged in"}, status_code=401)
 
+    # Authenticate before anything else, so made up session ids can't reach the validator
     with database.begin() as connector:
-        # Authenticate user
         row = connector.execute(
             sqlalchemy.text("SELECT user_id, expires_at FROM sessions WHERE id = :id"),
             {"id": session_id},
@@ -309,17 +1970,52 @@ async def create_lead(request: Request):
             )
             return JSONResponse({"ok": False, "error": "Session expired"}, status_code=401)
 
+    # Every create calls the email validator, so limit how often a user can post
+    enforce_rate_limit(request, "create_lead", user_id)
+
+    data = await request.json()
+    
+    # Valdiate Email with gloud function
+    async with email_validator_client() as client:
+       try:
+            validation_email = await client.post( EMAIL_VALIDATOR_CLOUD_FUNCTION, json={"email": data["email"]}, timeout=4.0)
+            validation_result = validation_email.json()
+            
+            if not validation_result.get('valid'):
+                return JSONResponse(
+                    {"ok": False, "error": "Email format incorrect"},
+                    status_code=400
+                )
+       except Exception as e:
+           print(f"Cloud Function error: {e}")
+
+    with database.begin() as connector:
+        # Ask before adding a company or email the user already has, the client resends with allow_duplicate to save it anyway
+        key = company_key(data["company_name"])
+        if not data.get("allow_duplicate"):
+            duplicate = find_duplicate_lead(connector, user_id, key, data["email"])
+            if duplicate:
+                return JSONResponse(
+                    {
+                        "ok": False,
+                        "error": "Possible duplicate",
+                        "duplicate": {"id": duplicate[0], "company_name": duplicate[1], "email": duplicate[2]},
+                    },
+                    status_code=409,
+                )
+
         # Insert lead info from modal menu into sql database
         new_lead_id = connector.execute(
             sqlalchemy.text("""
-                INSERT INTO leads (user_id, im, company_name, agent_name, email, task, action_date)
-                VALUES (:user_id, :im, :company_name, :agent_name, :email, :task, :action_date)
+                INSERT INTO leads (user_id, im, company_name, company_key, agent_name, email, task, action_date, updated_at)
+                VALUES (:user_id, :im, :company_name, :company_key, :agent_name, :email, :task, :action_date, CURRENT_TIMESTAMP)
                 RETURNING id
             """),
             {
                 "user_id": user_id,
                 "im": data["im"],
                 "company_name": data["company_name"],
+                "company_key": key,
                 "agent_name": data["agent_name"],
                 "email": data["email"],
                 "task": data["task"],
@@ -327,72 +2023,128 @@ async def create_lead(request: Request):
             },
         ).scalar()
         
-        # Add to activity log      
-        dateReformat = date.fromisoformat(data["date"]).strftime("%x")
-        
-        create_lead_activity = {
-            'user_id': user_id,
-            'timestamp': datetime.now(timezone.utc),
-            'time': (datetime.now(timezone.utc).strftime('%X')),
-            'date': (datetime.now(timezone.utc).strftime('%x')),
-            'details': f"Lead created by user {user_id} for {data['company_name']} with agent {data['agent_name']} to {data['task']} for {dateReformat}"
-        } # Time and date should go on left hand side
-        
-        activity_log.insert_one(create_lead_activity)
+        # Add to activity log
+        record_activity(
+            connector, user_id, ActivityEvent.LEAD_CREATE, lead_id=new_lead_id, company=data["company_name"],
+            after={"agent": data["agent_name"], "task": data["task"], "date": data["date"]},
+        )
         
 
+    # Score after the commit, then change the generation so cached lists pick the score up
+    await asyncio.to_thread(refresh_lead_priorities, [new_lead_id])
+    on_lead_mutation(user_id)
+    reminders.lead_changed(new_lead_id, user_id, data["date"])
+    # Let this worker's enrichment loop pick the lead up now rather than at its next poll
+    enrichment_wakeup.set()
+
     return {"ok": True, "id": new_lead_id}
 
-# Get leads to show on dashboard
-@app.get("/api/getleads")
-async def get_leads(request: Request):
-    session_id = request.cookies.get("id")
-    source = request.query_params.get("source")
-    
-    # Check if logged in
-    if not session_id:
-        raise HTTPException(status_code=401, detail="Not logged in")
-    
-    
-    with database.begin() as connector:
-        # Authenticate
-        lead_row = connector.execute(
-            sqlalchemy.text("SELECT user_id FROM sessions WHERE id = :id"),
-        {"id": session_id},
-        ).fetchone()
-        
-        if not lead_row:
-            raise HTTPException(status_code=401, detail="Invalid session")
-        
-        user_id = lead_row[0]
-        lead_rows=[]
-    
-        # Check if api request is from leads.js or dashboard.js
-        match source:
-            case "leadpage":
-                lead_rows = connector.execute(
+# Most leads accepted by one import request
+IMPORT_MAX_LEADS = 5000
+
+class ImportedLead(BaseModel):
+    im: str
+    company_name: str
+    agent_name: str
+    email: str
+    task: str
+    date: date
+
+class LeadImport(BaseModel):
+    leads: list[ImportedLead]
+    allow_duplicates: bool = False
+
+# Columns written by a bulk import, a Core insert lets SQLAlchemy batch the rows and still return their ids
+leads_table = sqlalchemy.Table(
+    "leads",
+    sqlalchemy.MetaData(),
+    sqlalchemy.Column("id", sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column("user_id", sqlalchemy.Integer),
+    sqlalchemy.Column("im", sqlalchemy.Text),
+    sqlalchemy.Column("company_name", sqlalchemy.Text),
+    sqlalchemy.Column("company_key", sqlalchemy.Text),
+    sqlalchemy.Column("agent_name", sqlalchemy.Text),
+    sqlalchemy.Column("email", sqlalchemy.Text),
+    sqlalchemy.Column("task", sqlalchemy.Text),
+    sqlalchemy.Column("action_date", sqlalchemy.Date),
+    sqlalchemy.Column("updated_at", sqlalchemy.DateTime(timezone=True)),
+)
+
+# Import many leads at once, skipping ones that match an existing lead or an earlier row in the same import
+# Emails aren't sent to the validator here, one call per row would make large imports too slow
+@app.post("/api/leads/import")
+async def importLeads(payload: LeadImport, request: Request):
+    user_id = require_user_id(request)
+    enforce_rate_limit(request, "import", user_id)
+
+    if len(payload.leads) > IMPORT_MAX_LEADS:
+        raise HTTPException(status_code=413, detail=f"Import at most {IMPORT_MAX_LEADS} leads at a time")
+
+    rows = [
+        {
+            "user_id": user_id,
+            "im": lead.im,
+            "company_name": lead.company_name,
+            "company_key": company_key(lead.company_name),
+            "agent_name": lead.agent_name,
+            "email": lead.email,
+            "task": lead.task,
+            "action_date": lead.date,
+        }
+        for lead in payload.leads
+    ]
+
+    with database.begin() as conn:
+        # One query finds every existing match for the whole import
+        seen_keys, seen_emails = set(), set()
+        if not payload.allow_duplicates:
+            existing = conn.execute(
                 sqlalchemy.text("""
-                                SELECT id, im, company_name, agent_name, email, task, action_date, stage 
-                                FROM leads 
-                                WHERE user_id = :user_id
-                                ORDER BY id DESC
-                            """),
-                            {"user_id": user_id},
-                        ).fetchall()
-            case _:
-                lead_rows = connector.execute(
-                    sqlalchemy.text("""
-                                    SELECT id, im, company_name, agent_name, email, task, action_date, stage 
-                                    FROM leads 
-                                    WHERE user_id = :user_id
-                                    AND COALESCE(task_status, 'open') <> 'done'
-                                    ORDER BY id DESC
-                                """),
-                                {"user_id": user_id},
-                            ).fetchall()
-        
-    # Turn leads into JSON
-    leads = [
+                    SELECT company_key, lower(email) FROM leads
+                    WHERE user_id = :user_id
+                    AND (company_key IN :keys OR lower(email) IN :emails)
+                """).bindparams(
+                    sqlalchemy.bindparam("keys", expanding=True),
+                    sqlalchemy.bindparam("emails", expanding=True),
+                ),
+                {
+                    "user_id": user_id,
+                    "keys": list({row["company_key"] for row in rows if row["company_key"]}),
+                    "emails": list({normalize_email(row["email"]) for row in rows if normalize_email(row["email"])}),
+                },
+            ).fetchall()
+            seen_keys = {key for key, _ in existing if key}
+            seen_emails = {email for _, email in existing if email}
+
+        new_rows, skipped = [], []
+        for index, row in enumerate(rows):
+            email = normalize_email(row["email"])
+            if not payload.allow_duplicates and (row["company_key"] in seen_keys or email in seen_emails):
+                skipped.append({"index": index, "company_name": row["company_name"]})
+                continue
+            if row["company_key"]:
+                seen_keys.add(row["company_key"])
+            if email:
+                seen_emails.add(email)
+            new_rows.append(row)
+
+        new_ids = []
+        if new_rows:
+            new_ids = conn.execute(sqlalchemy.insert(leads_table).values(updated_at=sqlalchemy.func.current_timestamp()).returning(leads_table.c.id, sort_by_parameter_order=True), new_rows).scalars().all()
+            record_activity(conn, user_id, ActivityEvent.LEAD_IMPORT, after={"imported": len(new_rows), "skipped": len(skipped)})
+
+    if new_ids:
+        await asyncio.to_thread(refresh_lead_priorities, new_ids)
+        on_lead_mutation(user_id)
+        for lead_id, row in zip(new_ids, new_rows):
+            reminders.lead_changed(lead_id, user_id, row["action_date"])
+        enrichment_wakeup.set()
+
+    return {"ok": True, "imported": len(new_ids), "ids": new_ids, "skipped": skipped}
+
+# Turn lead rows into JSON
+def lead_rows_to_json(lead_rows):
+    return [
         {
             "id": r[0],
             "im": r[1],
@@ -402,18 +2154,501 @@ async def get_leads(request: Request):
             "task": r[5],
             "action_date": r[6],
             "stage": r[7],
-
+            "version": r[8],
         }
         for r in lead_rows
     ]
+
+# Leads whose task isn't done, the task_status test is written the same way as the leads_open_tasks_idx predicate so the index is used
+OPEN_LEADS_SQL = """
+    SELECT id, im, company_name, agent_name, email, task, action_date, stage, version
+    FROM leads
+    WHERE user_id = :user_id
+    AND (task_status IS NULL OR task_status <> 'done')
+    ORDER BY id DESC
+"""
+
+# Open leads in priority order, read straight from leads_open_priority_idx without sorting
+TOP_LEADS_SQL = """
+    SELECT id, im, company_name, agent_name, email, task, action_date, stage, version
+    FROM leads
+    WHERE user_id = :user_id
+    AND (task_status IS NULL OR task_status <> 'done')
+    ORDER BY priority_score DESC, id DESC
+    LIMIT :limit
+"""
+TOP_LEADS_LIMIT = 20
+
+# Lead priority
+# Scores run from 0 to 100, higher means work on it sooner. They are stored on the lead and recomputed for the leads a
+# change touches, and for all of a user's leads once a day since they depend on how far away the action date is
+STAGE_PRIORITY = {"new": 0.6, "contacted": 0.8, "in_progress": 1.0, "Won": 0.0, "Lost": 0.0}
+DEFAULT_STAGE_PRIORITY = 0.6
+
+# Share of the score from the action date, recent activity and the enrichment model's priority
+PRIORITY_WEIGHTS = (0.55, 0.2, 0.25)
+
+# Activity on a lead counts towards its score for this long
+PRIORITY_ACTIVITY_WINDOW = timedelta(days=14)
+
+PRIORITY_SQL = "SELECT id, user_id, stage, action_date, task_status, ai_priority FROM leads"
+
+# Score many leads at once, every argument is an array with one entry per lead
+# days is the action date minus today, ai_priority is NaN where the lead hasn't been enriched
+def score_priorities(stages: np.ndarray, days: np.ndarray, done: np.ndarray, activity: np.ndarray, ai_priority: np.ndarray) -> np.ndarray:
+    # Look each distinct stage up once rather than once per lead
+    stage_names, stage_index = np.unique(stages, return_inverse=True)
+    stage_weight = np.array([STAGE_PRIORITY.get(name, DEFAULT_STAGE_PRIORITY) for name in stage_names])[stage_index]
+
+    # 1 when due today, rising to 1.5 two weeks overdue and falling away for dates further ahead, scaled to 0-1
+    urgency = np.where(days <= 0, 1 + np.minimum(-days, 14) / 28, np.exp(-np.maximum(days, 0) / 7)) / 1.5
+    engagement = 1 - np.exp(-activity / 3)
+    model = np.nan_to_num(ai_priority / 100, nan=0.5)
+
+    date_weight, activity_weight, model_weight = PRIORITY_WEIGHTS
+    scores = 100 * stage_weight * (date_weight * urgency + activity_weight * engagement + model_weight * model)
+    return np.round(np.where(done, 0, scores), 2)
+
+# Activity documents per lead in the window, leads without any are left out
+# Scores are only a guide, so they go without activity counts rather than fail when MongoDB can't be reached
+def recent_activity_counts(user_ids: list, lead_ids: list) -> dict:
+    try:
+        return {
+            row["_id"]: row["n"]
+            for row in activity_log.aggregate([
+                {"$match": {
+                    "u": {"$in": user_ids},
+                    "l": {"$in": lead_ids},
+                    "t": {"$gte": datetime.now(timezone.utc) - PRIORITY_ACTIVITY_WINDOW},
+                }},
+                {"$group": {"_id": "$l", "n": {"$sum": 1}}},
+            ])
+        }
+    except pymongo.errors.PyMongoError as e:
+        print(f"Could not count activity for priorities: {e}")
+        return {}
+
+# Recompute and store scores for all of a user's leads, or only the ones listed
+def rescore_leads(conn, user_id: Optional[int] = None, lead_ids: Optional[list] = None) -> int:
+    if lead_ids is None:
+        query, params = sqlalchemy.text(PRIORITY_SQL + " WHERE user_id = :user_id"), {"user_id": user_id}
+    else:
+        query = sqlalchemy.text(PRIORITY_SQL + " WHERE id IN :lead_ids").bindparams(sqlalchemy.bindparam("lead_ids", expanding=True))
+        params = {"lead_ids": lead_ids}
+    rows = conn.execute(query, params).fetchall()
+    if not rows:
+        return 0
+
+    ids = [row[0] for row in rows]
+    counts = recent_activity_counts(list({row[1] for row in rows}), ids)
+
+    action_dates = np.array([row[3] for row in rows], dtype="datetime64[D]")
+    days = (action_dates - np.datetime64(date.today(), "D")).astype(float)
+    scores = score_priorities(
+        stages=np.array([row[2] or "" for row in rows]),
+        days=np.where(np.isnat(action_dates), 0, days),
+        done=np.array([row[4] == "done" for row in rows]),
+        activity=np.array([counts.get(lead_id, 0) for lead_id in ids], dtype=float),
+        ai_priority=np.array([np.nan if row[5] is None else row[5] for row in rows], dtype=float),
+    )
+
+    conn.execute(
+        sqlalchemy.text("UPDATE leads SET priority_score = :score WHERE id = :id"),
+        [{"id": lead_id, "score": float(score)} for lead_id, score in zip(ids, scores)],
+    )
+    return len(rows)
+
+# Rescore leads after a change to them has committed
+def refresh_lead_priorities(lead_ids: list):
+    if lead_ids:
+        with database.begin() as conn:
+            rescore_leads(conn, lead_ids=lead_ids)
+
+# Rescore all of a user's leads if that hasn't been done today, returns whether it was done now
+# Claiming the day in users first means only one worker does it
+# The day is checked with a read first (on the replica when the user's reads go there), so reads only write to the
+# primary once a day even when there is no shared cache to remember it in
+def ensure_fresh_priorities(user_id: int, request: Optional[Request] = None) -> bool:
+    today = date.today()
+    if cache.get(f"priorities:{user_id}:{today}"):
+        return False
+
+    with reader_for(request, user_id).connect() as conn:
+        scored_on = conn.execute(
+            sqlalchemy.text("SELECT priorities_scored_on FROM users WHERE id = :user_id"),
+            {"user_id": user_id},
+        ).scalar()
+    if scored_on is not None and scored_on >= today:
+        cache.set(f"priorities:{user_id}:{today}", True, LEAD_CACHE_SECONDS * 24)
+        return False
+
+    with database.begin() as conn:
+        claimed = conn.execute(
+            sqlalchemy.text("""
+                UPDATE users SET priorities_scored_on = :today
+                WHERE id = :user_id AND (priorities_scored_on IS NULL OR priorities_scored_on < :today)
+                RETURNING id
+            """),
+            {"user_id": user_id, "today": today},
+        ).fetchone()
+        if claimed:
+            rescore_leads(conn, user_id=user_id)
+
+    cache.set(f"priorities:{user_id}:{today}", True, LEAD_CACHE_SECONDS * 24)
+    return claimed is not None
+
+# Get a user's leads, every lead for leads.js, the open ones, or the open ones most worth working on first
+def fetch_leads(connector, user_id: int, source: Optional[str] = None, limit: int = TOP_LEADS_LIMIT):
+    match source:
+        case "leadpage":
+            lead_rows = connector.execute(
+            sqlalchemy.text("""
+                            SELECT id, im, company_name, agent_name, email, task, action_date, stage, version
+                            FROM leads 
+                            WHERE user_id = :user_id
+                            ORDER BY id DESC
+                        """),
+                        {"user_id": user_id},
+                    ).fetchall()
+        case "top":
+            lead_rows = connector.execute(
+                sqlalchemy.text(TOP_LEADS_SQL),
+                {"user_id": user_id, "limit": limit},
+            ).fetchall()
+        case _:
+            lead_rows = connector.execute(
+                sqlalchemy.text(OPEN_LEADS_SQL),
+                {"user_id": user_id},
+            ).fetchall()
+
+    return lead_rows_to_json(lead_rows)
+
+# Get leads on a connection of their own
+def load_leads(engine, user_id: int, source: Optional[str] = None, limit: int = TOP_LEADS_LIMIT):
+    with engine.connect() as conn:
+        return fetch_leads(conn, user_id, source, limit)
+
+# Today's top leads, bringing the user's scores up to date first
+# Reads the primary when that just happened, the replica may not have the new scores yet
+def load_top_leads(request: Optional[Request], user_id: int, limit: int):
+    engine = database if ensure_fresh_priorities(user_id, request) else reader_for(request, user_id)
+    return load_leads(engine, user_id, "top", limit)
+
+# Get leads to show on dashboard
+@app.get("/api/getleads")
+async def get_leads(request: Request, limit: int = Query(TOP_LEADS_LIMIT, ge=1, le=TOP_LEADS_LIMIT)):
+    source = request.query_params.get("source")
+    
+    # Check if logged in
+    user_id = require_user_id(request)
+    
+    # Check if api request is from leads.js or dashboard.js, ?source=top&limit=n is the n open leads with the highest priority
+    source = source if source in ("leadpage", "top") else "dashboard"
+
+    # The browser revalidates with If-None-Match and gets a 304 while the user's leads haven't changed
+    # Priorities also change with the date
+    generation = lead_generation(user_id)
+    headers = {"Cache-Control": "private, no-cache"}
+    if generation is not None:
+        headers["ETag"] = f'W/"{generation}-{source}-{limit}-{date.today()}"' if source == "top" else f'W/"{generation}-{source}"'
+        if headers["ETag"] in request.headers.get("if-none-match", ""):
+            return Response(status_code=304, headers=headers)
+
+    # Identical requests from the same user that arrive together share one query
+    if source == "top":
+        leads = await coalesce(("leads", user_id, source, limit), load_top_leads, request, user_id, limit)
+    else:
+        engine = reader_for(request, user_id)
+        leads = await coalesce(("leads", user_id, source, engine is database), load_leads, engine, user_id, source)
         
-    return {"ok": True, "leads": leads}
+    return JSONResponse(jsonable_encoder({"ok": True, "leads": leads}), headers=headers)
+
+
+
+# Columns written by the lead export, in order
+EXPORT_COLUMNS = ["id", "im", "company_name", "agent_name", "email", "task", "action_date", "stage", "task_status"]
+
+# Rows fetched from the server-side cursor at a time, memory use depends on this and not on how many leads there are
+EXPORT_BATCH_ROWS = 1000
+
+XLSX_MEDIA_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+# Stream a user's leads in batches, the database keeps the cursor so the rows never all sit in memory at once
+def iter_export_batches(engine, user_id: int):
+    with engine.connect() as conn:
+        result = conn.execution_options(stream_results=True, yield_per=EXPORT_BATCH_ROWS).execute(
+            sqlalchemy.text("""
+                SELECT id, im, company_name, agent_name, email, task, action_date, stage, task_status
+                FROM leads
+                WHERE user_id = :user_id
+                ORDER BY id
+            """),
+            {"user_id": user_id},
+        )
+        for batch in result.partitions():
+            yield batch
+
+# Spreadsheets run cells starting with these as formulas, so they are written as text
+def csv_cell(value):
+    if isinstance(value, str) and value[:1] in ("=", "+", "-", "@", "\t", "\r"):
+        return "'" + value
+    return value
+
+def export_csv(batches):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    # The BOM tells Excel the file is UTF-8
+    writer.writerow(EXPORT_COLUMNS)
+    yield ("\ufeff" + buffer.getvalue()).encode("utf-8")
+
+    for batch in batches:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows([csv_cell(value) for value in row] for row in batch)
+        yield buffer.getvalue().encode("utf-8")
+
+def export_jsonl(batches):
+    for batch in batches:
+        yield "".join(json.dumps(dict(zip(EXPORT_COLUMNS, row)), default=str) + "\n" for row in batch).encode("utf-8")
+
+# Collects what zipfile writes until the response takes it, zipfile doesn't need to seek so the workbook streams out
+class ExportBuffer:
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+# The smallest set of parts Excel needs to open a workbook with one sheet
+XLSX_PARTS = {
+    "[Content_Types].xml": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '</Types>'
+    ),
+    "_rels/.rels": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+        '</Relationships>'
+    ),
+    "xl/workbook.xml": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        '<sheets><sheet name="Leads" sheetId="1" r:id="rId1"/></sheets>'
+        '</workbook>'
+    ),
+    "xl/_rels/workbook.xml.rels": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>'
+        '</Relationships>'
+    ),
+}
+
+# Characters XML 1.0 doesn't allow, even escaped
+XML_INVALID_CHARS = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+# One sheet row, numbers as numbers and everything else as inline text so no shared string table is needed
+def xlsx_row(values) -> str:
+    cells = []
+    for value in values:
+        if value is None:
+            cells.append("<c/>")
+        elif isinstance(value, int):
+            cells.append(f"<c><v>{value}</v></c>")
+        else:
+            text = xml_escape(XML_INVALID_CHARS.sub("", str(value)))
+            cells.append(f'<c t="inlineStr"><is><t xml:space="preserve">{text}</t></is></c>')
+    return "<row>" + "".join(cells) + "</row>"
+
+def export_xlsx(batches):
+    buffer = ExportBuffer()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as workbook:
+        for name, xml in XLSX_PARTS.items():
+            workbook.writestr(name, xml)
+
+        with workbook.open("xl/worksheets/sheet1.xml", "w", force_zip64=True) as sheet:
+            sheet.write((
+                '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>'
+                + xlsx_row(EXPORT_COLUMNS)
+            ).encode("utf-8"))
+            yield buffer.drain()
+
+            for batch in batches:
+                sheet.write("".join(xlsx_row(row) for row in batch).encode("utf-8"))
+                yield buffer.drain()
+
+            sheet.write(b"</sheetData></worksheet>")
+
+    # Closing the zip writes its central directory
+    yield buffer.drain()
+
+# Compress as the chunks go past instead of building the whole file first
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+# format -> (writer, media type)
+EXPORT_FORMATS = {
+    "csv": (export_csv, "text/csv; charset=utf-8"),
+    "jsonl": (export_jsonl, "application/x-ndjson"),
+    "xlsx": (export_xlsx, XLSX_MEDIA_TYPE),
+}
+
+# Download every lead as csv, jsonl or xlsx, ?gzip=1 sends a .gz of the csv or jsonl
+@app.get("/api/leads/export")
+async def exportLeads(request: Request, export_format: str = Query("csv", alias="format"), compress: bool = Query(False, alias="gzip")):
+    user_id = require_user_id(request)
+    if export_format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail="format must be csv, jsonl or xlsx")
+    enforce_rate_limit(request, "export", user_id)
+    writer, media_type = EXPORT_FORMATS[export_format]
+
+    chunks = writer(iter_export_batches(reader_for(request, user_id), user_id))
+    file_name = f"leads-{date.today()}.{export_format}"
+
+    # xlsx is already a zip, compressing it again gains nothing
+    if compress and export_format != "xlsx":
+        chunks = gzip_chunks(chunks)
+        media_type = "application/gzip"
+        file_name += ".gz"
+
+    return StreamingResponse(
+        chunks,
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{file_name}"'},
+    )
+
+# Changes are looked for this far before the client's watermark, so a write whose transaction started before the
+# last sync but committed after it is still picked up. Clients apply rows by id so seeing one twice is harmless
+SYNC_OVERLAP = timedelta(seconds=30)
+
+# Tombstones are kept this long, a client that hasn't synced for longer gets every lead again
+LEAD_TOMBSTONE_RETENTION = timedelta(days=30)
+
+# Same columns as the lead list plus task_status, so the client can work out today's tasks itself, and the enrichment
+SYNC_LEADS_SQL = """
+    SELECT id, im, company_name, agent_name, email, task, action_date, stage, version, task_status,
+           suggested_task, sector, ai_priority
+    FROM leads
+    WHERE user_id = :user_id
+"""
+
+def prune_lead_tombstones():
+    with database.begin() as conn:
+        conn.execute(
+            sqlalchemy.text("DELETE FROM lead_tombstones WHERE deleted_at < :cutoff"),
+            {"cutoff": datetime.now(timezone.utc) - LEAD_TOMBSTONE_RETENTION},
+        )
+
+# The watermark is "user_id:timestamp" so a cache left behind by another user on the same browser is never patched
+def parse_sync_watermark(watermark: Optional[str], user_id: int) -> Optional[datetime]:
+    owner, _, stamp = (watermark or "").partition(":")
+    if owner != str(user_id):
+        return None
+    try:
+        since = datetime.fromisoformat(stamp)
+    except ValueError:
+        return None
+    # Watermarks handed out always carry an offset, anything else is treated like a missing one
+    return since if since.tzinfo else None
+
+# Leads changed and deleted since the watermark, or every lead when the client has to start again
+# Reads the primary, replica lag could otherwise hide a change from a client that has already moved its watermark past it
+def fetch_lead_changes(user_id: int, since: Optional[datetime]) -> dict:
+    with database.begin() as conn:
+        # The database clock, the same one that stamps updated_at
+        now = utc_timestamp(conn.execute(sqlalchemy.text("SELECT CURRENT_TIMESTAMP")).scalar())
+        full = since is None or since < now - LEAD_TOMBSTONE_RETENTION
+        changed_since = None if full else since - SYNC_OVERLAP
+
+        if full:
+            rows = conn.execute(sqlalchemy.text(SYNC_LEADS_SQL), {"user_id": user_id}).fetchall()
+        else:
+            rows = conn.execute(
+                sqlalchemy.text(SYNC_LEADS_SQL + " AND updated_at > :since"),
+                {"user_id": user_id, "since": changed_since},
+            ).fetchall()
+        deleted = [] if full else conn.execute(
+            sqlalchemy.text("SELECT lead_id FROM lead_tombstones WHERE user_id = :user_id AND deleted_at > :since"),
+            {"user_id": user_id, "since": changed_since},
+        ).scalars().all()
+
+    return {
+        "full": full,
+        "watermark": f"{user_id}:{now.isoformat()}",
+        "leads": [
+            {**lead, "task_status": row[9], "suggested_task": row[10], "sector": row[11], "ai_priority": row[12]}
+            for lead, row in zip(lead_rows_to_json(rows), rows)
+        ],
+        "deleted": deleted,
+    }
+
+# Delta sync for the browser's lead cache, ?since is the watermark from the previous response
+@app.get("/api/leads/sync")
+async def syncLeads(request: Request, since: Optional[str] = None):
+    user_id = require_user_id(request)
+    changes = await asyncio.to_thread(fetch_lead_changes, user_id, parse_sync_watermark(since, user_id))
+    return {"ok": True, **changes}
+
+# Answer an edit whose version check matched no row: 404 if the lead does not exist, otherwise 409 with the lead as it is now
+def lead_conflict_response(conn, lead_id: int, user_id: int):
+    current = conn.execute(
+        sqlalchemy.text("""
+            SELECT id, im, company_name, agent_name, email, task, action_date, stage, version
+            FROM leads WHERE id = :lead_id AND user_id = :user_id
+                        """),
+        {"lead_id": lead_id, "user_id": user_id},
+    ).fetchall()
+
+    if not current:
+        raise HTTPException(status_code=404, detail="Lead not found")
+
+    return JSONResponse(
+        jsonable_encoder({"ok": False, "error": "Lead was changed by someone else", "lead": lead_rows_to_json(current)[0]}),
+        status_code=409,
+    )
 
 
+# Read the value an edit is about to replace and the version the update has to match
+# SQLite's RETURNING only sees the new row, so the before value is read up front on every engine
+# Returns None when the lead is missing or the client's version is already stale
+def read_lead_before_edit(conn, lead_id: int, user_id: int, column: str, version: Optional[int]):
+    row = conn.execute(
+        sqlalchemy.text(f"SELECT company_name, {column}, version FROM leads WHERE id = :lead_id AND user_id = :user_id"),
+        {"lead_id": lead_id, "user_id": user_id},
+    ).fetchone()
+    if not row or (version is not None and row[2] != version):
+        return None
+    return row
+
 
 # Update task, use pydantic basemodel to type check task is string
 class TaskUpdate(BaseModel):
     task: str
+    # Version of the lead the client last saw, leave out to overwrite whatever is there
+    version: Optional[int] = None
 
 @app.patch("/api/leads/{lead_id}/task")
 async def updateLeadTask(lead_id: int, payload: TaskUpdate, request: Request):
@@ -433,54 +2668,40 @@ async def updateLeadTask(lead_id: int, payload: TaskUpdate, request: Request):
         
         user_id = row[0]
         
-        # Get task before change
-        original_task = conn.execute(
-            sqlalchemy.text("""
-                SELECT task FROM leads WHERE id = :lead_id AND user_id = :user_id
-                            """),
-            {"lead_id": lead_id, "user_id": user_id},
-        ).fetchone()
-        
-        # only allow updating your own lead
-        updated = conn.execute(
+        # only allow updating your own lead, and only if nobody changed it since the client read it
+        original = read_lead_before_edit(conn, lead_id, user_id, "task", payload.version)
+        if not original:
+            return lead_conflict_response(conn, lead_id, user_id)
+        company_name, original_task, seen_version = original
+
+        # The version guard makes sure the task being replaced is still the one read above
+        new_version = conn.execute(
             sqlalchemy.text("""
               UPDATE leads
-              SET task = :task
-              WHERE id = :lead_id AND user_id = :user_id
+              SET task = :task, version = version + 1, updated_at = CURRENT_TIMESTAMP, enriched_at = NULL
+              WHERE id = :lead_id AND user_id = :user_id AND version = :version
+              RETURNING version
             """),
-            {"task": payload.task, "lead_id": lead_id, "user_id": user_id},
-        ).rowcount
-        
-        # Get company name and task
-        company_info = conn.execute(
-            sqlalchemy.text("""
-                SELECT company_name, task 
-                FROM leads
-                WHERE id = :lead_id AND user_id = :user_id
-                            """),
-            {"lead_id": lead_id, "user_id": user_id}
-        ).fetchone()
+            {"task": payload.task, "lead_id": lead_id, "user_id": user_id, "version": seen_version},
+        ).scalar()
+
+        if new_version is None:
+            return lead_conflict_response(conn, lead_id, user_id)
         
         # Update task and audit for mongodb
-        update_lead_activity = {
-            'user_id': user_id,
-            'timestamp': datetime.now(timezone.utc),
-            'time': (datetime.now(timezone.utc).strftime('%X')),
-            'date': (datetime.now(timezone.utc).strftime('%x')),
-            'details': f'User updated lead {company_info[0]} task from {original_task[0]} to {company_info[1]}'
-        }
-        
-        activity_log.insert_one(update_lead_activity)
+        record_activity(conn, user_id, ActivityEvent.LEAD_TASK, lead_id=lead_id, company=company_name, before=original_task, after=payload.task)
 
-        if updated == 0:
-            raise HTTPException(status_code=404, detail="Lead not found")
+    await asyncio.to_thread(refresh_lead_priorities, [lead_id])
+    on_lead_mutation(user_id)
 
-    return {"ok": True}
+    return {"ok": True, "version": new_version}
 
 
 # Update Stage and use pydantic basemodel to ensure stage is string
 class StageUpdate(BaseModel):
     stage: str
+    # Version of the lead the client last saw, leave out to overwrite whatever is there
+    version: Optional[int] = None
 
 @app.patch("/api/leads/{lead_id}/stage")
 async def updateLeadStage(lead_id: int, payload: StageUpdate, request: Request):
@@ -500,48 +2721,32 @@ async def updateLeadStage(lead_id: int, payload: StageUpdate, request: Request):
             raise HTTPException(status_code=401, detail="Invalid session")
         user_id = row[0]
         
-        # Get original stage
-        original_task = conn.execute(
-            sqlalchemy.text("""
-                SELECT stage FROM leads WHERE id = :lead_id AND user_id = :user_id
-                            """),
-            {"lead_id": lead_id, "user_id": user_id},
-        ).scalar()
+        # Read the original stage, then update it in sql according to lead and user id if the version still matches
+        original = read_lead_before_edit(conn, lead_id, user_id, "stage", payload.version)
+        if not original:
+            return lead_conflict_response(conn, lead_id, user_id)
+        company_name, original_stage, seen_version = original
 
-        # Update stage in sql according to lead and user id
-        updated = conn.execute(
+        new_version = conn.execute(
             sqlalchemy.text("""
               UPDATE leads
-              SET stage = :stage
-              WHERE id = :lead_id AND user_id = :user_id
+              SET stage = :stage, version = version + 1, updated_at = CURRENT_TIMESTAMP, enriched_at = NULL
+              WHERE id = :lead_id AND user_id = :user_id AND version = :version
+              RETURNING version
             """),
-            {"stage": payload.stage, "lead_id": lead_id, "user_id": user_id},
-        ).rowcount
-        
-        # Get lead stage and company name
-        company_info = conn.execute(
-            sqlalchemy.text("""
-                SELECT company_name, stage FROM leads WHERE id = :lead_id AND user_id = :user_id
-                            """),
-            {"lead_id": lead_id, "user_id": user_id},
-        ).fetchone()
-        
+            {"stage": payload.stage, "lead_id": lead_id, "user_id": user_id, "version": seen_version},
+        ).scalar()
+
+        if new_version is None:
+            return lead_conflict_response(conn, lead_id, user_id)
         
         # Update no sql lead stage
-        update_lead_activity = {
-            'user_id': user_id,
-            'timestamp': datetime.now(timezone.utc),
-            'time': (datetime.now(timezone.utc).strftime('%X')),
-            'date': (datetime.now(timezone.utc).strftime('%x')),
-            'details': f'User updated lead {company_info[0]} stage from {original_task} to {company_info[1]}'
-        }
-        
-        activity_log.insert_one(update_lead_activity)
+        record_activity(conn, user_id, ActivityEvent.LEAD_STAGE, lead_id=lead_id, company=company_name, before=original_stage, after=payload.stage)
 
-        if updated == 0:
-            raise HTTPException(status_code=404, detail="Lead not found")
+    await asyncio.to_thread(refresh_lead_priorities, [lead_id])
+    on_lead_mutation(user_id)
 
-    return {"ok": True}
+    return {"ok": True, "version": new_version}
 
 # Pydantic class to get metrics and make sure response is ok for simpler success message
 class MetricResponse(BaseModel):
@@ -550,62 +2755,296 @@ class MetricResponse(BaseModel):
     tasks_due_count:int
     tasks_open: int
 
+# Overdue, due today and open counts for leads that are neither won nor lost, in one pass over leads_active_stage_idx
+LEAD_METRICS_SQL = """
+    SELECT
+        COUNT(*) FILTER (WHERE action_date <= CURRENT_DATE),
+        COUNT(*) FILTER (WHERE action_date = CURRENT_DATE),
+        COUNT(*)
+    FROM leads
+    WHERE user_id = :user_id
+    AND stage NOT IN ('Lost', 'Won')
+"""
+
+def fetch_lead_metrics(conn, user_id: int) -> dict:
+    tasks_overdue_count, tasks_due_count, tasks_open = conn.execute(
+        sqlalchemy.text(LEAD_METRICS_SQL),
+        {"user_id": user_id},
+    ).fetchone()
+    
+    return {"tasks_status": tasks_overdue_count, "tasks_due_count": tasks_due_count, "tasks_open": tasks_open}
+
+# Count lead metrics on a connection of their own
+def load_lead_metrics(engine, user_id: int) -> dict:
+    with engine.connect() as conn:
+        return fetch_lead_metrics(conn, user_id)
+
+# Metrics are cached until the user's leads change, the date is in the key because they count against today
+async def cached_lead_metrics(request: Request, user_id: int) -> dict:
+    generation = lead_generation(user_id)
+    cache_key = f"metrics:{user_id}:{generation}:{date.today()}"
+    if generation is not None:
+        metrics = cache.get(cache_key)
+        if metrics is not None:
+            return metrics
+
+    # Identical requests from the same user that arrive together share one query
+    engine = reader_for(request, user_id)
+    metrics = await coalesce(("metrics", user_id, engine is database), load_lead_metrics, engine, user_id)
+    if generation is not None:
+        cache.set(cache_key, metrics, LEAD_CACHE_SECONDS)
+    return metrics
+
 # Get leads
 @app.get('/api/leads/metrics')
 async def getLeadMetrics(request: Request):
     # Check if logged in
-    session_id = request.cookies.get("id")
-    if not session_id:
-        raise HTTPException(status_code=401, detail="Not logged in")
-    
-    with database.begin() as conn:
-        # Authenticate
-        auth = conn.execute(
-            sqlalchemy.text("SELECT user_id FROM sessions WHERE id = :id"),
-            {"id": session_id},
-        ).fetchone()
-        
-        if not auth:
-            raise HTTPException(status_code=401, detail="Invalid session")
-        
-        user_id = auth[0]
-        
-        # Get tasks that are over due and not lost/won
-        tasks_overdue_count = conn.execute(
-            sqlalchemy.text("""
-                SELECT COUNT(*) FROM leads
-                WHERE user_id = :user_id
-                AND stage != 'Lost'
-                AND stage != 'Won'
-                AND action_date <= CURRENT_DATE
-                """),
-            {"user_id": user_id}
-        ).scalar()
-        
-        # Get tasks that are due today and not lost/won
-        tasks_due_count = conn.execute(
-            sqlalchemy.text("""
-                SELECT COUNT(*) FROM leads
-                WHERE user_id = :user_id
-                AND stage != 'Lost'
-                AND stage != 'Won'
-                AND action_date = CURRENT_DATE
-                """),
-            {'user_id': user_id}
-        ).scalar()
-        
-        # Get tasks that are open not lost/won
-        tasks_open = conn.execute(
-            sqlalchemy.text("""
-                SELECT COUNT(*) FROM leads
-                WHERE user_id = :user_id
-                AND stage != 'Lost'
-                AND stage != 'Won'
-            """),
-            {'user_id': user_id}
-        ).scalar()   
-        
-    return MetricResponse(ok=True, tasks_status=tasks_overdue_count, tasks_due_count=tasks_due_count, tasks_open=tasks_open)
+    user_id = require_user_id(request)
+    metrics = await cached_lead_metrics(request, user_id)
+    return MetricResponse(ok=True, **metrics)
+
+
+# Calendar of upcoming actions, a window of days with each day's lead count and its highest priority leads
+# Won and lost leads have no actions left, so the query is a range scan of leads_active_stage_idx on (user_id, action_date)
+CALENDAR_MAX_DAYS = 42
+CALENDAR_DAY_LEADS = 10
+
+# The day counts come from window functions over the same rows as the leads, one statement sees one snapshot,
+# so a lead added or moved while the month loads can't end up listed under a day that has no count
+CALENDAR_SQL = """
+    SELECT id, im, company_name, agent_name, email, task, task_status, stage, action_date, version, day_count, day_done
+    FROM (
+        SELECT id, im, company_name, agent_name, email, task, task_status, stage, action_date, version,
+               ROW_NUMBER() OVER (PARTITION BY action_date ORDER BY priority_score DESC, id DESC) AS day_rank,
+               COUNT(*) OVER (PARTITION BY action_date) AS day_count,
+               COUNT(*) FILTER (WHERE task_status = 'done') OVER (PARTITION BY action_date) AS day_done
+        FROM leads
+        WHERE user_id = :user_id
+        AND stage NOT IN ('Lost', 'Won')
+        AND action_date >= :start AND action_date < :end
+    ) ranked
+    WHERE day_rank <= :per_day
+    ORDER BY action_date, day_rank
+"""
+
+# First day of the month after month
+def next_month(month: date) -> date:
+    return (month.replace(day=28) + timedelta(days=4)).replace(day=1)
+
+# One month of the calendar keyed by ISO date, days without leads are left out
+def load_calendar_month(engine, user_id: int, month: date) -> dict:
+    params = {"user_id": user_id, "start": month, "end": next_month(month), "per_day": CALENDAR_DAY_LEADS}
+    days = {}
+    with engine.connect() as conn:
+        for row in conn.execute(sqlalchemy.text(CALENDAR_SQL), params).mappings():
+            lead = dict(row)
+            count, done = lead.pop("day_count"), lead.pop("day_done")
+            day = days.setdefault(str(lead["action_date"]), {"count": count, "done": done, "leads": []})
+            day["leads"].append(jsonable_encoder(lead))
+    return days
+
+# Months are cached until the user's leads change, rescheduling or completing a lead moves it to another day
+# and on_lead_mutation starts a new generation for those like for every other change
+async def cached_calendar_month(request: Request, user_id: int, month: date) -> dict:
+    generation = lead_generation(user_id)
+    cache_key = f"calendar:{user_id}:{generation}:{month:%Y-%m}"
+    if generation is not None:
+        days = cache.get(cache_key)
+        if days is not None:
+            return days
+
+    engine = reader_for(request, user_id)
+    days = await coalesce(("calendar", user_id, month, engine is database), load_calendar_month, engine, user_id, month)
+    if generation is not None:
+        cache.set(cache_key, days, LEAD_CACHE_SECONDS)
+    return days
+
+# Days from start (today by default), built from the cached months the window covers
+@app.get('/api/leads/calendar')
+async def getLeadCalendar(request: Request, start: Optional[date] = None, days: int = Query(7, ge=1, le=CALENDAR_MAX_DAYS)):
+    user_id = require_user_id(request)
+    start = start or date.today()
+    end = start + timedelta(days=days)
+
+    months = []
+    month = start.replace(day=1)
+    while month < end:
+        months.append(month)
+        month = next_month(month)
+
+    by_day = {}
+    for month_days in await asyncio.gather(*(cached_calendar_month(request, user_id, month) for month in months)):
+        by_day.update(month_days)
+
+    # Empty days are included so the client can lay the window out as a grid
+    calendar = []
+    for offset in range(days):
+        day = (start + timedelta(days=offset)).isoformat()
+        calendar.append({"date": day, **by_day.get(day, {"count": 0, "done": 0, "leads": []})})
+
+    return {"ok": True, "start": start, "end": end, "days": calendar}
+
+
+# Team views
+# Managers see the reps listed for them in team_members, admins see every user
+MANAGER_ROLES = ("manager", "admin")
+
+# Team views cover other users' leads, whose changes don't reach the manager's cache keys, so they only live briefly
+TEAM_CACHE_SECONDS = int(os.getenv("TEAM_CACHE_SECONDS", "60"))
+TEAM_LEADS_LIMIT = 500
+
+# The users a manager can see, shared by every team query so each one is a single statement for the whole team
+TEAM_MEMBERS_SQL = """
+    WITH members AS (
+        SELECT member_id AS user_id FROM team_members WHERE manager_id = :manager_id AND :role = 'manager'
+        UNION
+        SELECT id FROM users WHERE :role = 'admin'
+    )
+"""
+
+# Same counts as LEAD_METRICS_SQL for every rep at once, reps without open leads still get a row
+TEAM_METRICS_SQL = TEAM_MEMBERS_SQL + """
+    SELECT
+        users.id,
+        users.username,
+        COUNT(leads.id) FILTER (WHERE leads.action_date <= CURRENT_DATE),
+        COUNT(leads.id) FILTER (WHERE leads.action_date = CURRENT_DATE),
+        COUNT(leads.id)
+    FROM members
+    JOIN users ON users.id = members.user_id
+    LEFT JOIN leads ON leads.user_id = members.user_id AND leads.stage NOT IN ('Lost', 'Won')
+    GROUP BY users.id, users.username
+    ORDER BY users.username
+"""
+
+# Leads per rep and stage, counted from leads_user_stage_idx
+TEAM_PIPELINE_SQL = TEAM_MEMBERS_SQL + """
+    SELECT leads.user_id, leads.stage, COUNT(*)
+    FROM members
+    JOIN leads ON leads.user_id = members.user_id
+    GROUP BY leads.user_id, leads.stage
+"""
+
+TEAM_LEADS_SQL = TEAM_MEMBERS_SQL + """
+    SELECT leads.id, leads.im, leads.company_name, leads.agent_name, leads.email, leads.task, leads.action_date,
+           leads.stage, leads.version, users.id, users.username
+    FROM members
+    JOIN leads ON leads.user_id = members.user_id
+    JOIN users ON users.id = leads.user_id
+"""
+
+# A user's role, cached for as long as their session is
+def user_role(user_id: int) -> str:
+    role = cache.get(f"role:{user_id}")
+    if role is None:
+        with database.connect() as conn:
+            role = conn.execute(
+                sqlalchemy.text("SELECT role FROM users WHERE id = :user_id"),
+                {"user_id": user_id},
+            ).scalar()
+        cache.set(f"role:{user_id}", role, SESSION_CACHE_SECONDS)
+    return role
+
+# Check the user may see team views, returns their id and role
+def require_manager(request: Request) -> tuple:
+    user_id = require_user_id(request)
+    role = user_role(user_id)
+    if role not in MANAGER_ROLES:
+        raise HTTPException(status_code=403, detail="Managers only")
+    return user_id, role
+
+# Check the user is an admin, for views that show more than their own data
+def require_admin(request: Request) -> int:
+    user_id = require_user_id(request)
+    if user_role(user_id) != "admin":
+        raise HTTPException(status_code=403, detail="Admins only")
+    return user_id
+
+# Open lead counts and pipeline by stage for every rep on the team, two grouped queries however big the team is
+def load_team_metrics(engine, manager_id: int, role: str) -> dict:
+    params = {"manager_id": manager_id, "role": role}
+    with engine.connect() as conn:
+        metric_rows = conn.execute(sqlalchemy.text(TEAM_METRICS_SQL), params).fetchall()
+        pipeline_rows = conn.execute(sqlalchemy.text(TEAM_PIPELINE_SQL), params).fetchall()
+
+    stages = {}
+    for user_id, stage, count in pipeline_rows:
+        stages.setdefault(user_id, {})[stage] = count
+
+    members = [
+        {
+            "user_id": user_id,
+            "username": username,
+            "tasks_status": overdue,
+            "tasks_due_count": due,
+            "tasks_open": open_count,
+            "stages": stages.get(user_id, {}),
+        }
+        for user_id, username, overdue, due, open_count in metric_rows
+    ]
+
+    totals = {"tasks_status": 0, "tasks_due_count": 0, "tasks_open": 0, "stages": {}}
+    for member in members:
+        for field in ("tasks_status", "tasks_due_count", "tasks_open"):
+            totals[field] += member[field]
+        for stage, count in member["stages"].items():
+            totals["stages"][stage] = totals["stages"].get(stage, 0) + count
+
+    return {"members": members, "totals": totals}
+
+# The team's leads in one query, optionally for one stage or rep
+def load_team_leads(engine, manager_id: int, role: str, stage: Optional[str], member_id: Optional[int], limit: int) -> list:
+    sql = TEAM_LEADS_SQL
+    params = {"manager_id": manager_id, "role": role, "limit": limit}
+    conditions = []
+    if stage is not None:
+        conditions.append("leads.stage = :stage")
+        params["stage"] = stage
+    if member_id is not None:
+        conditions.append("leads.user_id = :member_id")
+        params["member_id"] = member_id
+    if conditions:
+        sql += " WHERE " + " AND ".join(conditions)
+    sql += " ORDER BY leads.action_date, leads.id LIMIT :limit"
+
+    with engine.connect() as conn:
+        rows = conn.execute(sqlalchemy.text(sql), params).fetchall()
+
+    return [
+        {**lead, "user_id": row[9], "username": row[10]}
+        for lead, row in zip(lead_rows_to_json(rows), rows)
+    ]
+
+# Serve a team view from the cache or load it, the date is in the key because counts are against today
+# Stored JSON ready since Redis keeps JSON and lead dates aren't
+async def cached_team_view(cache_key: str, load, *args):
+    cache_key = f"{cache_key}:{date.today()}"
+    view = cache.get(cache_key)
+    if view is None:
+        view = jsonable_encoder(await coalesce(cache_key, load, *args))
+        cache.set(cache_key, view, TEAM_CACHE_SECONDS)
+    return view
+
+@app.get('/api/team/metrics')
+async def getTeamMetrics(request: Request):
+    manager_id, role = require_manager(request)
+    # Other users' leads, so the manager's own recent writes don't matter and the replica is fine
+    metrics = await cached_team_view(f"team:{manager_id}:metrics", load_team_metrics, read_database, manager_id, role)
+    return {"ok": True, **metrics}
+
+@app.get('/api/team/leads')
+async def getTeamLeads(
+    request: Request,
+    stage: Optional[str] = None,
+    member_id: Optional[int] = None,
+    limit: int = Query(TEAM_LEADS_LIMIT, ge=1, le=TEAM_LEADS_LIMIT),
+):
+    manager_id, role = require_manager(request)
+    leads = await cached_team_view(
+        f"team:{manager_id}:leads:{stage}:{member_id}:{limit}",
+        load_team_leads, read_database, manager_id, role, stage, member_id, limit,
+    )
+    return {"ok": True, "leads": leads}
 
 
 # Complete leads and remove from today's task
@@ -635,49 +3074,42 @@ def completeLead(leadId: int, request: Request):
         future_datetime = current_datetime + timedelta(days=7)
         
         # Set datetime to be 7 days in advance
-        conn.execute(
+        company_info = conn.execute(
             sqlalchemy.text("""
                             UPDATE leads 
                             SET task_status = 'done',
-                            action_date = :new_date
+                            action_date = :new_date,
+                            version = version + 1,
+                            updated_at = CURRENT_TIMESTAMP
                             WHERE id = :lead_id
                             AND user_id = :user_id
-                            RETURNING id
+                            RETURNING company_name
                             """),
             {"user_id": user_id, "lead_id": leadId, "new_date": future_datetime},
-        ).fetchone()
-        
-        # Get company info to update mongodb
-        company_info = conn.execute(
-            sqlalchemy.text("""
-                SELECT company_name FROM leads WHERE id = :lead_id AND user_id = :user_id
-                            """),
-            {"user_id": user_id, "lead_id": leadId},
         ).scalar()
-        
+
+        if company_info is None:
+            raise HTTPException(status_code=404, detail="Lead not found")
         
         # Update no sql lead status
-        update_lead_activity = {
-            'user_id': user_id,
-            'timestamp': datetime.now(timezone.utc),
-            'time': (datetime.now(timezone.utc).strftime('%X')),
-            'date': (datetime.now(timezone.utc).strftime('%x')),
-            'details': f'User completed lead {company_info}'
-        }
-        
-        activity_log.insert_one(update_lead_activity)
+        record_activity(conn, user_id, ActivityEvent.LEAD_COMPLETE, lead_id=leadId, company=company_info)
+
+    refresh_lead_priorities([leadId])
+    on_lead_mutation(user_id)
+    reminders.unschedule(leadId)
 
     return {"ok": True, "lead_id": leadId}
 
 
 # Get date from user and update action date of lead
-@app.patch('/api/leads/{leadId}/reschedule')
-async def rescheduleLead(leadId:int, request: Request):
-    # Await for user to set new action date
-    newDateTime = await request.json()
+class RescheduleUpdate(BaseModel):
+    action_date: date
+    # Version of the lead the client last saw, leave out to overwrite whatever is there
+    version: Optional[int] = None
 
-    convertedDateTime = datetime.strptime(newDateTime['action_date'], '%Y-%m-%d')
-    datetime_now = datetime.now()
+@app.patch('/api/leads/{leadId}/reschedule')
+async def rescheduleLead(leadId:int, payload: RescheduleUpdate, request: Request):
+    new_date = payload.action_date.isoformat()
 
     session_id = request.cookies.get('id')
     
@@ -693,57 +3125,68 @@ async def rescheduleLead(leadId:int, request: Request):
         ).fetchone()
         
         if not auth:
-            raise HTTPException(status_code=401, details="Invalid session")
+            raise HTTPException(status_code=401, detail="Invalid session")
         
         user_id = auth[0]
-        
-        # Get previous date time and company name
+
+        # If lead's datetime is set to before today's date, then remove task completion status i.e. 'done' so that we can display the lead on the main page
+        reopen = date.today() >= payload.action_date
+
+        # Read the company name and previous date before they are overwritten
+        original = read_lead_before_edit(conn, leadId, user_id, "action_date", payload.version)
+        if not original:
+            return lead_conflict_response(conn, leadId, user_id)
+        company_name, original_date, seen_version = original
+
+        # Update SQL database with new action date if the version still matches
         company_info = conn.execute(
             sqlalchemy.text("""
-                SELECT company_name, action_date FROM leads WHERE id = :lead_id AND user_id = :user_id
+                UPDATE leads
+                set action_date = :newDateTime,
+                task_status = CASE WHEN :reopen THEN NULL ELSE task_status END,
+                version = version + 1,
+                updated_at = CURRENT_TIMESTAMP
+                WHERE id = :lead_id
+                AND user_id = :user_id
+                AND version = :version
+                RETURNING version, task_status, stage
                             """),
-            {"user_id": user_id, "lead_id":leadId},
+            {"user_id": user_id, "lead_id":leadId, "newDateTime": payload.action_date, "reopen": reopen, "version": seen_version}
         ).fetchone()
 
-        # If lead's datetime is set to before today's date, then remove task completion status i.e. 'done' so that we can display the lead on the main page
-        if datetime_now >= convertedDateTime:
-            # Update SQL database with new action date
-            conn.execute(
-                sqlalchemy.text("""
-                    UPDATE leads
-                    set action_date = :newDateTime,
-                    task_status = NULL
-                    WHERE id = :lead_id
-                    AND user_id = :user_id
-                                """),
-                {"user_id": user_id, "lead_id":leadId, "newDateTime": newDateTime['action_date']}
-        ) 
-        else:
-            # Update SQL database with new action date
-            conn.execute(
-                sqlalchemy.text("""
-                    UPDATE leads
-                    set action_date = :newDateTime
-                    WHERE id = :lead_id
-                    AND user_id = :user_id
-                                """),
-                {"user_id": user_id, "lead_id":leadId, "newDateTime": newDateTime['action_date']}
-            )
+        if not company_info:
+            return lead_conflict_response(conn, leadId, user_id)
             
         # Update no sql schedule status
-        update_lead_activity = {
-            'user_id': user_id,
-            'timestamp': datetime.now(timezone.utc),
-            'time': (datetime.now(timezone.utc).strftime('%X')),
-            'date': (datetime.now(timezone.utc).strftime('%x')),
-            'details': f'User rescheduled lead: {company_info[0]} from {company_info[1]} to {newDateTime["action_date"]}'
-        }
+        record_activity(conn, user_id, ActivityEvent.LEAD_RESCHEDULE, lead_id=leadId, company=company_name, before=original_date, after=new_date)
         
-        activity_log.insert_one(update_lead_activity)
-        
-        return {"ok": True, "lead_id": leadId}
+    await asyncio.to_thread(refresh_lead_priorities, [leadId])
+    on_lead_mutation(user_id)
+
+    # Done or closed leads don't need reminding
+    if company_info[1] == 'done' or company_info[2] in ('Lost', 'Won'):
+        reminders.unschedule(leadId)
+    else:
+        reminders.lead_changed(leadId, user_id, new_date)
+
+    return {"ok": True, "lead_id": leadId, "version": company_info[0]}
     
 
+# Get a user's activities oldest first, optionally only the most recent ones
+# Documents from before schema version 2 keep user_id and timestamp until tools/activity-migrate.py rewrites them,
+# they are read alongside the compact ones so nobody's feed goes empty in between
+def fetch_activity(user_id: int, limit: Optional[int] = None):
+    direction = pymongo.ASCENDING if limit is None else pymongo.DESCENDING
+    activity = []
+    for activity_query, time_field in (({'u': user_id}, "t"), ({'user_id': user_id}, "timestamp")):
+        documents = activity_log.find(activity_query, {"_id": 0}).sort(time_field, direction)
+        if limit is not None:
+            documents = documents.limit(limit)
+        activity.extend(render_activity(doc) for doc in documents)
+
+    activity.sort(key=lambda entry: entry["timestamp"] or datetime.min)
+    return activity if limit is None else activity[-limit:]
+
 # Get activity log to show in activity tab
 @app.get('/api/activity')
 async def getActivityLog(request: Request):
@@ -765,18 +3208,167 @@ async def getActivityLog(request: Request):
         user_id = auth[0]
         
         # Get activities associated with user id and put into list to return to frontend
-        activity_query = { 'user_id': user_id }
-        current_activity_log = list(activity_log.find(activity_query, {"_id": 0}))
+        current_activity_log = fetch_activity(user_id)
         
         
         return {'ok': True, 'activity_log': current_activity_log}
     
-# Chatbot that calls OpenAI API 
+# How far the activity outbox relay is behind MongoDB
+@app.get('/api/activity/outbox')
+async def getOutboxLag(request: Request):
+    require_admin(request)
+    lag = await asyncio.to_thread(outbox_lag)
+    return jsonable_encoder({'ok': True, **lag})
+
+# This worker's connection pools and slowest statements since it started or since the last ?reset=1
+# Pool sizes and timeouts are tuned from these, see pool_options and the Mongo client settings
+@app.get('/api/debug/pools')
+async def getPoolStats(
+    request: Request,
+    limit: int = Query(10, ge=1, le=STATEMENT_STATS_MAX),
+    by: str = Query("total", pattern="^(total|mean|max|calls)$"),
+    reset: bool = False,
+):
+    require_admin(request)
+
+    engines = {"primary": database} if read_database is database else {"primary": database, "replica": read_database}
+    pools = {
+        name: {"driver": engine.dialect.driver, "pre_ping": DB_PRE_PING, **database_stats[name].report(engine.pool)}
+        for name, engine in engines.items()
+    }
+    statements = [statement for name in engines for statement in database_stats[name].slowest(limit, by)]
+    statements = heapq.nlargest(limit, statements, key=lambda s: s["calls"] if by == "calls" else s[f"{by}_ms"])
+
+    report = {"ok": True, "worker": os.getpid(), "pools": pools, "mongo": mongo_stats.report(), "slow_statements": statements}
+    if reset:
+        for name in engines:
+            database_stats[name].reset()
+        mongo_stats.reset()
+    return report
+
+# Everything the dashboard needs on first load in one request
+@app.get('/api/dashboard/bootstrap')
+async def getDashboardBootstrap(request: Request, leads: bool = True):
+    # Authenticate once for all of the queries below
+    user_id = require_user_id(request)
+
+    # Each SQL query gets its own pooled connection so both run alongside the Mongo read
+    # leads are today's tasks, the highest priority open leads. ?leads=0 leaves them out
+    lead_rows, metrics, recent_activity = await asyncio.gather(
+        coalesce(("leads", user_id, "top", DASHBOARD_TASK_LIMIT), load_top_leads, request, user_id, DASHBOARD_TASK_LIMIT) if leads else asyncio.sleep(0),
+        cached_lead_metrics(request, user_id),
+        asyncio.to_thread(fetch_activity, user_id, BOOTSTRAP_ACTIVITY_LIMIT),
+    )
+
+    body = {
+        "ok": True,
+        "metrics": metrics,
+        "activity_log": recent_activity,
+    }
+    if leads:
+        body["leads"] = lead_rows
+    return body
+
+# Chatbot that calls OpenAI API
+CHAT_MODEL = "gpt-5-nano"
+
+# Each user has one running conversation, sent back to the model with every prompt so follow up questions keep their context
+# Stored compactly in MongoDB as {"_id": user id, "n": turns saved, "d": digest, "m": [[role, text], ...], "t": last used}
+# with role "u" for the user and "a" for the assistant, and kept in the cache between turns
+chat_conversations = nosql_database["chat_conversations"]
+
+# Messages kept word for word, the oldest fall off the end like a ring buffer if the digest can't keep up
+CHAT_MAX_MESSAGES = 20
+# Once a conversation is estimated to be over CHAT_TOKEN_BUDGET tokens its older messages are summarised into the digest,
+# keeping the latest CHAT_KEEP_MESSAGES as they are while they fit in half the budget
+CHAT_TOKEN_BUDGET = int(os.getenv("CHAT_TOKEN_BUDGET", "2000"))
+CHAT_KEEP_MESSAGES = 4
+CHAT_DIGEST_MAX_CHARS = 2000
+# A conversation left this long starts again from nothing
+CHAT_IDLE_SECONDS = 2 * 3600
+
+CHAT_DIGEST_PROMPT = (
+    "You keep a running summary of a conversation between a CRM user and their email drafting assistant. "
+    "Rewrite the summary so it also covers the new messages below. Keep names, companies, dates, decisions and the "
+    "user's preferences, drop pleasantries and full email drafts. Answer with the summary only, under 200 words.\n\n"
+)
+
 class PromptPayload(BaseModel):
     prompt: str
 
+# Rough token count, about four characters each for English text
+def estimate_tokens(text: str) -> int:
+    return len(text) // 4 + 1
+
+def conversation_tokens(conversation: dict) -> int:
+    return estimate_tokens(conversation["d"]) + sum(estimate_tokens(text) for _, text in conversation["m"])
+
+# The user's conversation, empty when there is none or it has been idle too long
+def load_conversation(user_id: int) -> dict:
+    conversation = cache.get(f"chat:{user_id}")
+    if conversation is None:
+        conversation = chat_conversations.find_one({"_id": user_id}, {"_id": 0})
+    if conversation is None or time.time() - conversation["t"] > CHAT_IDLE_SECONDS:
+        return {"n": 0, "d": "", "m": [], "t": 0}
+    return conversation
+
+# Messages for the Responses API: the digest, the messages kept and the new prompt
+def chat_input(conversation: dict, prompt: str) -> list:
+    messages = []
+    if conversation["d"]:
+        messages.append({"role": "developer", "content": f"Summary of the conversation so far:\n{conversation['d']}"})
+    for role, text in conversation["m"]:
+        messages.append({"role": "user" if role == "u" else "assistant", "content": text})
+    messages.append({"role": "user", "content": prompt})
+    return messages
+
+# Add a prompt and its answer, an idle conversation is replaced rather than added to
+def save_turn(user_id: int, conversation: dict, prompt: str, answer: str) -> dict:
+    turn = [["u", prompt], ["a", answer]]
+    if conversation["n"]:
+        update = {"$push": {"m": {"$each": turn, "$slice": -CHAT_MAX_MESSAGES}}, "$inc": {"n": 1}, "$set": {"t": time.time()}}
+    else:
+        update = {"$set": {"m": turn, "d": "", "t": time.time()}, "$inc": {"n": 1}}
+
+    saved = chat_conversations.find_one_and_update(
+        {"_id": user_id}, update, projection={"_id": 0}, upsert=True, return_document=pymongo.ReturnDocument.AFTER,
+    )
+    cache.set(f"chat:{user_id}", saved, CHAT_IDLE_SECONDS)
+    return saved
+
+# Fold the older messages into the digest, run after the answer has been sent so the user never waits for it
+# Saved only if no other turn was added meanwhile, the next turn over budget tries again
+def compact_conversation(user_id: int, conversation: dict):
+    messages = conversation["m"]
+    keep = min(CHAT_KEEP_MESSAGES, len(messages))
+    while keep > 2 and sum(estimate_tokens(text) for _, text in messages[-keep:]) > CHAT_TOKEN_BUDGET // 2:
+        keep -= 2
+    folded = messages[:-keep]
+    if not folded:
+        return
+
+    transcript = "\n".join(f"{'User' if role == 'u' else 'Assistant'}: {text}" for role, text in folded)
+    try:
+        response = client.responses.create(
+            model=CHAT_MODEL,
+            input=f"{CHAT_DIGEST_PROMPT}Summary so far:\n{conversation['d'] or '(none)'}\n\nNew messages:\n{transcript}",
+        )
+        digest = response.output_text.strip()[:CHAT_DIGEST_MAX_CHARS]
+    except Exception as e:
+        print(f"Could not summarise conversation: {e}")
+        return
+
+    compacted = chat_conversations.find_one_and_update(
+        {"_id": user_id, "n": conversation["n"]},
+        {"$set": {"d": digest, "m": messages[-keep:]}},
+        projection={"_id": 0},
+        return_document=pymongo.ReturnDocument.AFTER,
+    )
+    if compacted is not None:
+        cache.set(f"chat:{user_id}", compacted, CHAT_IDLE_SECONDS)
+
 @app.post('/api/llm')
-async def sendPrompt(payload: PromptPayload, request: Request):
+async def sendPrompt(payload: PromptPayload, request: Request, background_tasks: BackgroundTasks):
     
     # Authentication
     session_id = request.cookies.get('id')
@@ -792,11 +3384,23 @@ async def sendPrompt(payload: PromptPayload, request: Request):
         
         if not auth:
             raise HTTPException(status_code=401, detail="Invalid session")
+
+        user_id = auth[0]
+
+    # LLM calls are slow and cost money per request
+    enforce_rate_limit(request, "llm", user_id)
+
+    # The chat still works without its history when MongoDB is unreachable
+    try:
+        conversation = await asyncio.to_thread(load_conversation, user_id)
+    except pymongo.errors.PyMongoError as e:
+        print(f"Could not load conversation: {e}")
+        conversation = {"n": 0, "d": "", "m": [], "t": 0}
     
     # Get response from GPT, reference: https://github.com/openai/openai-python
     gpt_response = client.responses.create(
-        model="gpt-5-nano",
-        input = payload.prompt
+        model=CHAT_MODEL,
+        input = chat_input(conversation, payload.prompt)
     )
     
     # Extract text
@@ -806,8 +3410,24 @@ async def sendPrompt(payload: PromptPayload, request: Request):
     except Exception:
         text = str(gpt_response)
 
+    try:
+        conversation = await asyncio.to_thread(save_turn, user_id, conversation, payload.prompt, text)
+    except pymongo.errors.PyMongoError as e:
+        print(f"Could not save conversation: {e}")
+    else:
+        if conversation_tokens(conversation) > CHAT_TOKEN_BUDGET:
+            background_tasks.add_task(compact_conversation, user_id, conversation)
+
     return { 'ok': True, 'response': text}
 
+# Start a new conversation
+@app.delete('/api/llm/conversation')
+async def clearConversation(request: Request):
+    user_id = require_user_id(request)
+    await asyncio.to_thread(chat_conversations.delete_one, {"_id": user_id})
+    cache.delete(f"chat:{user_id}")
+    return {'ok': True}
+
 
 # Delete lead from sql database
 @app.delete('/api/leads/{leadId}/delete')
@@ -827,36 +3447,36 @@ async def deleteLead(leadId: int, request: Request):
             {'id': session_id},
         ).fetchone()
 
+        # If the user id is not the same as session id then throw error
+        if not auth:
+            raise HTTPException(status_code=401, detail="Invalid session")
+
         # Define user id
         user_id = auth[0]
 
-        # Get previous date time and company name
+        # Delete the lead and get its company name for the audit in one statement
         company_info = conn.execute(
-            sqlalchemy.text("""
-                SELECT company_name FROM leads WHERE id = :lead_id AND user_id = :user_id
-                            """),
-            {"user_id": user_id, "lead_id":leadId},
+            sqlalchemy.text("DELETE FROM leads WHERE id = :lead_id AND user_id = :user_id RETURNING company_name"),
+            {"lead_id": leadId, "user_id": user_id}
         ).fetchone()
 
-        # If the user id is not the same as session id then throw error
-        if not auth:
-            raise HTTPException(status_code=401, detail="Invalid session")
+        if not company_info:
+            raise HTTPException(status_code=404, detail="Lead not found")
 
+        # Tell synced clients to drop it
         conn.execute(
-            sqlalchemy.text("DELETE FROM leads WHERE id = :lead_id AND user_id = :user_id"),
-            {"lead_id": leadId, "user_id": user_id}
+            sqlalchemy.text("""
+                INSERT INTO lead_tombstones (lead_id, user_id, deleted_at) VALUES (:lead_id, :user_id, CURRENT_TIMESTAMP)
+                ON CONFLICT (lead_id) DO UPDATE SET user_id = excluded.user_id, deleted_at = excluded.deleted_at
+            """),
+            {"lead_id": leadId, "user_id": user_id},
         )
 
         # Update no sql schedule status
-        update_lead_activity = {
-            'user_id': user_id,
-            'timestamp': datetime.now(timezone.utc),
-            'time': (datetime.now(timezone.utc).strftime('%X')),
-            'date': (datetime.now(timezone.utc).strftime('%x')),
-            'details': f'User deleted lead: {company_info[0]}'
-        }
-        
-        activity_log.insert_one(update_lead_activity)
+        record_activity(conn, user_id, ActivityEvent.LEAD_DELETE, lead_id=leadId, company=company_info[0])
+
+    on_lead_mutation(user_id)
+    reminders.unschedule(leadId)
 
     return { 'ok': True}
     
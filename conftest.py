@@ -0,0 +1,170 @@
+import importlib.util
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import httpx
+import pytest
+import sqlalchemy
+from openai import OpenAI
+
+# Run the tests without any outside service: a SQLite file instead of Postgres, mongomock instead of MongoDB,
+# secrets from the environment instead of Secret Manager and a fake OpenAI client
+# Set TEST_DATABASE_URL to a throwaway Postgres database to run against Postgres instead of SQLite
+# app reads its configuration when it is imported, so this has to happen first
+TEST_DIR = tempfile.mkdtemp(prefix=f"crm-test-{os.getenv('PYTEST_XDIST_WORKER', 'main')}-")
+TEST_DATABASE_PATH = os.path.join(TEST_DIR, "crm.db")
+
+os.environ.update({
+    "SECRET_PROVIDER": "env",
+    "DATABASE_URL": os.getenv("TEST_DATABASE_URL") or f"sqlite:///{TEST_DATABASE_PATH}",
+    "MONGODB_URL": "mongomock://localhost",
+    "WEB_CONCURRENCY": "1",
+    "OUTBOX_RELAY_ENABLED": "0",
+    "REMINDERS_ENABLED": "0",
+    # Starlette's test client connects as "testclient", trust it like the front end proxy in production
+    "FORWARDED_ALLOW_IPS": "testclient",
+})
+for name in ("DATABASE_READ_URL", "REDIS_URL", "RATE_LIMIT_REDIS_URL", "REMINDER_NOTIFIER"):
+    os.environ.pop(name, None)
+
+import app as crm_app
+
+# Build the schema with the same migrations production runs
+spec = importlib.util.spec_from_file_location("migrate", os.path.join(os.path.dirname(__file__), "tools", "migrate.py"))
+migrations = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(migrations)
+migrations.migrate(crm_app.database)
+migrations.ensure_mongo_indexes(crm_app.nosql_database)
+
+# Each test starts from a copy of the freshly migrated SQLite file
+TEMPLATE_DATABASE_PATH = os.path.join(TEST_DIR, "template.db")
+if crm_app.database.dialect.name == "sqlite":
+    crm_app.database.dispose()
+    shutil.copyfile(TEST_DATABASE_PATH, TEMPLATE_DATABASE_PATH)
+
+
+# Stands in for the OpenAI client, answers every prompt by echoing it and remembers the calls
+# A list of messages is answered by echoing the last one
+class FakeOpenAI:
+    class Responses:
+        def __init__(self):
+            self.calls = []
+
+        def create(self, **kwargs):
+            self.calls.append(kwargs)
+            prompt = kwargs.get('input', '')
+            if isinstance(prompt, list):
+                prompt = prompt[-1]["content"]
+            return type("FakeResponse", (), {"output_text": f"Draft: {prompt}"})()
+
+    def __init__(self):
+        self.responses = self.Responses()
+
+
+# A local HTTP server speaking enough of the OpenAI Responses API for the real client to talk to it
+# answer(prompt) gives the model's text, prompts holds every prompt received
+class StubModelServer(ThreadingHTTPServer):
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), StubModelHandler)
+        self.prompts = []
+        self.answer = lambda prompt: "{}"
+        self.base_url = f"http://127.0.0.1:{self.server_address[1]}/v1"
+
+
+class StubModelHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.server.prompts.append(body["input"])
+        try:
+            text = self.server.answer(body["input"])
+        except Exception:
+            self.send_error(500)
+            return
+
+        payload = json.dumps({
+            "id": f"resp_{len(self.server.prompts)}",
+            "object": "response",
+            "created_at": 0,
+            "model": body["model"],
+            "status": "completed",
+            "output": [{
+                "type": "message",
+                "id": "msg_1",
+                "status": "completed",
+                "role": "assistant",
+                "content": [{"type": "output_text", "text": text, "annotations": []}],
+            }],
+        }).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Answers like cloud_function/main.py does
+def fake_email_validator(request: httpx.Request) -> httpx.Response:
+    email = json.loads(request.content).get("email", "")
+    valid = bool(re.match(r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$', email))
+    return httpx.Response(200, json={"valid": valid, "email": email})
+
+
+# Empty every table, keeping the record of which migrations ran
+def reset_database():
+    engine = crm_app.database
+    if engine.dialect.name == "sqlite":
+        # The app's pool is closed first so no connection keeps the old file open
+        engine.dispose()
+        shutil.copyfile(TEMPLATE_DATABASE_PATH, TEST_DATABASE_PATH)
+        return
+
+    with engine.begin() as conn:
+        tables = [name for name in sqlalchemy.inspect(conn).get_table_names() if name != "schema_migrations"]
+        if tables:
+            conn.exec_driver_sql(f"TRUNCATE {', '.join(tables)} RESTART IDENTITY CASCADE")
+
+
+# Every test gets an empty database, activity log, cache and rate limits
+@pytest.fixture(autouse=True)
+def isolated_backends(monkeypatch):
+    reset_database()
+    for name in crm_app.nosql_database.list_collection_names():
+        crm_app.nosql_database[name].delete_many({})
+
+    monkeypatch.setattr(crm_app, "cache", crm_app.MemoryCache())
+    monkeypatch.setattr(crm_app, "idempotency_store", crm_app.MemoryCache())
+    monkeypatch.setattr(crm_app, "rate_limiter", crm_app.MemoryTokenBuckets())
+    monkeypatch.setattr(crm_app, "reminders", crm_app.ReminderScheduler(crm_app.reminders.notifier))
+    crm_app.in_flight_reads.clear()
+    yield
+
+
+@pytest.fixture(autouse=True)
+def fake_email_validator_client(monkeypatch):
+    monkeypatch.setattr(crm_app, "email_validator_client", lambda: httpx.AsyncClient(transport=httpx.MockTransport(fake_email_validator)))
+
+
+@pytest.fixture(autouse=True)
+def fake_openai(monkeypatch):
+    fake = FakeOpenAI()
+    monkeypatch.setattr(crm_app, "client", fake)
+    return fake
+
+
+# Point the app's OpenAI client at a stub model server for the test
+@pytest.fixture
+def stub_model_server(monkeypatch):
+    server = StubModelServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(crm_app, "client", OpenAI(api_key="test", base_url=server.base_url))
+    yield server
+    server.shutdown()
+    server.server_close()
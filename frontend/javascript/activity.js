@@ -1,5 +1,14 @@
+// Activity sent with the dashboard bootstrap, used the first time the tab is opened
+let prefetchedActivity = null;
+
 // Display activity logs
 async function showActivityLog() {
+    if (prefetchedActivity) {
+        renderActivityLog(prefetchedActivity);
+        prefetchedActivity = null;
+        return;
+    }
+
     // Call python rest api for nosql database
     const response = await fetch('/api/activity', {
         method : 'GET',
@@ -12,13 +21,16 @@ async function showActivityLog() {
 
     // Define variable to hold response
     const data = await response.json();
+    console.log(data);
+    renderActivityLog(data.activity_log);
+}
 
-    // Create activity log row
+// Create activity log rows, newest first
+function renderActivityLog(activity_log) {
     const tbody = document.getElementById("activity-page-tbody");
     tbody.innerHTML = ''; 
-    console.log(data);
 
-    data.activity_log.reverse().forEach(log => {
+    activity_log.reverse().forEach(log => {
         const tr = document.createElement("tr");
 
         tr.innerHTML = `
@@ -102,6 +102,37 @@ leadFields = document.querySelectorAll(".lead-field")
 
 let leadData;
 
+// Saving the same lead again (a double click or a retry after a slow response) reuses its Idempotency-Key,
+// so the server answers with the first response instead of adding the lead twice
+let leadKey = { body: null, key: null };
+
+function leadIdempotencyKey(body) {
+    if (leadKey.body !== body) leadKey = { body, key: crypto.randomUUID() };
+    return leadKey.key;
+}
+
+// Post a new lead, if the server finds the company or email already in the user's leads ask before saving it again
+async function postLead(leadData) {
+    const body = JSON.stringify(leadData);
+    const res = await fetch("/api/leads", {
+    method: "POST",
+    credentials: "same-origin",
+    headers: { "Content-Type": "application/json", "Idempotency-Key": leadIdempotencyKey(body) },
+    body,
+    });
+
+    // Saved, adding the same details later is a new lead
+    if (res.ok) leadKey = { body: null, key: null };
+
+    if (res.status === 409) {
+      const data = await res.clone().json();
+      if (data.duplicate && confirm(`${data.duplicate.company_name} is already in your leads. Save it anyway?`)) {
+        return postLead({ ...leadData, allow_duplicate: true });
+      }
+    }
+    return res;
+}
+
 document.getElementById('modal-save-button').onclick = function() {
     document.getElementById('save-error-btn').style.display = 'none';
 
@@ -132,15 +163,15 @@ document.getElementById('modal-save-button').onclick = function() {
     };
 
     // post lead info to /api/leads endpoint
-    fetch("/api/leads", {
-    method: "POST",
-    credentials: "same-origin",
-    headers: { "Content-Type": "application/json" },
-    body: JSON.stringify(leadData),
-    })
+    postLead(leadData)
     .then(async (res) => {
     const text = await res.text();
 
+    // User chose not to save a lead that is already in their list, leave the form open
+    if (res.status === 409) {
+      throw new Error("Duplicate lead not saved")
+    }
+
     // If google cloud function email validator deems email format to be incorrect, show error message to user
     if (text.includes("Email format incorrect")) {
       emailError.style.display = 'block'
@@ -176,6 +207,9 @@ document.getElementById('modal-save-button').onclick = function() {
 
 // Sign out of page
 document.getElementById("sign-out-btn").onclick = async function () {
+  // Don't leave this user's leads in the browser for whoever signs in next
+  await clearLeadCache();
+
   const responseSignOut = await fetch("/logout", {
     method: "POST",
     credentials: "same-origin"
@@ -191,7 +225,8 @@ document.getElementById("sign-out-btn").onclick = async function () {
 
 // Get leads to display on page
 async function loadLeads() {
-  const res = await fetch("/api/getleads?source=dashboard", {
+  // Today's tasks are the open leads with the highest priority, already in order
+  const res = await fetch("/api/getleads?source=top&limit=5", {
     method: "GET",
     headers: { "Accept": "application/json" },
     credentials: "same-origin"
@@ -199,20 +234,20 @@ async function loadLeads() {
 
   if (!res.ok) throw new Error(`Failed: ${res.status}`);
 
-  // Store incomming json data in data variable and get the leads container id into tbody variable to append rows of data
   const data = await res.json();
+  renderDashboardLeads(data.leads);
+}
+
+// Build today's task table from a list of leads
+function renderDashboardLeads(leads) {
+  // Get the leads container id into tbody variable to append rows of data
   const tbody = document.getElementById("leads-tbody");
   tbody.innerHTML = "";
 
-  // Sort by date
-  data.leads.sort((date2, date1) => {
-    return new Date(date2.action_date) - new Date(date1.action_date);
-  });
-
-
-  // For each lead, create a row
-  data.leads.forEach((lead) => {
+  // For each lead, create a row, the server sends them highest priority first
+  leads.forEach((lead) => {
     const tr = document.createElement("tr");
+    tr.dataset.version = lead.version;
 
     // Maximum 5 rows for today's tasks
     if (tbody.children.length === 5) {
@@ -254,12 +289,16 @@ async function loadLeads() {
     tbody.appendChild(tr);
   });
 
-  // Add event listener to all buttons in the rows
+  bindDashboardLeadEvents(tbody);
+  }
+
+// Add event listener to all buttons in the rows
+function bindDashboardLeadEvents(tbody) {
   tbody.addEventListener("change", onTaskChange);
   tbody.addEventListener("change", onStageChange);
   tbody.addEventListener("click", onCompleteClick);
   tbody.addEventListener("click", rescheduleClick);
-  }
+}
 
   // Reschedule function that gets a new date from the user, then posts it to the sql database via the rest api endpoint
 async function rescheduleClick(e){
@@ -271,6 +310,7 @@ async function rescheduleClick(e){
   const popup_dialog = document.getElementById("reschedule-dialog");
 
   popup_dialog.dataset.currentLeadId = leadId;
+  popup_dialog.dataset.currentLeadVersion = e.target.closest("tr").dataset.version;
   
   // Show the dialog
   popup_dialog.showModal();
@@ -285,16 +325,21 @@ document.getElementById('reschedule-form').addEventListener('submit', async (e)
 
   const modal_dialog = document.getElementById('reschedule-dialog');
   const leadId = modal_dialog.dataset.currentLeadId;
+  const version = Number(modal_dialog.dataset.currentLeadVersion);
   const newDateTime = document.getElementById('reschedule-date-input').value;
 
   // Call Rest API
-  await fetch(`/api/leads/${leadId}/reschedule`, {
+  const response = await fetch(`/api/leads/${leadId}/reschedule`, {
     method: 'PATCH',
     headers: {'Content-Type': 'application/json'},
     credentials: 'same-origin',
-    body: JSON.stringify({action_date:newDateTime})
+    body: JSON.stringify({action_date:newDateTime, version})
   });
 
+  if (response.status === 409) {
+    alert("This lead was changed somewhere else, showing the latest version.");
+  }
+
   // Close pop up modal and load leads again to reflect changes
   modal_dialog.close();
   loadLeads();
@@ -352,15 +397,23 @@ async function onTaskChange(e) {
 
   const leadId = e.target.dataset.leadId;
   const newTask = e.target.value;
+  const row = e.target.closest("tr");
   
     try {
-      // Send patch to backend
+      // Send patch to backend with the version this row was loaded at
       const response = await fetch(`/api/leads/${leadId}/task`, {
         method: "PATCH",
         headers: { "Content-Type": "application/json" },
         credentials: "same-origin",
-        body: JSON.stringify({ task: newTask })
+        body: JSON.stringify({ task: newTask, version: Number(row.dataset.version) })
       });
+
+      // Someone else edited the lead first, reload so the user sees their change
+      if (response.status === 409) {
+        alert("This lead was changed somewhere else, showing the latest version.");
+        loadLeads();
+        return;
+      }
       
       if (!response.ok) {
         console.error("Failed to update task:", response.status);
@@ -368,6 +421,9 @@ async function onTaskChange(e) {
         return;
       }
       
+      // Remember the new version for the next edit
+      const data = await response.json();
+      row.dataset.version = data.version;
       console.log("Task updated successfully");
       // If CORS incorrect or server failure show error
     } catch (error) {
@@ -383,16 +439,24 @@ async function onStageChange(e) {
 
   const leadId = e.target.dataset.leadId;
   const newStage = e.target.value;
+  const row = e.target.closest("tr");
   
 
   try {
-      // Patch column
+      // Patch column with the version this row was loaded at
       const response = await fetch(`/api/leads/${leadId}/stage`, {
         method: "PATCH",
         headers: { "Content-Type": "application/json" },
         credentials: "same-origin",
-        body: JSON.stringify({ stage: newStage })
+        body: JSON.stringify({ stage: newStage, version: Number(row.dataset.version) })
       });
+
+      // Someone else edited the lead first, reload so the user sees their change
+      if (response.status === 409) {
+        alert("This lead was changed somewhere else, showing the latest version.");
+        loadLeads();
+        return;
+      }
       
       if (!response.ok) {
         console.error("Failed to update stage:", response.status);
@@ -400,6 +464,9 @@ async function onStageChange(e) {
         return;
       }
       
+      // Remember the new version for the next edit
+      const data = await response.json();
+      row.dataset.version = data.version;
       console.log("Stage updated successfully");
       // Show server error or CORS problem
     } catch (error) {
@@ -407,9 +474,6 @@ async function onStageChange(e) {
       alert("Error updating stage");
     }
 }
-// Leads after changing task or stage
-loadLeads();
-
 // Get task metric info via a aggregate sql query
 async function leadMetrics(){
   res = await fetch("/api/leads/metrics", {
@@ -420,7 +484,11 @@ async function leadMetrics(){
 
   // Get the data
   const data = await res.json();
+  renderMetrics(data);
+};
 
+// Fill in the metric boxes
+function renderMetrics(data) {
   // Update over due tasks
   const overDue = document.getElementById("tasks-overdue-count");
   overDue.textContent = data.tasks_status;
@@ -434,4 +502,28 @@ async function leadMetrics(){
   openLeads.textContent = data.tasks_open;
 };
 
-leadMetrics()
+// Load leads, metrics and recent activity in one request when the page opens
+async function bootstrapDashboard() {
+  const res = await fetch("/api/dashboard/bootstrap", {
+    method: "GET",
+    headers: { "Accept": "application/json" },
+    credentials: "same-origin"
+  });
+
+  if (!res.ok) throw new Error(`Failed: ${res.status}`);
+
+  const data = await res.json();
+  renderDashboardLeads(data.leads);
+  renderMetrics(data.metrics);
+
+  // Keep activity for the first time the activity tab is opened
+  prefetchedActivity = data.activity_log;
+}
+
+// Server rendered pages already have today's tasks and metrics, so only the row buttons need wiring up
+const dashboardTbody = document.getElementById("leads-tbody");
+if (dashboardTbody.hasAttribute("data-server-rendered")) {
+  bindDashboardLeadEvents(dashboardTbody);
+} else {
+  bootstrapDashboard()
+}
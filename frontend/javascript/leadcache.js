@@ -0,0 +1,121 @@
+// Keep the user's leads in IndexedDB and only download what changed since the last visit
+// The server hands back a watermark with every sync, the next sync sends it to get the changes after it
+const LEAD_CACHE_NAME = "crm-lead-cache";
+const LEAD_CACHE_VERSION = 1;
+
+// Wrap an IndexedDB request in a promise
+function idbRequest(request) {
+  return new Promise((resolve, reject) => {
+    request.onsuccess = () => resolve(request.result);
+    request.onerror = () => reject(request.error);
+  });
+}
+
+// Resolve once a transaction has been written
+function idbDone(tx) {
+  return new Promise((resolve, reject) => {
+    tx.oncomplete = () => resolve();
+    tx.onerror = () => reject(tx.error);
+    tx.onabort = () => reject(tx.error);
+  });
+}
+
+// Open the cache, null when the browser has no IndexedDB (private windows in some browsers)
+let leadCachePromise = null;
+function openLeadCache() {
+  if (!leadCachePromise) {
+    leadCachePromise = new Promise((resolve) => {
+      if (!window.indexedDB) return resolve(null);
+
+      const request = indexedDB.open(LEAD_CACHE_NAME, LEAD_CACHE_VERSION);
+      request.onupgradeneeded = () => {
+        const db = request.result;
+        db.createObjectStore("leads", { keyPath: "id" });
+        db.createObjectStore("meta");
+      };
+      request.onsuccess = () => resolve(request.result);
+      request.onerror = () => resolve(null);
+      request.onblocked = () => resolve(null);
+    });
+  }
+  return leadCachePromise;
+}
+
+// Every cached lead, newest first like the server lists them
+async function readCachedLeads(db) {
+  const tx = db.transaction("leads", "readonly");
+  const leads = await idbRequest(tx.objectStore("leads").getAll());
+  return leads.sort((a, b) => b.id - a.id);
+}
+
+// The user the page was rendered for, the cache only ever holds this user's leads
+function leadCacheOwner() {
+  return document.body.dataset.userId || null;
+}
+
+// Forget every cached lead and the watermark, on logout and whenever the session is rejected
+async function clearLeadCache() {
+  const db = await openLeadCache();
+  if (!db) return;
+
+  const tx = db.transaction(["leads", "meta"], "readwrite");
+  tx.objectStore("leads").clear();
+  tx.objectStore("meta").clear();
+  await idbDone(tx);
+}
+
+// Apply one sync response, deletions go first so a lead that came back under the same id is kept
+async function applyLeadChanges(db, changes) {
+  const tx = db.transaction(["leads", "meta"], "readwrite");
+  const leads = tx.objectStore("leads");
+
+  if (changes.full) leads.clear();
+  changes.deleted.forEach((id) => leads.delete(id));
+  changes.leads.forEach((lead) => leads.put(lead));
+  tx.objectStore("meta").put(changes.watermark, "sync");
+  tx.objectStore("meta").put(leadCacheOwner(), "owner");
+
+  await idbDone(tx);
+}
+
+// The stored watermark, after wiping a cache left behind by another user on this browser
+async function readLeadWatermark(db) {
+  const meta = db.transaction("meta", "readonly").objectStore("meta");
+  const [owner, watermark] = await Promise.all([idbRequest(meta.get("owner")), idbRequest(meta.get("sync"))]);
+
+  if (!watermark) return null;
+  if (!owner || owner !== leadCacheOwner()) {
+    await clearLeadCache();
+    return null;
+  }
+  return watermark;
+}
+
+// Fetch changes since the stored watermark and return every lead
+async function syncLeads() {
+  const db = await openLeadCache();
+  const watermark = db ? await readLeadWatermark(db) : null;
+
+  let changes;
+  try {
+    const query = watermark ? `?since=${encodeURIComponent(watermark)}` : "";
+    const res = await fetch(`/api/leads/sync${query}`, {
+      method: "GET",
+      headers: { "Accept": "application/json" },
+      credentials: "same-origin"
+    });
+    if (res.status === 401) await clearLeadCache();
+    if (!res.ok) throw new Error(`Failed: ${res.status}`);
+    changes = await res.json();
+  } catch (err) {
+    // Offline (fetch itself failed), show what we had last time, anything the server answered is passed on
+    if (err instanceof TypeError && db && watermark) return readCachedLeads(db);
+    throw err;
+  }
+
+  // Without a cache the response has to be a full list to be any use
+  if (!db) return changes.leads;
+
+  await applyLeadChanges(db, changes);
+  return readCachedLeads(db);
+}
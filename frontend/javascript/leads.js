@@ -4,6 +4,12 @@ tbody.addEventListener("change", onLeadsPageTaskChange);
 tbody.addEventListener("change", onLeadsPageStageChange);
 tbody.addEventListener("click", rescheduleClick);
 
+// Export downloads straight from the server, which streams the file
+document.getElementById("export-leads-btn").addEventListener("click", () => {
+  const format = document.getElementById("export-format").value;
+  window.location.href = `/api/leads/export?format=${encodeURIComponent(format)}`;
+});
+
 // Before clicking, check in console:
 console.log(document.getElementById("leads-id").hidden); // Should be false
 console.log(document.querySelectorAll(".leads-page-reschedule-btn")); // Should 
@@ -12,17 +18,8 @@ console.log(document.querySelectorAll(".leads-page-reschedule-btn")); // Should
 async function loadLeadsPage() {
     console.log("loadLeadsPage called!");
 
-    // Send get request for leads from postgreSQL database
-    const res = await fetch("/api/getleads?source=leadpage", {
-    method: "GET",
-    headers: { "Accept": "application/json" },
-    credentials: "same-origin"
-  });
-
-  if (!res.ok) throw new Error(`Failed: ${res.status}`);
-
-  // Wait for data to store in variable
-  const data = await res.json();
+    // Bring the local lead cache up to date, only changed leads are downloaded
+  const data = { leads: await syncLeads() };
   const tbody = document.getElementById("leads-page-tbody");
   tbody.innerHTML = "";
 
@@ -34,6 +31,7 @@ async function loadLeadsPage() {
   // For each lead, create a row
   data.leads.forEach((lead) => {
     const tr = document.createElement("tr");
+    tr.dataset.version = lead.version;
 
     tr.innerHTML = `
       <td>${lead.im}</td>
@@ -80,6 +78,7 @@ async function rescheduleClick(e){
   const popup_dialog = document.getElementById("reschedule-dialog");
 
   popup_dialog.dataset.currentLeadId = leadId;
+  popup_dialog.dataset.currentLeadVersion = e.target.closest("tr").dataset.version;
   
   // Show the dialog
   popup_dialog.showModal();
@@ -96,16 +95,21 @@ document.getElementById('reschedule-form').addEventListener('submit', async (e)
 
   const modal_dialog = document.getElementById('reschedule-dialog');
   const leadId = modal_dialog.dataset.currentLeadId;
+  const version = Number(modal_dialog.dataset.currentLeadVersion);
   const newDateTime = document.getElementById('reschedule-date-input').value;
 
   // Call Rest API
-  await fetch(`/api/leads/${leadId}/reschedule`, {
+  const response = await fetch(`/api/leads/${leadId}/reschedule`, {
     method: 'PATCH',
     headers: {'Content-Type': 'application/json'},
     credentials: 'same-origin',
-    body: JSON.stringify({action_date:newDateTime})
+    body: JSON.stringify({action_date:newDateTime, version})
   });
 
+  if (response.status === 409) {
+    alert("This lead was changed somewhere else, showing the latest version.");
+  }
+
   // Close pop up modal and load leads again to reflect changes
   modal_dialog.close();
   loadLeadsPage()
@@ -147,9 +151,16 @@ async function onLeadsPageTaskChange(e) {
     method: "PATCH",
     headers: { "Content-Type": "application/json" },
     credentials: "same-origin",
-    body: JSON.stringify({ task: newTask })
+    body: JSON.stringify({ task: newTask, version: Number(e.target.closest("tr").dataset.version) })
   });
 
+  // Someone else edited the lead first, reload so the user sees their change
+  if (response.status === 409) {
+    alert("This lead was changed somewhere else, showing the latest version.");
+    await loadLeadsPage();
+    return;
+  }
+
   console.log("Update response:", response.status);
   
   // Wait for response before loading leads page to see updated lead
@@ -175,8 +186,15 @@ async function onLeadsPageStageChange(e) {
     method: "PATCH",
     headers: { "Content-Type": "application/json" },
     credentials: "same-origin",
-    body: JSON.stringify({ stage: newStage })
+    body: JSON.stringify({ stage: newStage, version: Number(e.target.closest("tr").dataset.version) })
   });
+
+  // Someone else edited the lead first, reload so the user sees their change
+  if (response.status === 409) {
+    alert("This lead was changed somewhere else, showing the latest version.");
+    await loadLeadsPage();
+    return;
+  }
   // Wait for response before loading leads page to see updated lead
   if (response.ok) {
     await loadLeadsPage();
@@ -0,0 +1,31 @@
+import multiprocessing
+import os
+
+# Production server profile: gunicorn -c gunicorn.conf.py app:app
+# Gunicorn keeps WEB_CONCURRENCY uvicorn workers running and restarts any that die
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8080')}"
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+worker_class = "uvicorn_worker.UvicornWorker"
+
+# app.py sizes its connection pools and picks its caches from this, so it has to match the real worker count
+os.environ["WEB_CONCURRENCY"] = str(workers)
+
+# Proxies trusted to set X-Forwarded-For: Cloud Run's proxy and Google's front end ranges
+# The client is the last address in the header that isn't one of them, app.py reads the same list
+forwarded_allow_ips = os.environ.setdefault("FORWARDED_ALLOW_IPS", "127.0.0.1,169.254.0.0/16,35.191.0.0/16,130.211.0.0/22")
+
+# Each worker imports the app itself, so its pools and clients are never shared across a fork
+preload_app = False
+
+# Workers get this long to finish running requests on shutdown or restart
+graceful_timeout = int(os.getenv("GRACEFUL_TIMEOUT", "30"))
+timeout = int(os.getenv("WORKER_TIMEOUT", "60"))
+keepalive = 5
+
+# Recycle workers now and then so slow leaks can't build up, with jitter so they don't all restart together
+max_requests = int(os.getenv("MAX_REQUESTS", "2000"))
+max_requests_jitter = 200
+
+accesslog = "-"
+errorlog = "-"
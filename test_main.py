@@ -1,8 +1,23 @@
 from fastapi.testclient import TestClient
+from starlette.requests import Request
 from argon2 import PasswordHasher
-from app import app, database
+from app import app, database, activity_log, asset_url, MemoryTokenBuckets, coalesce, ship_outbox_batch
+from app import ReminderScheduler, FileReminderNotifier, reminder_time
+from app import MemoryCache, RedisCache, company_key
+from app import compact_legacy_activity, render_activity
+import app as crm_app
 import sqlalchemy
-from datetime import date
+import pytest
+import asyncio
+import time
+import json
+import io
+import gzip
+import zipfile
+import numpy as np
+import httpx
+from conftest import fake_email_validator
+from datetime import date, datetime, timedelta, timezone
 
 
 client = TestClient(app)
@@ -288,4 +303,1360 @@ def test_get_leads():
     response = client.get('/api/getleads')
     
     assert response.status_code == 200
-    
\ No newline at end of file
+    
+
+# Test the dashboard bootstrap returns leads, metrics and activity in one response
+def test_dashboard_bootstrap():
+    # Create test user
+    test_username = 'testbootstrapuser'
+    testpass = 'testbootstrappass'
+    
+    # Delete previous users
+    with database.begin() as conn:
+        conn.execute(
+            sqlalchemy.text("DELETE FROM users WHERE username = :username"),
+            {"username": test_username}
+        )
+        
+    # Register user
+    response = client.post('/register',
+        data={"user_name": test_username, "password": testpass},
+        follow_redirects=False
+    )
+    assert response.status_code == 303
+    
+    # Get session id
+    session_id = response.cookies.get("id")
+    client.cookies.set("id", session_id)
+    
+    # Ship queued activity to MongoDB like the background relay would
+    ship_outbox_batch()
+    
+    response = client.get('/api/dashboard/bootstrap')
+    
+    # Test
+    assert response.status_code == 200
+    data = response.json()
+    assert data["ok"] is True
+    assert data["leads"] == []
+    assert data["metrics"] == {"tasks_status": 0, "tasks_due_count": 0, "tasks_open": 0}
+    
+    # Registering is logged so the activity should contain it
+    assert any("registered" in log["details"] for log in data["activity_log"])
+    
+    # Delete test user
+    with database.begin() as conn:
+        conn.execute(
+            sqlalchemy.text("DELETE FROM users WHERE username = :username"),
+            {"username": test_username}
+        )
+        
+        
+# Test the server rendered dashboard and that a new lead clears the cached fragments
+def test_dashboard_server_rendered():
+    # Create test user
+    test_username = 'testrenderuser'
+    testpass = 'testrenderpass'
+    
+    # Delete previous users
+    with database.begin() as conn:
+        conn.execute(
+            sqlalchemy.text("DELETE FROM users WHERE username = :username"),
+            {"username": test_username}
+        )
+        
+    # Register user
+    response = client.post('/register',
+        data={"user_name": test_username, "password": testpass},
+        follow_redirects=False
+    )
+    assert response.status_code == 303
+    
+    # Get session id
+    session_id = response.cookies.get("id")
+    client.cookies.set("id", session_id)
+    
+    # First render has no leads
+    response = client.get('/dashboard?render=server')
+    assert response.status_code == 200
+    assert "data-server-rendered" in response.text
+    assert "rendered corp" not in response.text
+    
+    # The page names its user so the browser's lead cache can tell whose leads it holds
+    with database.connect() as conn:
+        user_id = conn.execute(
+            sqlalchemy.text("SELECT id FROM users WHERE username = :username"),
+            {"username": test_username},
+        ).scalar()
+    assert f'data-user-id="{user_id}"' in response.text
+    assert f'data-user-id="{user_id}"' in client.get('/dashboard?render=client').text
+    
+    # Add a lead due today
+    exampleLead = {
+        "im": 'rendertest',
+        "company_name": 'rendered corp',
+        "agent_name": 'John',
+        'email': 'john@gmail.com',
+        'task': 'contact',
+        'date': date.today().isoformat()
+    }
+    response = client.post('/api/leads', json=exampleLead)
+    assert response.status_code == 200
+    
+    # Cached fragments should have been thrown away so the lead shows up
+    response = client.get('/dashboard?render=server')
+    assert "rendered corp" in response.text
+    assert 'id="open-leads-count">1<' in response.text
+    
+    # Delete lead and test user
+    with database.begin() as conn:
+        conn.execute(
+            sqlalchemy.text("DELETE FROM leads WHERE im = :im"),
+            {'im': exampleLead['im']}
+        )
+        conn.execute(
+            sqlalchemy.text("DELETE FROM users WHERE username = :username"),
+            {"username": test_username}
+        )
+
+
+# Test that editing a lead with an out of date version is rejected with the current lead
+def test_lead_version_conflict():
+    # Create test user
+    test_username = 'testversionuser'
+    testpass = 'testversionpass'
+    
+    # Delete previous users
+    with database.begin() as conn:
+        conn.execute(
+            sqlalchemy.text("DELETE FROM users WHERE username = :username"),
+            {"username": test_username}
+        )
+        
+    # Register user
+    response = client.post('/register',
+        data={"user_name": test_username, "password": testpass},
+        follow_redirects=False
+    )
+    assert response.status_code == 303
+    
+    # Get session id
+    session_id = response.cookies.get("id")
+    client.cookies.set("id", session_id)
+    
+    # Add a lead
+    exampleLead = {
+        "im": 'versiontest',
+        "company_name": 'version corp',
+        "agent_name": 'John',
+        'email': 'john@gmail.com',
+        'task': 'contact',
+        'date': date.today().isoformat()
+    }
+    lead_id = client.post('/api/leads', json=exampleLead).json()["id"]
+    
+    # Get the version the lead was created with
+    lead = client.get('/api/getleads?source=leadpage').json()["leads"][0]
+    version = lead["version"]
+    
+    # First edit with the current version works and bumps it
+    response = client.patch(f'/api/leads/{lead_id}/task', json={"task": "reply", "version": version})
+    assert response.status_code == 200
+    assert response.json()["version"] == version + 1
+    
+    # Second edit from a tab still holding the old version is rejected
+    response = client.patch(f'/api/leads/{lead_id}/stage', json={"stage": "Won", "version": version})
+    assert response.status_code == 409
+    assert response.json()["lead"]["task"] == "reply"
+    assert response.json()["lead"]["stage"] != "Won"
+    assert response.json()["lead"]["version"] == version + 1
+    
+    # The activity log records the value each edit replaced, not the new one
+    assert client.patch(f'/api/leads/{lead_id}/stage', json={"stage": "Won", "version": version + 1}).status_code == 200
+    assert client.patch(f'/api/leads/{lead_id}/reschedule', json={"action_date": "2030-01-01"}).status_code == 200
+    assert client.patch(f'/api/leads/{lead_id}/reschedule', json={"action_date": "2030-02-01"}).status_code == 200
+    ship_outbox_batch()
+    details = [log["details"] for log in client.get('/api/activity').json()["activity_log"]]
+    assert "User updated lead version corp task from contact to reply" in details
+    assert "User updated lead version corp stage from new to Won" in details
+    assert f"User rescheduled lead: version corp from {date.today().isoformat()} to 2030-01-01" in details
+    assert "User rescheduled lead: version corp from 2030-01-01 to 2030-02-01" in details
+    
+    # Delete lead and test user
+    with database.begin() as conn:
+        conn.execute(
+            sqlalchemy.text("DELETE FROM leads WHERE im = :im"),
+            {'im': exampleLead['im']}
+        )
+        conn.execute(
+            sqlalchemy.text("DELETE FROM users WHERE username = :username"),
+            {"username": test_username}
+        )
+
+
+# Test frontend files are linked through the asset manifest and served with caching headers
+def test_static_assets():
+    response = client.get('/login')
+    assert response.status_code == 200
+    
+    # Find the stylesheet the login page links to, hashed if the build has run
+    stylesheet = asset_url('styles/loginStyles.css')
+    assert stylesheet in response.text
+    
+    response = client.get(stylesheet, headers={"Accept-Encoding": "gzip"})
+    assert response.status_code == 200
+    assert response.headers["vary"] == "Accept-Encoding"
+    
+    # Hashed files never change, plain files have to be revalidated
+    if "/dist/" in stylesheet:
+        assert "immutable" in response.headers["cache-control"]
+    else:
+        assert response.headers["cache-control"] == "no-cache"
+    
+    # Asking again with the etag should not send the file again
+    response = client.get(stylesheet, headers={"Accept-Encoding": "gzip", "If-None-Match": response.headers["etag"]})
+    assert response.status_code == 304
+
+
+# Test the token bucket lets a burst through then makes the client wait
+def test_token_bucket_rate_limit():
+    buckets = MemoryTokenBuckets()
+    
+    # Bucket of 3 that refills one token a second
+    assert [buckets.take("test", 1, 3) for _ in range(3)] == [0, 0, 0]
+    wait = buckets.take("test", 1, 3)
+    assert 0 < wait <= 1
+    
+    # Other clients have their own bucket
+    assert buckets.take("other", 1, 3) == 0
+
+
+# Test a client can't get around the login limit by sending a new session cookie each time
+def test_login_rate_limit_ignores_cookies(monkeypatch):
+    statuses = []
+    for n in range(6):
+        client.cookies.set("id", f"made-up-{n}")
+        response = client.post('/login',
+            data={"user_name": 'nobody', "password": 'wrong'},
+            follow_redirects=False
+        )
+        statuses.append(response.status_code)
+    assert statuses[-1] == 429
+    assert 429 not in statuses[:5]
+    
+    # Made up sessions are turned away before the email validator is called
+    validations = []
+    monkeypatch.setattr(crm_app, "email_validator_client", lambda: httpx.AsyncClient(transport=httpx.MockTransport(lambda request: validations.append(request))))
+    response = client.post('/api/leads', json={"email": 'john@gmail.com'})
+    assert response.status_code == 401
+    assert validations == []
+
+
+# Test clients behind the proxy get their own login bucket, keyed on the forwarded address and the account
+def test_login_rate_limit_per_forwarded_client():
+    def attempt(forwarded_for, user_name='sharedlogin'):
+        return client.post('/login',
+            data={"user_name": user_name, "password": 'wrong'},
+            headers={"X-Forwarded-For": forwarded_for},
+            follow_redirects=False
+        ).status_code
+    
+    assert [attempt('203.0.113.1') for _ in range(5)] == [400] * 5
+    assert attempt('203.0.113.1') == 429
+    
+    # A made up address in front of the real one doesn't start a new bucket
+    assert attempt('198.51.100.7, 203.0.113.1') == 429
+    
+    # Someone else behind the same proxy can still log in, and the same client can try another account
+    assert attempt('203.0.113.2') == 400
+    assert attempt('203.0.113.1', 'otherlogin') == 400
+
+
+# Test identical concurrent reads share one call
+def test_coalesce_shares_one_query():
+    calls = []
+    
+    def slow_query(user_id):
+        calls.append(user_id)
+        time.sleep(0.1)
+        return {"user_id": user_id}
+    
+    async def run():
+        return await asyncio.gather(*[coalesce(("test", 1), slow_query, 1) for _ in range(5)])
+    
+    results = asyncio.run(run())
+    
+    # Every caller gets the result of the single query
+    assert calls == [1]
+    assert results == [{"user_id": 1}] * 5
+
+
+
+# Test activity waits in the outbox until the relay ships it, and shipping twice doesn't duplicate it
+def test_activity_outbox_relay():
+    # Create test user
+    test_username = 'testoutboxuser'
+    testpass = 'testoutboxpass'
+    
+    # Delete previous users
+    with database.begin() as conn:
+        conn.execute(
+            sqlalchemy.text("DELETE FROM users WHERE username = :username"),
+            {"username": test_username}
+        )
+        
+    # Register user, which logs an activity
+    response = client.post('/register',
+        data={"user_name": test_username, "password": testpass},
+        follow_redirects=False
+    )
+    assert response.status_code == 303
+    
+    # The activity is in the outbox as part of the registration transaction
+    with database.begin() as conn:
+        user_id = conn.execute(
+            sqlalchemy.text("SELECT id FROM users WHERE username = :username"),
+            {"username": test_username}
+        ).scalar()
+        outbox_id = conn.execute(
+            sqlalchemy.text("SELECT MAX(id) FROM activity_outbox WHERE shipped_at IS NULL"),
+        ).scalar()
+        assert outbox_id is not None
+    
+    # Only admins see the relay's backlog, which covers every user
+    client.cookies.set("id", response.cookies.get("id"))
+    assert client.get('/api/activity/outbox').status_code == 403
+    with database.begin() as conn:
+        conn.execute(sqlalchemy.text("UPDATE users SET role = 'admin' WHERE id = :id"), {"id": user_id})
+    crm_app.cache.delete(f"role:{user_id}")
+    lag = client.get('/api/activity/outbox')
+    assert lag.status_code == 200
+    assert lag.json()["pending"] >= 1
+    assert lag.json()["lag_seconds"] >= 0
+    
+    # Ship everything waiting
+    while ship_outbox_batch():
+        pass
+    
+    assert activity_log.count_documents({"u": user_id, "e": "register"}) == 1
+    
+    # Replaying the row delivers nothing new
+    with database.begin() as conn:
+        conn.execute(
+            sqlalchemy.text("UPDATE activity_outbox SET shipped_at = NULL WHERE id = :id"),
+            {"id": outbox_id}
+        )
+    ship_outbox_batch()
+    
+    assert activity_log.count_documents({"u": user_id, "e": "register"}) == 1
+    
+    # Delete test user
+    with database.begin() as conn:
+        conn.execute(
+            sqlalchemy.text("DELETE FROM users WHERE username = :username"),
+            {"username": test_username}
+        )
+
+
+# Test reminders come off the heaps in time order and moved leads don't fire at their old time
+def test_reminder_scheduler_order():
+    scheduler = ReminderScheduler()
+    now = datetime.now(timezone.utc)
+    
+    scheduler.schedule(1, 10, now - timedelta(minutes=2), "due")
+    scheduler.schedule(2, 10, now + timedelta(hours=1), "due")
+    scheduler.schedule(3, 20, now - timedelta(minutes=1), "due")
+    scheduler.schedule(4, 20, now - timedelta(minutes=3), "overdue")
+    
+    # Lead 1 is rescheduled before it fires and lead 4 is completed
+    scheduler.schedule(1, 10, now + timedelta(hours=2), "due")
+    scheduler.unschedule(4)
+    
+    due = scheduler.pop_due(now)
+    assert [(user_id, lead_id) for user_id, lead_id, _, _ in due] == [(20, 3)]
+    
+    # Next wake up is lead 2 in an hour
+    assert 3500 < scheduler.seconds_until_next(now) <= 3600
+    assert scheduler.pop_due(now + timedelta(hours=3)) == [
+        (10, 2, now + timedelta(hours=1), "due"),
+        (10, 1, now + timedelta(hours=2), "due"),
+    ]
+
+
+# Test a due reminder is logged, sent to the notifier and followed by an overdue reminder
+def test_reminder_fire(tmp_path):
+    # Create test user
+    test_username = 'testreminderuser'
+    testpass = 'testreminderpass'
+    
+    # Delete previous users
+    with database.begin() as conn:
+        conn.execute(
+            sqlalchemy.text("DELETE FROM users WHERE username = :username"),
+            {"username": test_username}
+        )
+    
+    # Insert a user and an open lead due today
+    with database.begin() as conn:
+        user_id = conn.execute(
+            sqlalchemy.text("INSERT INTO users (username, password_hash, role) VALUES (:username, :password_hash, 'rep') RETURNING id"),
+            {"username": test_username, "password_hash": ph.hash(testpass)}
+        ).scalar()
+        lead_id = conn.execute(
+            sqlalchemy.text("""INSERT INTO leads (user_id, im, company_name, agent_name, email, task, action_date)
+                            VALUES (:user_id, 'remindertest', 'reminder corp', 'John', 'john@gmail.com', 'contact', :action_date)
+                            RETURNING id"""),
+            {"user_id": user_id, "action_date": date.today().isoformat()}
+        ).scalar()
+    
+    notifications = tmp_path / "reminders.log"
+    scheduler = ReminderScheduler(FileReminderNotifier(str(notifications)))
+    scheduler.fire(user_id, lead_id, reminder_time(date.today(), "due"), "due")
+    
+    # Reminder was sent and an overdue one is queued for tomorrow
+    sent = [json.loads(line) for line in notifications.read_text().splitlines()]
+    assert [(r["lead_id"], r["kind"], r["company_name"]) for r in sent] == [(lead_id, "due", "reminder corp")]
+    assert scheduler.pending[lead_id] == (reminder_time(date.today(), "overdue"), "overdue")
+    
+    # A reminder for a date the lead is no longer on does nothing
+    scheduler.fire(user_id, lead_id, reminder_time(date.today() - timedelta(days=3), "due"), "due")
+    assert len(notifications.read_text().splitlines()) == 1
+    
+    # Delete lead and test user
+    with database.begin() as conn:
+        conn.execute(
+            sqlalchemy.text("DELETE FROM leads WHERE im = 'remindertest'")
+        )
+        conn.execute(
+            sqlalchemy.text("DELETE FROM users WHERE username = :username"),
+            {"username": test_username}
+        )
+
+
+# Test the reminder leader picks up leads changed elsewhere from their updated_at instead of reloading every lead
+def test_reminder_changes():
+    scheduler = ReminderScheduler()
+    since = scheduler.load()
+    
+    response = client.post('/register',
+        data={"user_name": 'testreminderchangesuser', "password": 'testreminderchangespass'},
+        follow_redirects=False
+    )
+    assert response.status_code == 303
+    client.cookies.set("id", response.cookies.get("id"))
+    
+    tomorrow = date.today() + timedelta(days=1)
+    lead_ids = []
+    for company_name in ('changes a', 'changes b'):
+        response = client.post('/api/leads', json={
+            "im": 'reminderchanges',
+            "company_name": company_name,
+            "agent_name": 'John',
+            'email': f'{company_name.replace(" ", "")}@gmail.com',
+            'task': 'contact',
+            'date': tomorrow.isoformat(),
+        })
+        lead_ids.append(response.json()["id"])
+    
+    # A lead can be saved without an action date, it just never gets a reminder
+    response = client.post('/api/leads', json={
+        "im": 'reminderchanges',
+        "company_name": 'changes undated',
+        "agent_name": 'John',
+        'email': 'undated@gmail.com',
+        'task': 'contact',
+        'date': None,
+    })
+    assert response.status_code == 200
+    undated_id = response.json()["id"]
+    
+    # This worker isn't running the reminder loop, so requests leave its heaps alone
+    assert crm_app.reminders.loop is None
+    assert crm_app.reminders.heaps == {}
+    assert crm_app.reminders.pending == {}
+    
+    since = scheduler.load_changes(since)
+    assert scheduler.pending[lead_ids[0]] == (reminder_time(tomorrow, "due"), "due")
+    assert undated_id not in scheduler.pending
+    scheduler.schedule_lead(undated_id, 1, None)
+    assert undated_id not in scheduler.pending
+    assert lead_ids[1] in scheduler.pending
+    
+    # Completed and deleted leads are dropped
+    assert client.post(f'/api/leads/{lead_ids[0]}/complete').status_code == 200
+    assert client.delete(f'/api/leads/{lead_ids[1]}/delete').status_code == 200
+    scheduler.load_changes(since)
+    assert lead_ids[0] not in scheduler.pending
+    assert lead_ids[1] not in scheduler.pending
+
+
+# Test reads go to the replica unless the user has just changed something
+def test_read_replica_routing(monkeypatch):
+    replica = sqlalchemy.create_engine("sqlite://")
+    monkeypatch.setattr(crm_app, "read_database", replica)
+    
+    # Users who haven't written anything read from the replica
+    assert crm_app.reader_for(None, 900001) is replica
+    
+    # Straight after a change, reads stick to the primary
+    crm_app.on_lead_mutation(900001)
+    assert crm_app.reader_for(None, 900001) is database
+    
+    # A write handled by another worker is carried by the browser's cookie
+    request = Request({"type": "http", "headers": [(b"cookie", f"last_write={time.time()}".encode())]})
+    assert crm_app.reader_for(request, 900002) is database
+    
+    # Once the window has passed the replica is used again
+    old_request = Request({"type": "http", "headers": [(b"cookie", f"last_write={time.time() - 60}".encode())]})
+    assert crm_app.reader_for(old_request, 900002) is replica
+
+
+# Test both cache backends behave the same, Redis is stood in for by fakeredis
+def test_cache_backends():
+    fakeredis = pytest.importorskip("fakeredis")
+    
+    for cache in (MemoryCache(max_keys=2), RedisCache(fakeredis.FakeRedis())):
+        assert cache.get("missing") is None
+        
+        cache.set("metrics", {"tasks_open": 3}, 60)
+        assert cache.get("metrics") == {"tasks_open": 3}
+        
+        # add only sets keys that aren't there
+        assert cache.add("metrics", {"tasks_open": 4}, 60) is False
+        assert cache.add("session", 7, 60) is True
+        assert cache.get("session") == 7
+        
+        cache.delete("session")
+        assert cache.get("session") is None
+        
+        # Expired entries are gone
+        cache.set("short", 1, 0.01)
+        time.sleep(0.05)
+        assert cache.get("short") is None
+    
+    # The memory cache drops the oldest entries past its size
+    cache = MemoryCache(max_keys=2)
+    for key in ("a", "b", "c"):
+        cache.set(key, key, 60)
+    assert cache.get("a") is None
+    assert cache.get("c") == "c"
+
+
+# Test lead lists are revalidated with an ETag until the user's leads change
+def test_getleads_etag():
+    test_username = 'testetaguser'
+    testpass = 'testetagpass'
+    
+    # Delete previous users
+    with database.begin() as conn:
+        conn.execute(
+            sqlalchemy.text("DELETE FROM users WHERE username = :username"),
+            {"username": test_username}
+        )
+    
+    # Register user
+    response = client.post('/register',
+        data={"user_name": test_username, "password": testpass},
+        follow_redirects=False
+    )
+    assert response.status_code == 303
+    client.cookies.set("id", response.cookies.get("id"))
+    
+    response = client.get('/api/getleads')
+    assert response.status_code == 200
+    etag = response.headers["etag"]
+    
+    # Nothing has changed so the browser's copy is still good
+    response = client.get('/api/getleads', headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    
+    # A new lead gives a new ETag
+    exampleLead = {
+        "im": 'etagtest',
+        "company_name": 'etag corp',
+        "agent_name": 'John',
+        'email': 'john@gmail.com',
+        'task': 'contact',
+        'date': date.today().isoformat()
+    }
+    response = client.post('/api/leads', json=exampleLead)
+    assert response.status_code == 200
+    
+    response = client.get('/api/getleads', headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["etag"] != etag
+    assert response.json()["leads"][0]["company_name"] == 'etag corp'
+    
+    # Delete lead and test user
+    with database.begin() as conn:
+        conn.execute(
+            sqlalchemy.text("DELETE FROM leads WHERE im = :im"),
+            {'im': exampleLead['im']}
+        )
+        conn.execute(
+            sqlalchemy.text("DELETE FROM users WHERE username = :username"),
+            {"username": test_username}
+        )
+
+
+# Test leads download as csv, gzipped jsonl and xlsx
+def test_lead_export():
+    test_username = 'testexportuser'
+    testpass = 'testexportpass'
+    
+    # Delete previous users
+    with database.begin() as conn:
+        conn.execute(
+            sqlalchemy.text("DELETE FROM users WHERE username = :username"),
+            {"username": test_username}
+        )
+    
+    # Register user
+    response = client.post('/register',
+        data={"user_name": test_username, "password": testpass},
+        follow_redirects=False
+    )
+    assert response.status_code == 303
+    client.cookies.set("id", response.cookies.get("id"))
+    
+    exampleLead = {
+        "im": 'exporttest',
+        "company_name": '=export corp',
+        "agent_name": 'John',
+        'email': 'john@gmail.com',
+        'task': 'contact',
+        'date': date.today().isoformat()
+    }
+    response = client.post('/api/leads', json=exampleLead)
+    assert response.status_code == 200
+    
+    # Csv has a header and the lead, with the formula-like name made safe
+    response = client.get('/api/leads/export?format=csv')
+    assert response.status_code == 200
+    assert "attachment" in response.headers["content-disposition"]
+    lines = response.content.decode("utf-8-sig").splitlines()
+    assert lines[0].startswith("id,im,company_name")
+    assert "'=export corp" in lines[1]
+    
+    # Gzipped jsonl
+    response = client.get('/api/leads/export?format=jsonl&gzip=1')
+    assert response.headers["content-type"] == "application/gzip"
+    row = json.loads(gzip.decompress(response.content).splitlines()[0])
+    assert row["company_name"] == '=export corp'
+    
+    # Xlsx opens as a zip with the lead in the sheet
+    response = client.get('/api/leads/export?format=xlsx')
+    workbook = zipfile.ZipFile(io.BytesIO(response.content))
+    assert "export corp" in workbook.read("xl/worksheets/sheet1.xml").decode()
+    
+    assert client.get('/api/leads/export?format=pdf').status_code == 400
+    
+    # Delete lead and test user
+    with database.begin() as conn:
+        conn.execute(
+            sqlalchemy.text("DELETE FROM leads WHERE im = :im"),
+            {'im': exampleLead['im']}
+        )
+        conn.execute(
+            sqlalchemy.text("DELETE FROM users WHERE username = :username"),
+            {"username": test_username}
+        )
+
+
+# Test company names that differ only in case, punctuation or legal form get the same key
+def test_company_key():
+    assert company_key("Acme Ltd") == "acme"
+    assert company_key("ACME Limited.") == "acme"
+    assert company_key("The Acme Co.") == "acme"
+    assert company_key("Société Générale S.A.") == "societe generale"
+    assert company_key("M&A Partners LLP") == "m and a partners"
+    assert company_key("Acme Capital") != company_key("Acme")
+
+
+# Test creating or importing a lead that is already there is caught
+def test_duplicate_leads():
+    test_username = 'testdedupuser'
+    testpass = 'testdeduppass'
+    
+    # Delete previous users
+    with database.begin() as conn:
+        conn.execute(
+            sqlalchemy.text("DELETE FROM users WHERE username = :username"),
+            {"username": test_username}
+        )
+    
+    # Register user
+    response = client.post('/register',
+        data={"user_name": test_username, "password": testpass},
+        follow_redirects=False
+    )
+    assert response.status_code == 303
+    client.cookies.set("id", response.cookies.get("id"))
+    
+    exampleLead = {
+        "im": 'deduptest',
+        "company_name": 'Dedup Holdings Ltd',
+        "agent_name": 'John',
+        'email': 'dedup@gmail.com',
+        'task': 'contact',
+        'date': date.today().isoformat()
+    }
+    assert client.post('/api/leads', json=exampleLead).status_code == 200
+    
+    # Same company spelt differently
+    response = client.post('/api/leads', json={**exampleLead, "company_name": 'DEDUP HOLDINGS LIMITED', "email": 'other@gmail.com'})
+    assert response.status_code == 409
+    assert response.json()["duplicate"]["company_name"] == 'Dedup Holdings Ltd'
+    
+    # Saved anyway when the user says so
+    response = client.post('/api/leads', json={**exampleLead, "company_name": 'Dedup Holdings plc', "allow_duplicate": True})
+    assert response.status_code == 200
+    
+    # Import skips the existing company and the repeat inside the import
+    response = client.post('/api/leads/import', json={"leads": [
+        {**exampleLead, "company_name": 'Dedup Holdings', "email": 'third@gmail.com'},
+        {**exampleLead, "company_name": 'New Target', "email": 'new@gmail.com'},
+        {**exampleLead, "company_name": 'New Target Inc', "email": 'new2@gmail.com'},
+    ]})
+    assert response.status_code == 200
+    data = response.json()
+    assert data["imported"] == 1
+    assert [row["index"] for row in data["skipped"]] == [0, 2]
+    
+    # Delete leads and test user
+    with database.begin() as conn:
+        conn.execute(
+            sqlalchemy.text("DELETE FROM leads WHERE im = :im"),
+            {'im': exampleLead['im']}
+        )
+        conn.execute(
+            sqlalchemy.text("DELETE FROM users WHERE username = :username"),
+            {"username": test_username}
+        )
+
+
+# Test the dashboard's open lead and metrics queries are answered from their partial indexes
+def test_open_lead_queries_use_partial_indexes():
+    # Mostly finished leads, like a real pipeline, so the planner has statistics showing the partial indexes are the small ones
+    with database.begin() as conn:
+        user_id = conn.execute(
+            sqlalchemy.text("INSERT INTO users (username, password_hash, role) VALUES ('testplanuser', 'x', 'rep') RETURNING id")
+        ).scalar()
+        conn.execute(
+            sqlalchemy.text("""
+                INSERT INTO leads (user_id, im, company_name, task, action_date, stage, task_status)
+                VALUES (:user_id, 'plantest', :company_name, 'contact', :action_date, :stage, :task_status)
+            """),
+            [
+                {
+                    "user_id": user_id,
+                    "company_name": f'plan corp {i}',
+                    "action_date": date.today(),
+                    "stage": "new" if i < 5 else "Won",
+                    "task_status": None if i < 5 else "done",
+                }
+                for i in range(500)
+            ]
+        )
+        conn.execute(sqlalchemy.text("ANALYZE"))
+    
+    with database.connect() as conn:
+        if database.dialect.name == "postgresql":
+            # The test database is tiny, so stop the planner preferring a full scan
+            conn.execute(sqlalchemy.text("SET LOCAL enable_seqscan = off"))
+            explain = "EXPLAIN "
+        else:
+            explain = "EXPLAIN QUERY PLAN "
+        
+        # Both open lead indexes share the predicate, either answers the open lead list
+        for sql, indexes in (
+            (crm_app.OPEN_LEADS_SQL, ("leads_open_tasks_idx", "leads_open_priority_idx")),
+            (crm_app.LEAD_METRICS_SQL, ("leads_active_stage_idx",)),
+            (crm_app.CALENDAR_SQL, ("leads_active_stage_idx",)),
+            (crm_app.TOP_LEADS_SQL, ("leads_open_priority_idx",)),
+        ):
+            params = {"user_id": user_id, "limit": 20, "per_day": 10, "start": date.today(), "end": date.today() + timedelta(days=30)}
+            plan = "\n".join(str(row[-1]) for row in conn.execute(sqlalchemy.text(explain + sql), params))
+            assert any(index in plan for index in indexes)
+        
+        # Top leads come out of the index already in order
+        assert "TEMP B-TREE" not in plan and "Sort" not in plan
+
+
+# Test old activity documents become compact ones that still show the same text
+def test_compact_activity_documents():
+    timestamp = datetime(2026, 10, 19, 9, 30)
+    for details in [
+        "User 5 logged in",
+        "User updated lead Acme task from contact to reply",
+        "User rescheduled lead: Acme from 2026-10-01 to 2026-10-08",
+        "Reminder: contact Acme Corp is overdue since 2026-10-01",
+        "Something the parser has never seen",
+    ]:
+        legacy = {"user_id": 5, "time": "09:30:00", "date": "10/19/26", "details": details, "timestamp": timestamp}
+        compact = compact_legacy_activity(legacy)
+        
+        assert compact["v"] == 2
+        assert "details" not in compact
+        assert len(json.dumps(compact, default=str)) < len(json.dumps(legacy, default=str))
+        assert render_activity(compact)["details"] == details
+        assert render_activity(compact)["time"] == timestamp.strftime("%X")
+    
+    compact = compact_legacy_activity({"user_id": 5, "details": "User updated lead Acme stage from new to Won", "timestamp": timestamp})
+    assert (compact["e"], compact["c"], compact["b"], compact["a"]) == ("lead_stage", "Acme", "new", "Won")
+    
+    # tools/migrate.py indexes the compact fields activity is read by
+    assert activity_log.index_information()["u_1_t_-1"]["key"] == [("u", 1), ("t", -1)]
+    
+    # Documents nobody has migrated yet still show up in the feed, in time order with the compact ones
+    activity_log.insert_many([
+        {"user_id": 5, "time": "09:00:00", "date": "10/19/26", "details": "User 5 logged in", "timestamp": datetime(2026, 10, 19, 9, 0)},
+        {"v": 2, "u": 5, "e": "logout", "t": datetime(2026, 10, 19, 9, 15)},
+        {"user_id": 5, "time": "09:45:00", "date": "10/19/26", "details": "User 5 logged out", "timestamp": datetime(2026, 10, 19, 9, 45)},
+        {"user_id": 6, "time": "09:50:00", "date": "10/19/26", "details": "User 6 logged in", "timestamp": datetime(2026, 10, 19, 9, 50)},
+    ])
+    assert [entry["details"] for entry in crm_app.fetch_activity(5)] == ["User 5 logged in", "User 5 logged out", "User 5 logged out"]
+    assert [entry["time"] for entry in crm_app.fetch_activity(5, limit=2)] == ["09:15:00", "09:45:00"]
+
+
+# Test the lead cache sync sends everything once, then only changes and deletions
+def test_lead_sync():
+    test_username = 'testsyncuser'
+    testpass = 'testsyncpass'
+    
+    # Delete previous users
+    with database.begin() as conn:
+        conn.execute(
+            sqlalchemy.text("DELETE FROM users WHERE username = :username"),
+            {"username": test_username}
+        )
+    
+    # Register user
+    response = client.post('/register',
+        data={"user_name": test_username, "password": testpass},
+        follow_redirects=False
+    )
+    assert response.status_code == 303
+    client.cookies.set("id", response.cookies.get("id"))
+    
+    exampleLead = {
+        "im": 'synctest',
+        "company_name": 'sync corp',
+        "agent_name": 'John',
+        'email': 'john@gmail.com',
+        'task': 'contact',
+        'date': date.today().isoformat()
+    }
+    kept_id = client.post('/api/leads', json=exampleLead).json()["id"]
+    deleted_id = client.post('/api/leads', json={**exampleLead, "company_name": 'sync deleted corp', "allow_duplicate": True}).json()["id"]
+    
+    # First sync has no watermark so every lead comes back
+    response = client.get('/api/leads/sync')
+    assert response.status_code == 200
+    first = response.json()
+    assert first["full"] is True
+    assert {lead["id"] for lead in first["leads"]} == {kept_id, deleted_id}
+    
+    # Edit one lead and delete the other
+    version = next(lead["version"] for lead in first["leads"] if lead["id"] == kept_id)
+    assert client.patch(f'/api/leads/{kept_id}/task', json={"task": "reply", "version": version}).status_code == 200
+    assert client.delete(f'/api/leads/{deleted_id}/delete').status_code == 200
+    
+    response = client.get('/api/leads/sync', params={"since": first["watermark"]})
+    delta = response.json()
+    assert delta["full"] is False
+    assert [lead["task"] for lead in delta["leads"] if lead["id"] == kept_id] == ["reply"]
+    assert deleted_id not in {lead["id"] for lead in delta["leads"]}
+    assert deleted_id in delta["deleted"]
+    
+    # A watermark belonging to someone else starts over
+    response = client.get('/api/leads/sync', params={"since": "0:" + first["watermark"].partition(":")[2]})
+    assert response.json()["full"] is True
+    
+    # So does one without a time zone
+    owner = first["watermark"].partition(":")[0]
+    response = client.get('/api/leads/sync', params={"since": f"{owner}:2026-10-01T00:00:00"})
+    assert response.status_code == 200
+    assert response.json()["full"] is True
+    
+    # The dashboard can leave leads out of the bootstrap
+    assert "leads" not in client.get('/api/dashboard/bootstrap?leads=0').json()
+    
+    # Delete lead and test user
+    with database.begin() as conn:
+        conn.execute(
+            sqlalchemy.text("DELETE FROM leads WHERE im = :im"),
+            {'im': exampleLead['im']}
+        )
+        conn.execute(
+            sqlalchemy.text("DELETE FROM users WHERE username = :username"),
+            {"username": test_username}
+        )
+
+
+# Test managers see their team's leads and metrics, and reps can't
+def test_team_views():
+    usernames = ['testteammanager', 'testteamrep1', 'testteamrep2']
+    
+    # Delete previous users
+    with database.begin() as conn:
+        conn.execute(
+            sqlalchemy.text("DELETE FROM users WHERE username IN :usernames").bindparams(sqlalchemy.bindparam("usernames", expanding=True)),
+            {"usernames": usernames}
+        )
+    
+    # Register users, each rep adds a lead
+    sessions = {}
+    for username in usernames:
+        response = client.post('/register',
+            data={"user_name": username, "password": 'testteampass'},
+            follow_redirects=False
+        )
+        assert response.status_code == 303
+        sessions[username] = response.cookies.get("id")
+    
+    for username in usernames[1:]:
+        client.cookies.set("id", sessions[username])
+        response = client.post('/api/leads', json={
+            "im": 'teamtest',
+            "company_name": f'{username} corp',
+            "agent_name": 'John',
+            'email': 'john@gmail.com',
+            'task': 'contact',
+            'date': date.today().isoformat()
+        })
+        assert response.status_code == 200
+    
+    # Reps are turned away
+    assert client.get('/api/team/metrics').status_code == 403
+    
+    with database.begin() as conn:
+        ids = dict(conn.execute(
+            sqlalchemy.text("SELECT username, id FROM users WHERE username IN :usernames").bindparams(sqlalchemy.bindparam("usernames", expanding=True)),
+            {"usernames": usernames}
+        ).fetchall())
+        conn.execute(sqlalchemy.text("UPDATE users SET role = 'manager' WHERE id = :id"), {"id": ids['testteammanager']})
+        conn.execute(
+            sqlalchemy.text("INSERT INTO team_members (manager_id, member_id) VALUES (:manager_id, :member_id)"),
+            [{"manager_id": ids['testteammanager'], "member_id": ids[username]} for username in usernames[1:]]
+        )
+    
+    client.cookies.set("id", sessions['testteammanager'])
+    response = client.get('/api/team/metrics')
+    assert response.status_code == 200
+    members = {member["username"]: member for member in response.json()["members"]}
+    assert set(members) == set(usernames[1:])
+    assert all(member["tasks_due_count"] == 1 and member["stages"] == {"new": 1} for member in members.values())
+    assert response.json()["totals"]["tasks_open"] == 2
+    
+    response = client.get('/api/team/leads', params={"member_id": ids['testteamrep1']})
+    assert [lead["company_name"] for lead in response.json()["leads"]] == ['testteamrep1 corp']
+    
+    # Delete leads and test users, their team rows go with them
+    with database.begin() as conn:
+        conn.execute(
+            sqlalchemy.text("DELETE FROM leads WHERE im = :im"),
+            {'im': 'teamtest'}
+        )
+        conn.execute(
+            sqlalchemy.text("DELETE FROM users WHERE username IN :usernames").bindparams(sqlalchemy.bindparam("usernames", expanding=True)),
+            {"usernames": usernames}
+        )
+
+
+# Test the chatbot returns the model's draft, answered here by the fake OpenAI client from conftest.py
+def test_llm_prompt(fake_openai):
+    response = client.post('/register',
+        data={"user_name": 'testllmuser', "password": 'testllmpass'},
+        follow_redirects=False
+    )
+    assert response.status_code == 303
+    client.cookies.set("id", response.cookies.get("id"))
+    
+    response = client.post('/api/llm', json={"prompt": "Write a follow up to Acme"})
+    assert response.status_code == 200
+    assert response.json() == {"ok": True, "response": "Draft: Write a follow up to Acme"}
+    assert fake_openai.responses.calls[0]["input"] == [{"role": "user", "content": "Write a follow up to Acme"}]
+    
+    # Emails the validator rejects never reach the database
+    response = client.post('/api/leads', json={
+        "im": 'llmtest',
+        "company_name": 'llm corp',
+        "agent_name": 'John',
+        'email': 'not-an-email',
+        'task': 'contact',
+        'date': date.today().isoformat()
+    })
+    assert response.status_code == 400
+
+
+# Test new leads are enriched in batched requests to the model, and details seen before come from the cache
+def test_lead_enrichment(stub_model_server, monkeypatch):
+    monkeypatch.setattr(crm_app, "ENRICHMENT_BATCH_SIZE", 2)
+    monkeypatch.setattr(crm_app, "ENRICHMENT_RETRY_SECONDS", 0)
+    
+    # The stub model tags every lead in the prompt
+    def answer(prompt):
+        leads = json.loads(prompt.split("Leads:\n", 1)[1])
+        return json.dumps({"leads": [
+            {"ref": lead["ref"], "suggested_task": "follow_up", "sector": f"{lead['company']} sector", "priority": 150}
+            for lead in leads
+        ]})
+    stub_model_server.answer = answer
+    
+    response = client.post('/register',
+        data={"user_name": 'testenrichuser', "password": 'testenrichpass'},
+        follow_redirects=False
+    )
+    assert response.status_code == 303
+    client.cookies.set("id", response.cookies.get("id"))
+    
+    lead_ids = []
+    for company_name in ['enrich one', 'enrich two', 'enrich three']:
+        response = client.post('/api/leads', json={
+            "im": 'enrichtest',
+            "company_name": company_name,
+            "agent_name": 'John',
+            'email': f'john@{company_name.replace(" ", "")}.com',
+            'task': 'contact',
+            'date': date.today().isoformat()
+        })
+        lead_ids.append(response.json()["id"])
+    
+    def enrichment(lead_id):
+        with database.connect() as conn:
+            return conn.execute(
+                sqlalchemy.text("SELECT suggested_task, sector, ai_priority, enriched_at IS NOT NULL FROM leads WHERE id = :id"),
+                {"id": lead_id}
+            ).fetchone()
+    
+    # Three leads in batches of two is two requests
+    assert asyncio.run(crm_app.enrich_pending_leads()) == 3
+    assert len(stub_model_server.prompts) == 2
+    assert tuple(enrichment(lead_ids[0])) == ("follow_up", "enrich one sector", 100, True)
+    
+    # Nothing left to do
+    assert asyncio.run(crm_app.enrich_pending_leads()) == 0
+    
+    # An edit queues the lead again with new details, putting it back needs no request
+    version = client.get('/api/getleads?source=leadpage').json()["leads"][-1]["version"]
+    assert client.patch(f'/api/leads/{lead_ids[0]}/stage', json={"stage": "contacted", "version": version}).status_code == 200
+    assert asyncio.run(crm_app.enrich_pending_leads()) == 1
+    assert len(stub_model_server.prompts) == 3
+    
+    assert client.patch(f'/api/leads/{lead_ids[0]}/stage', json={"stage": "new", "version": version + 1}).status_code == 200
+    assert asyncio.run(crm_app.enrich_pending_leads()) == 1
+    assert len(stub_model_server.prompts) == 3
+    assert enrichment(lead_ids[0])[3]
+    
+    # A lead the model leaves out is tried again later, a server error leaves it as it was
+    response = client.post('/api/leads', json={
+        "im": 'enrichtest',
+        "company_name": 'enrich four',
+        "agent_name": 'John',
+        'email': 'john@enrichfour.com',
+        'task': 'contact',
+        'date': date.today().isoformat()
+    })
+    stub_model_server.answer = lambda prompt: '```json\n{"leads": []}\n```'
+    assert asyncio.run(crm_app.enrich_pending_leads()) == 1
+    stub_model_server.answer = lambda prompt: 1 / 0
+    assert asyncio.run(crm_app.enrich_pending_leads()) == 0
+    with database.connect() as conn:
+        assert conn.execute(
+            sqlalchemy.text("SELECT enrichment_attempts, enriched_at FROM leads WHERE id = :id"),
+            {"id": response.json()["id"]}
+        ).fetchone() == (1, None)
+    
+    # An answer that can't be read counts against every lead in the batch, without paying for retries
+    stub_model_server.prompts.clear()
+    stub_model_server.answer = lambda prompt: 'Sorry, I cannot help with that'
+    assert asyncio.run(crm_app.enrich_pending_leads()) == 1
+    assert len(stub_model_server.prompts) == 1
+    with database.connect() as conn:
+        assert conn.execute(
+            sqlalchemy.text("SELECT enrichment_attempts FROM leads WHERE id = :id"),
+            {"id": response.json()["id"]}
+        ).scalar() == 2
+
+
+# Test priority scores favour overdue and active leads and today's tasks come out in that order
+def test_lead_priorities(monkeypatch):
+    scores = crm_app.score_priorities(
+        stages=np.array(["new", "new", "new", "in_progress", "Won", "new"]),
+        days=np.array([-5, 0, 10, 0, -5, 0], dtype=float),
+        done=np.array([False, False, False, False, False, True]),
+        activity=np.zeros(6),
+        ai_priority=np.full(6, np.nan),
+    )
+    assert scores[0] > scores[1] > scores[2] > 0
+    assert scores[3] > scores[1]
+    assert scores[4] == scores[5] == 0
+    
+    busy = crm_app.score_priorities(np.array(["new"]), np.zeros(1), np.zeros(1, dtype=bool), np.array([5.0]), np.array([90.0]))
+    assert busy[0] > scores[1]
+    
+    response = client.post('/register',
+        data={"user_name": 'testpriorityuser', "password": 'testprioritypass'},
+        follow_redirects=False
+    )
+    assert response.status_code == 303
+    client.cookies.set("id", response.cookies.get("id"))
+    
+    lead_ids = {}
+    for company_name, days in (('priority later', 10), ('priority today', 0), ('priority overdue', -3)):
+        response = client.post('/api/leads', json={
+            "im": 'prioritytest',
+            "company_name": company_name,
+            "agent_name": 'John',
+            'email': 'john@gmail.com',
+            'task': 'contact',
+            'date': (date.today() + timedelta(days=days)).isoformat(),
+            "allow_duplicate": True,
+        })
+        lead_ids[company_name] = response.json()["id"]
+    
+    response = client.get('/api/getleads', params={"source": "top", "limit": 2})
+    assert [lead["company_name"] for lead in response.json()["leads"]] == ['priority overdue', 'priority today']
+    
+    # Completing a lead rescores it straight away
+    assert client.post(f'/api/leads/{lead_ids["priority overdue"]}/complete').status_code == 200
+    response = client.get('/api/getleads', params={"source": "top"})
+    assert [lead["company_name"] for lead in response.json()["leads"]] == ['priority today', 'priority later']
+    
+    # Scores are recomputed once a day
+    with database.connect() as conn:
+        user_id = conn.execute(sqlalchemy.text("SELECT id FROM users WHERE username = 'testpriorityuser'")).scalar()
+    assert crm_app.ensure_fresh_priorities(user_id) is False
+    with database.begin() as conn:
+        conn.execute(sqlalchemy.text("UPDATE users SET priorities_scored_on = :yesterday WHERE id = :id"), {"yesterday": date.today() - timedelta(days=1), "id": user_id})
+    crm_app.cache.delete(f"priorities:{user_id}:{date.today()}")
+    assert crm_app.ensure_fresh_priorities(user_id) is True
+    
+    # Without a cache to remember the day in, later reads still don't write
+    monkeypatch.setattr(crm_app, "cache", crm_app.NullCache())
+    writes = []
+    def record_writes(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith("UPDATE"):
+            writes.append(statement)
+    sqlalchemy.event.listen(database, "before_cursor_execute", record_writes)
+    try:
+        assert crm_app.ensure_fresh_priorities(user_id) is False
+        assert client.get('/api/getleads', params={"source": "top"}).status_code == 200
+    finally:
+        sqlalchemy.event.remove(database, "before_cursor_execute", record_writes)
+    assert writes == []
+
+
+def test_idempotent_lead_create(monkeypatch):
+    validations = []
+    def counting_validator(request):
+        validations.append(request)
+        return fake_email_validator(request)
+    monkeypatch.setattr(crm_app, "email_validator_client", lambda: httpx.AsyncClient(transport=httpx.MockTransport(counting_validator)))
+    
+    response = client.post('/register',
+        data={"user_name": 'testidempotentuser', "password": 'testidempotentpass'},
+        follow_redirects=False
+    )
+    assert response.status_code == 303
+    client.cookies.set("id", response.cookies.get("id"))
+    
+    exampleLead = {
+        "im": 'idempotenttest',
+        "company_name": 'retry corp',
+        "agent_name": 'John',
+        'email': 'john@gmail.com',
+        'task': 'contact',
+        'date': date.today().isoformat(),
+    }
+    
+    # A retry with the same key gets the first response and saves nothing
+    first = client.post('/api/leads', json=exampleLead, headers={"Idempotency-Key": "lead-1"})
+    retry = client.post('/api/leads', json=exampleLead, headers={"Idempotency-Key": "lead-1"})
+    assert first.status_code == retry.status_code == 200
+    assert retry.json() == first.json()
+    assert retry.headers["idempotent-replayed"] == "true"
+    assert "idempotent-replayed" not in first.headers
+    assert len(validations) == 1
+    
+    with database.connect() as conn:
+        count = conn.execute(sqlalchemy.text("SELECT count(*) FROM leads WHERE im = 'idempotenttest'")).scalar()
+    assert count == 1
+    
+    # The same key can't be reused for different details
+    response = client.post('/api/leads', json={**exampleLead, "company_name": 'other corp'}, headers={"Idempotency-Key": "lead-1"})
+    assert response.status_code == 422
+    
+    # Imports replay too
+    payload = {"leads": [{**exampleLead, "company_name": 'imported corp', 'email': 'jane@gmail.com'}]}
+    first = client.post('/api/leads/import', json=payload, headers={"Idempotency-Key": "import-1"})
+    retry = client.post('/api/leads/import', json=payload, headers={"Idempotency-Key": "import-1"})
+    assert first.status_code == 200
+    assert retry.json() == first.json()
+    with database.connect() as conn:
+        count = conn.execute(sqlalchemy.text("SELECT count(*) FROM leads WHERE company_name = 'imported corp'")).scalar()
+    assert count == 1
+
+
+def test_pool_stats():
+    assert crm_app.normalize_statement("SELECT id FROM leads\n  WHERE id IN (?, ?, ?)") == "SELECT id FROM leads WHERE id IN (...)"
+    assert crm_app.normalize_statement("INSERT INTO t (a, b) VALUES (?, ?), (?, ?), (?, ?)") == "INSERT INTO t (a, b) VALUES (...), ..."
+    
+    response = client.post('/register',
+        data={"user_name": 'testpooluser', "password": 'testpoolpass'},
+        follow_redirects=False
+    )
+    assert response.status_code == 303
+    client.cookies.set("id", response.cookies.get("id"))
+    
+    # Only admins see other users' statements
+    assert client.get('/api/debug/pools').status_code == 403
+    with database.begin() as conn:
+        user_id = conn.execute(sqlalchemy.text("SELECT id FROM users WHERE username = 'testpooluser'")).scalar()
+        conn.execute(sqlalchemy.text("UPDATE users SET role = 'admin' WHERE id = :id"), {"id": user_id})
+    crm_app.cache.delete(f"role:{user_id}")
+    client.get('/api/getleads')
+    
+    response = client.get('/api/debug/pools', params={"limit": 50, "by": "calls"})
+    assert response.status_code == 200
+    report = response.json()
+    primary = report["pools"]["primary"]
+    assert primary["checked_out"] == 0
+    assert primary["waits"] > 0
+    assert 3 <= len(report["slow_statements"]) <= 50
+    calls = [statement["calls"] for statement in report["slow_statements"]]
+    assert calls == sorted(calls, reverse=True)
+    assert any("FROM sessions" in statement["statement"] for statement in report["slow_statements"])
+    
+    # Resetting starts the counts again
+    client.get('/api/debug/pools', params={"reset": 1})
+    assert crm_app.database_stats["primary"].waits == 0
+
+
+def test_lead_calendar():
+    response = client.post('/register',
+        data={"user_name": 'testcalendaruser', "password": 'testcalendarpass'},
+        follow_redirects=False
+    )
+    assert response.status_code == 303
+    client.cookies.set("id", response.cookies.get("id"))
+    
+    # Two leads tomorrow and one the day after, plus a won deal that has no action left
+    tomorrow = date.today() + timedelta(days=1)
+    lead_ids = []
+    for company_name, day in (('calendar a', tomorrow), ('calendar b', tomorrow), ('calendar c', tomorrow + timedelta(days=1)), ('calendar won', tomorrow)):
+        response = client.post('/api/leads', json={
+            "im": 'calendartest',
+            "company_name": company_name,
+            "agent_name": 'John',
+            'email': 'john@gmail.com',
+            'task': 'contact',
+            'date': day.isoformat(),
+            "allow_duplicate": True,
+        })
+        lead_ids.append(response.json()["id"])
+    assert client.patch(f'/api/leads/{lead_ids[3]}/stage', json={"stage": 'Won'}).status_code == 200
+    
+    response = client.get('/api/leads/calendar', params={"start": tomorrow.isoformat(), "days": 3})
+    days = response.json()["days"]
+    assert [day["date"] for day in days] == [(tomorrow + timedelta(days=n)).isoformat() for n in range(3)]
+    assert [day["count"] for day in days] == [2, 1, 0]
+    assert {lead["company_name"] for lead in days[0]["leads"]} == {'calendar a', 'calendar b'}
+    
+    # Rescheduling moves the lead on the next read, and completing one pushes it a week out
+    assert client.patch(f'/api/leads/{lead_ids[0]}/reschedule', json={"action_date": (tomorrow + timedelta(days=2)).isoformat()}).status_code == 200
+    
+    # Malformed dates and versions are rejected before they reach the database
+    assert client.patch(f'/api/leads/{lead_ids[2]}/reschedule', json={"action_date": tomorrow.isoformat(), "version": "abc"}).status_code == 422
+    assert client.patch(f'/api/leads/{lead_ids[2]}/reschedule', json={"action_date": "next week"}).status_code == 422
+    response = client.get('/api/leads/calendar', params={"start": tomorrow.isoformat(), "days": 3})
+    assert [day["count"] for day in response.json()["days"]] == [1, 1, 1]
+    
+    assert client.post(f'/api/leads/{lead_ids[1]}/complete').status_code == 200
+    response = client.get('/api/leads/calendar', params={"days": 14})
+    days = {day["date"]: day for day in response.json()["days"]}
+    assert days[tomorrow.isoformat()]["count"] == 0
+    week_out = days[(date.today() + timedelta(days=7)).isoformat()]
+    assert week_out["count"] == week_out["done"] == 1
+    
+    # Windows are limited to six weeks
+    assert client.get('/api/leads/calendar', params={"days": 100}).status_code == 422
+    
+    # A lead added on another connection between two reads of the same month would be listed under a day with no count,
+    # so the month is loaded by one statement and anything added while it loads waits for the next load
+    with database.connect() as conn:
+        user_id = conn.execute(sqlalchemy.text("SELECT user_id FROM leads WHERE id = :id"), {"id": lead_ids[2]}).scalar()
+    late_day = tomorrow + timedelta(days=5)
+    def add_late_lead():
+        with database.begin() as other:
+            other.execute(
+                sqlalchemy.text("""
+                    INSERT INTO leads (user_id, im, company_name, agent_name, email, task, action_date)
+                    VALUES (:user_id, 'calendartest', 'calendar late', 'John', 'john@gmail.com', 'contact', :day)
+                """),
+                {"user_id": user_id, "day": late_day},
+            )
+    
+    reads = []
+    def add_lead_before_second_read(conn, cursor, statement, parameters, context, executemany):
+        reads.append(statement)
+        if len(reads) == 2:
+            add_late_lead()
+    sqlalchemy.event.listen(database, "before_cursor_execute", add_lead_before_second_read)
+    try:
+        month = crm_app.load_calendar_month(database, user_id, late_day.replace(day=1))
+    finally:
+        sqlalchemy.event.remove(database, "before_cursor_execute", add_lead_before_second_read)
+    assert len(reads) == 1
+    assert all(day["count"] >= len(day["leads"]) for day in month.values())
+    
+    add_late_lead()
+    month = crm_app.load_calendar_month(database, user_id, late_day.replace(day=1))
+    assert [lead["company_name"] for lead in month[late_day.isoformat()]["leads"]] == ['calendar late']
+    assert month[late_day.isoformat()]["count"] == 1
+
+
+# Test follow up prompts are sent with the conversation so far, and long conversations are folded into a digest
+def test_chat_conversation(fake_openai, monkeypatch):
+    response = client.post('/register',
+        data={"user_name": 'testchatuser', "password": 'testchatpass'},
+        follow_redirects=False
+    )
+    assert response.status_code == 303
+    client.cookies.set("id", response.cookies.get("id"))
+    monkeypatch.setitem(crm_app.RATE_LIMITS, "llm", (100, 100))
+    
+    client.post('/api/llm', json={"prompt": "Draft an intro to Acme"})
+    response = client.post('/api/llm', json={"prompt": "Make it shorter"})
+    assert response.json()["response"] == "Draft: Make it shorter"
+    assert fake_openai.responses.calls[-1]["input"] == [
+        {"role": "user", "content": "Draft an intro to Acme"},
+        {"role": "assistant", "content": "Draft: Draft an intro to Acme"},
+        {"role": "user", "content": "Make it shorter"},
+    ]
+    
+    # Going over the budget summarises all but the latest messages, what is sent next stays small
+    monkeypatch.setattr(crm_app, "CHAT_TOKEN_BUDGET", 200)
+    for n in range(3):
+        client.post('/api/llm', json={"prompt": f"Pasted notes {n}: " + "lorem ipsum " * 20})
+    digest_call = next(call for call in fake_openai.responses.calls if isinstance(call["input"], str))
+    assert digest_call["input"].startswith(crm_app.CHAT_DIGEST_PROMPT)
+    assert "Draft an intro to Acme" in digest_call["input"]
+    
+    with database.connect() as conn:
+        user_id = conn.execute(sqlalchemy.text("SELECT id FROM users WHERE username = 'testchatuser'")).scalar()
+    stored = crm_app.chat_conversations.find_one({"_id": user_id})
+    assert stored["d"].startswith("Draft: ")
+    assert len(stored["m"]) <= crm_app.CHAT_KEEP_MESSAGES
+    
+    client.post('/api/llm', json={"prompt": "And the follow up?"})
+    sent = next(call["input"] for call in reversed(fake_openai.responses.calls) if isinstance(call["input"], list))
+    assert sent[0]["role"] == "developer"
+    assert sent[-1] == {"role": "user", "content": "And the follow up?"}
+    assert len(sent) <= crm_app.CHAT_KEEP_MESSAGES + 4
+    
+    # A new conversation starts empty
+    assert client.delete('/api/llm/conversation').status_code == 200
+    client.post('/api/llm', json={"prompt": "Hello again"})
+    assert fake_openai.responses.calls[-1]["input"] == [{"role": "user", "content": "Hello again"}]
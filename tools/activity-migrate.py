@@ -0,0 +1,59 @@
+import argparse
+import os
+import sys
+import bson
+import pymongo
+
+# Run from anywhere, app.py lives one folder up
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from app import activity_log, nosql_database, compact_legacy_activity
+
+# Rewrite schema version 1 activity documents ({user_id, time, date, details, timestamp}) in the compact form
+# and swap the old indexes for one on (u, t). Safe to run more than once, and while the app is running
+parser = argparse.ArgumentParser(description="Rewrite activity documents in the compact schema")
+parser.add_argument("--batch-size", type=int, default=1000, help="documents replaced per bulk write")
+parser.add_argument("--dry-run", action="store_true", help="count the documents and estimate the saving without writing")
+args = parser.parse_args()
+
+
+def collection_size() -> int:
+    return nosql_database.command("collStats", activity_log.name).get("size", 0)
+
+
+size_before = collection_size()
+converted = 0
+bytes_before = bytes_after = 0
+batch = []
+
+# Walk the _id index so documents already replaced are never seen twice
+for document in activity_log.find({"v": {"$exists": False}}).sort("_id", pymongo.ASCENDING).batch_size(args.batch_size):
+    compact = compact_legacy_activity(document)
+    bytes_before += len(bson.encode(document))
+    bytes_after += len(bson.encode(compact))
+
+    # Only replace documents that are still version 1 in case the app touched them meanwhile
+    batch.append(pymongo.ReplaceOne({"_id": document["_id"], "v": {"$exists": False}}, compact))
+    if len(batch) >= args.batch_size:
+        if not args.dry_run:
+            activity_log.bulk_write(batch, ordered=False)
+        converted += len(batch)
+        batch = []
+        print(f"Converted {converted} documents")
+
+if batch and not args.dry_run:
+    activity_log.bulk_write(batch, ordered=False)
+converted += len(batch)
+
+print(f"{'Would convert' if args.dry_run else 'Converted'} {converted} documents, {bytes_before} -> {bytes_after} bytes")
+
+if not args.dry_run:
+    # The activity log is read by user, newest first
+    activity_log.create_index([("u", pymongo.ASCENDING), ("t", pymongo.DESCENDING)], name="u_1_t_-1")
+
+    # Indexes on version 1 field names no longer match anything
+    for index in activity_log.list_indexes():
+        if index["name"] != "_id_" and {"user_id", "timestamp", "time", "date", "details"} & set(index["key"]):
+            activity_log.drop_index(index["name"])
+            print(f"Dropped index {index['name']}")
+
+    print(f"Collection size {size_before} -> {collection_size()} bytes")
@@ -0,0 +1,77 @@
+import gzip
+import hashlib
+import json
+import os
+import re
+import shutil
+import brotli
+
+# Build content hashed, minified and pre-compressed copies of the frontend js and css
+# Output goes to frontend/dist along with manifest.json, which app.py reads to link the hashed files
+FRONTEND_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "frontend")
+DIST_DIR = os.path.join(FRONTEND_DIR, "dist")
+SOURCE_DIRS = ["javascript", "styles"]
+
+
+# Strip comments and whitespace from css
+def minify_css(source: str) -> str:
+    source = re.sub(r"/\*.*?\*/", "", source, flags=re.S)
+    source = re.sub(r"\s+", " ", source)
+    source = re.sub(r"\s*([{};,])\s*", r"\1", source)
+    return source.replace(";}", "}").strip()
+
+
+# Drop indentation, blank lines and whole-line comments from js
+# Code is kept on its own lines so automatic semicolon insertion still works
+def minify_js(source: str) -> str:
+    lines = []
+    for line in source.splitlines():
+        line = line.strip()
+        if not line or line.startswith("//"):
+            continue
+        lines.append(line)
+    return "\n".join(lines) + "\n"
+
+
+# Write the file plus .gz and .br versions for the static handler to pick from
+def write_compressed(path: str, content: bytes):
+    with open(path, "wb") as f:
+        f.write(content)
+    with open(path + ".gz", "wb") as f:
+        f.write(gzip.compress(content, compresslevel=9, mtime=0))
+    with open(path + ".br", "wb") as f:
+        f.write(brotli.compress(content, quality=11))
+
+
+def build():
+    # Start from an empty dist folder so old hashes don't pile up
+    shutil.rmtree(DIST_DIR, ignore_errors=True)
+    manifest = {}
+
+    for source_dir in SOURCE_DIRS:
+        os.makedirs(os.path.join(DIST_DIR, source_dir))
+
+        for file_name in sorted(os.listdir(os.path.join(FRONTEND_DIR, source_dir))):
+            name, ext = os.path.splitext(file_name)
+            if ext not in (".js", ".css"):
+                continue
+
+            with open(os.path.join(FRONTEND_DIR, source_dir, file_name), encoding="utf-8") as f:
+                source = f.read()
+
+            minified = (minify_js(source) if ext == ".js" else minify_css(source)).encode("utf-8")
+
+            # The hash changes whenever the content does, so the file can be cached forever
+            content_hash = hashlib.sha256(minified).hexdigest()[:12]
+            hashed_name = f"{source_dir}/{name}.{content_hash}{ext}"
+            write_compressed(os.path.join(DIST_DIR, hashed_name), minified)
+
+            manifest[f"{source_dir}/{file_name}"] = f"dist/{hashed_name}"
+            print(f"{source_dir}/{file_name}: {len(source)} -> {len(minified)} bytes")
+
+    with open(os.path.join(DIST_DIR, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=2)
+
+
+if __name__ == "__main__":
+    build()
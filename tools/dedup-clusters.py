@@ -0,0 +1,126 @@
+import argparse
+import json
+import os
+import sys
+import sqlalchemy
+
+# Run from anywhere, app.py lives one folder up
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from app import database, normalize_email
+
+# Find clusters of leads that are probably the same company, one JSON line per cluster
+# Leads only match within a user, so they are streamed in user order and each user is handled on its own.
+# Comparing every pair is too slow for big accounts, so only leads that share a block are compared:
+# the same email, the same first word of the company key, or being near each other in company key order
+parser = argparse.ArgumentParser(description="Find clusters of near-duplicate leads")
+parser.add_argument("--user-id", type=int, help="only look at this user's leads")
+parser.add_argument("--threshold", type=float, default=0.8, help="company key similarity needed to match, 0 to 1")
+parser.add_argument("--window", type=int, default=5, help="neighbours compared in company key order")
+parser.add_argument("--max-block", type=int, default=200, help="word blocks bigger than this are left to the window")
+args = parser.parse_args()
+
+# Rows fetched from the server-side cursor at a time
+FETCH_SIZE = 10000
+
+
+def trigrams(key: str) -> frozenset:
+    padded = f"  {key} "
+    return frozenset(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+# Jaccard similarity of character trigrams, forgiving of typos and small word changes
+def similarity(a: frozenset, b: frozenset) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+class UnionFind:
+    def __init__(self, size: int):
+        self.parent = list(range(size))
+
+    def find(self, i: int) -> int:
+        while self.parent[i] != i:
+            self.parent[i] = self.parent[self.parent[i]]
+            i = self.parent[i]
+        return i
+
+    def union(self, a: int, b: int):
+        root_a, root_b = self.find(a), self.find(b)
+        if root_a != root_b:
+            self.parent[max(root_a, root_b)] = min(root_a, root_b)
+
+
+# leads: list of (id, company_name, company_key, email) sorted by company key
+def cluster_user(leads: list) -> list:
+    grams = [trigrams(lead[2] or "") for lead in leads]
+    groups = UnionFind(len(leads))
+
+    def compare(i: int, j: int):
+        if groups.find(i) != groups.find(j) and similarity(grams[i], grams[j]) >= args.threshold:
+            groups.union(i, j)
+
+    blocks = {}
+    for i, (_, _, key, email) in enumerate(leads):
+        # Same email is a match without scoring
+        email = normalize_email(email)
+        if email:
+            blocks.setdefault(("email", email), []).append(i)
+        if key:
+            blocks.setdefault(("word", key.split()[0]), []).append(i)
+
+    for (kind, _), members in blocks.items():
+        if kind == "email":
+            for i in members[1:]:
+                groups.union(members[0], i)
+        elif len(members) <= args.max_block:
+            for position, i in enumerate(members):
+                for j in members[position + 1:]:
+                    compare(i, j)
+
+    # Sorted neighbourhood catches typos in the first word
+    for i in range(len(leads)):
+        for j in range(i + 1, min(i + 1 + args.window, len(leads))):
+            compare(i, j)
+
+    clusters = {}
+    for i in range(len(leads)):
+        clusters.setdefault(groups.find(i), []).append(i)
+    return [members for members in clusters.values() if len(members) > 1]
+
+
+def report(user_id: int, leads: list) -> int:
+    found = 0
+    for members in cluster_user(leads):
+        members.sort(key=lambda i: leads[i][0])
+        print(json.dumps({
+            "user_id": user_id,
+            "lead_ids": [leads[i][0] for i in members],
+            "company_names": [leads[i][1] for i in members],
+        }))
+        found += 1
+    return found
+
+
+with database.connect() as conn:
+    result = conn.execution_options(stream_results=True, yield_per=FETCH_SIZE).execute(
+        sqlalchemy.text("""
+            SELECT user_id, id, company_name, company_key, email FROM leads
+            WHERE (CAST(:user_id AS INTEGER) IS NULL OR user_id = :user_id)
+            ORDER BY user_id, company_key, id
+        """),
+        {"user_id": args.user_id},
+    )
+
+    clusters = 0
+    current_user, leads = None, []
+    for user_id, lead_id, company_name, key, email in result:
+        if user_id != current_user:
+            if leads:
+                clusters += report(current_user, leads)
+            current_user, leads = user_id, []
+        leads.append((lead_id, company_name, key, email))
+    if leads:
+        clusters += report(current_user, leads)
+
+print(f"Found {clusters} clusters", file=sys.stderr)
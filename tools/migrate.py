@@ -0,0 +1,289 @@
+import argparse
+import os
+import sys
+import pymongo
+import sqlalchemy
+
+# Run from anywhere, app.py lives one folder up
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Schema changes in the order they are applied, each one runs once per database and is recorded in schema_migrations
+# Every step is written so it is also safe on a database set up before this tool existed
+# Postgres is what runs in production, SQLite is also handled so tests can build a throwaway database
+MIGRATIONS = []
+
+# Held while migrating so two deploys starting together don't both apply the same step
+MIGRATION_LOCK = 71037
+
+
+# Register a migration, transactional=False runs it outside a transaction so Postgres can build indexes concurrently
+def migration(name: str, transactional: bool = True):
+    def register(fn):
+        MIGRATIONS.append((name, fn, transactional))
+        return fn
+    return register
+
+
+def add_column(conn, dialect: str, table: str, column: str, definition: str):
+    if dialect == "postgresql":
+        conn.execute(sqlalchemy.text(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {column} {definition}"))
+        return
+    existing = {row[1] for row in conn.execute(sqlalchemy.text(f"PRAGMA table_info({table})"))}
+    if column not in existing:
+        conn.execute(sqlalchemy.text(f"ALTER TABLE {table} ADD COLUMN {column} {definition}"))
+
+
+# Build an index without blocking writes on Postgres, a failed concurrent build leaves an invalid index behind so drop it first
+def create_index(conn, dialect: str, name: str, definition: str):
+    if dialect != "postgresql":
+        conn.execute(sqlalchemy.text(f"CREATE INDEX IF NOT EXISTS {name} ON {definition}"))
+        return
+    invalid = conn.execute(
+        sqlalchemy.text("""
+            SELECT 1 FROM pg_index JOIN pg_class ON pg_class.oid = pg_index.indexrelid
+            WHERE pg_class.relname = :name AND NOT pg_index.indisvalid
+        """),
+        {"name": name},
+    ).fetchone()
+    if invalid:
+        conn.execute(sqlalchemy.text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+    conn.execute(sqlalchemy.text(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {definition}"))
+
+
+@migration("001_base_schema")
+def base_schema(conn, dialect: str):
+    serial = "SERIAL PRIMARY KEY" if dialect == "postgresql" else "INTEGER PRIMARY KEY AUTOINCREMENT"
+    timestamp = "TIMESTAMPTZ" if dialect == "postgresql" else "TIMESTAMP"
+    conn.execute(sqlalchemy.text(f"""
+        CREATE TABLE IF NOT EXISTS users (
+            id {serial},
+            username TEXT NOT NULL UNIQUE,
+            password_hash TEXT NOT NULL,
+            role TEXT NOT NULL DEFAULT 'rep'
+        )
+    """))
+    conn.execute(sqlalchemy.text(f"""
+        CREATE TABLE IF NOT EXISTS sessions (
+            id TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+            expires_at {timestamp} NOT NULL
+        )
+    """))
+    conn.execute(sqlalchemy.text(f"""
+        CREATE TABLE IF NOT EXISTS leads (
+            id {serial},
+            user_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+            im TEXT,
+            company_name TEXT,
+            agent_name TEXT,
+            email TEXT,
+            task TEXT,
+            action_date DATE,
+            stage TEXT DEFAULT 'new',
+            task_status TEXT
+        )
+    """))
+
+
+# Version used for optimistic concurrency on lead edits
+@migration("002_lead_version")
+def lead_version(conn, dialect: str):
+    add_column(conn, dialect, "leads", "version", "INTEGER NOT NULL DEFAULT 1")
+
+
+# Outbox that activity documents wait in until the relay ships them to MongoDB
+@migration("003_activity_outbox")
+def activity_outbox(conn, dialect: str):
+    serial = "BIGSERIAL PRIMARY KEY" if dialect == "postgresql" else "INTEGER PRIMARY KEY AUTOINCREMENT"
+    timestamp = "TIMESTAMPTZ" if dialect == "postgresql" else "TIMESTAMP"
+    conn.execute(sqlalchemy.text(f"""
+        CREATE TABLE IF NOT EXISTS activity_outbox (
+            id {serial},
+            document TEXT NOT NULL,
+            created_at {timestamp} NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            shipped_at {timestamp}
+        )
+    """))
+    # The relay only ever looks for unshipped rows in id order
+    conn.execute(sqlalchemy.text("CREATE INDEX IF NOT EXISTS activity_outbox_pending_idx ON activity_outbox (id) WHERE shipped_at IS NULL"))
+    conn.execute(sqlalchemy.text("CREATE INDEX IF NOT EXISTS activity_outbox_shipped_idx ON activity_outbox (shipped_at) WHERE shipped_at IS NOT NULL"))
+
+
+# Normalized company name used to spot duplicate leads, existing leads are keyed in batches
+@migration("004_company_key", transactional=False)
+def company_key_column(conn, dialect: str):
+    from app import company_key
+
+    add_column(conn, dialect, "leads", "company_key", "TEXT")
+
+    # A name that normalizes to nothing gets '' so it isn't picked up again
+    while True:
+        rows = conn.execute(
+            sqlalchemy.text("SELECT id, company_name FROM leads WHERE company_key IS NULL ORDER BY id LIMIT 5000")
+        ).fetchall()
+        if not rows:
+            break
+        conn.execute(
+            sqlalchemy.text("UPDATE leads SET company_key = :company_key WHERE id = :id"),
+            [{"id": lead_id, "company_key": company_key(name)} for lead_id, name in rows],
+        )
+
+    # Duplicate checks on create and import
+    create_index(conn, dialect, "leads_user_company_key_idx", "leads (user_id, company_key)")
+    create_index(conn, dialect, "leads_user_email_idx", "leads (user_id, lower(email))")
+
+
+# Partial indexes holding only the leads the dashboard looks at, their predicates match the queries in app.py word for word
+# so the planner can prove the query only needs rows in the index
+@migration("005_open_lead_indexes", transactional=False)
+def open_lead_indexes(conn, dialect: str):
+    # Today's tasks: leads whose task isn't done
+    create_index(
+        conn, dialect, "leads_open_tasks_idx",
+        "leads (user_id, action_date) WHERE (task_status IS NULL OR task_status <> 'done')",
+    )
+    # Metrics: leads that are neither won nor lost
+    create_index(
+        conn, dialect, "leads_active_stage_idx",
+        "leads (user_id, action_date) WHERE stage NOT IN ('Lost', 'Won')",
+    )
+
+
+# Change tracking for delta sync: when each lead last changed, and a tombstone for each deleted lead
+@migration("006_lead_sync", transactional=False)
+def lead_sync(conn, dialect: str):
+    timestamp = "TIMESTAMPTZ" if dialect == "postgresql" else "TIMESTAMP"
+    # SQLite can't add a column with a non-constant default, new rows there get it from the insert instead
+    default = "NOT NULL DEFAULT CURRENT_TIMESTAMP" if dialect == "postgresql" else ""
+    add_column(conn, dialect, "leads", "updated_at", f"{timestamp} {default}".strip())
+    conn.execute(sqlalchemy.text(f"""
+        CREATE TABLE IF NOT EXISTS lead_tombstones (
+            lead_id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            deleted_at {timestamp} NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+    """))
+    create_index(conn, dialect, "leads_user_updated_at_idx", "leads (user_id, updated_at)")
+    create_index(conn, dialect, "lead_tombstones_user_deleted_at_idx", "lead_tombstones (user_id, deleted_at)")
+
+
+# Managers see the pipeline of the reps on their team, looked up by manager for team views and by rep for removals
+# leads (user_id, stage) answers the per-rep stage counts from the index alone
+@migration("007_teams", transactional=False)
+def teams(conn, dialect: str):
+    conn.execute(sqlalchemy.text("""
+        CREATE TABLE IF NOT EXISTS team_members (
+            manager_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+            member_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+            PRIMARY KEY (manager_id, member_id)
+        )
+    """))
+    create_index(conn, dialect, "team_members_member_idx", "team_members (member_id)")
+    create_index(conn, dialect, "leads_user_stage_idx", "leads (user_id, stage)")
+
+
+# What the enrichment worker learns about each lead from the LLM, and results kept by content hash so a lead whose
+# details were seen before is never sent again. Leads waiting for enrichment are found through a partial index
+@migration("008_lead_enrichment", transactional=False)
+def lead_enrichment(conn, dialect: str):
+    timestamp = "TIMESTAMPTZ" if dialect == "postgresql" else "TIMESTAMP"
+    add_column(conn, dialect, "leads", "suggested_task", "TEXT")
+    add_column(conn, dialect, "leads", "sector", "TEXT")
+    add_column(conn, dialect, "leads", "ai_priority", "INTEGER")
+    add_column(conn, dialect, "leads", "enrichment_hash", "TEXT")
+    add_column(conn, dialect, "leads", "enriched_at", timestamp)
+    add_column(conn, dialect, "leads", "enrichment_attempts", "INTEGER NOT NULL DEFAULT 0")
+    conn.execute(sqlalchemy.text(f"""
+        CREATE TABLE IF NOT EXISTS enrichment_cache (
+            content_hash TEXT PRIMARY KEY,
+            suggested_task TEXT NOT NULL,
+            sector TEXT NOT NULL,
+            ai_priority INTEGER NOT NULL,
+            created_at {timestamp} NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+    """))
+    create_index(conn, dialect, "leads_enrichment_pending_idx", "leads (id) WHERE enriched_at IS NULL")
+
+
+# Priority score per lead for the dashboard's "work on these first" list, read in order from a partial index of open leads
+# users.priorities_scored_on records the day a user's scores were last recomputed, they depend on the date
+@migration("009_lead_priority", transactional=False)
+def lead_priority(conn, dialect: str):
+    add_column(conn, dialect, "leads", "priority_score", "REAL NOT NULL DEFAULT 0")
+    add_column(conn, dialect, "users", "priorities_scored_on", "DATE")
+    create_index(
+        conn, dialect, "leads_open_priority_idx",
+        "leads (user_id, priority_score DESC, id DESC) WHERE (task_status IS NULL OR task_status <> 'done')",
+    )
+
+
+# The reminder leader picks up leads changed by other workers by their updated_at, across every user
+@migration("010_lead_changes", transactional=False)
+def lead_changes(conn, dialect: str):
+    create_index(conn, dialect, "leads_updated_at_idx", "leads (updated_at)")
+
+
+def applied_migrations(engine) -> set:
+    with engine.begin() as conn:
+        conn.execute(sqlalchemy.text("""
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                name TEXT PRIMARY KEY,
+                applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+            )
+        """))
+        return {row[0] for row in conn.execute(sqlalchemy.text("SELECT name FROM schema_migrations"))}
+
+
+# Apply every migration the database hasn't had yet, returns the names applied
+def migrate(engine) -> list:
+    dialect = engine.dialect.name
+    applied = []
+
+    with engine.connect() as lock_conn:
+        if dialect == "postgresql":
+            lock_conn.execute(sqlalchemy.text("SELECT pg_advisory_lock(:key)"), {"key": MIGRATION_LOCK})
+            lock_conn.commit()
+        try:
+            # Read after taking the lock so steps another deploy just applied are skipped
+            done = applied_migrations(engine)
+            for name, fn, transactional in MIGRATIONS:
+                if name in done:
+                    continue
+                if transactional:
+                    with engine.begin() as conn:
+                        fn(conn, dialect)
+                        conn.execute(sqlalchemy.text("INSERT INTO schema_migrations (name) VALUES (:name)"), {"name": name})
+                else:
+                    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+                        fn(conn, dialect)
+                        conn.execute(sqlalchemy.text("INSERT INTO schema_migrations (name) VALUES (:name)"), {"name": name})
+                applied.append(name)
+        finally:
+            if dialect == "postgresql":
+                lock_conn.execute(sqlalchemy.text("SELECT pg_advisory_unlock(:key)"), {"key": MIGRATION_LOCK})
+                lock_conn.commit()
+
+    return applied
+
+
+# MongoDB indexes, create_index does nothing for ones that already exist so these are checked on every run
+# The activity log is read by user, newest first, by fetch_activity and the priority score's activity counts
+def ensure_mongo_indexes(nosql_database):
+    nosql_database["activities_log"].create_index([("u", pymongo.ASCENDING), ("t", pymongo.DESCENDING)], name="u_1_t_-1")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Apply database schema migrations")
+    parser.add_argument("--status", action="store_true", help="list migrations and whether they have been applied")
+    args = parser.parse_args()
+
+    from app import database, nosql_database
+
+    if args.status:
+        done = applied_migrations(database)
+        for name, _, _ in MIGRATIONS:
+            print(f"{'applied' if name in done else 'pending'}  {name}")
+    else:
+        for name in migrate(database):
+            print(f"Applied {name}")
+        ensure_mongo_indexes(nosql_database)
@@ -0,0 +1,38 @@
+import argparse
+import os
+import sys
+from datetime import datetime
+import sqlalchemy
+
+# Run from anywhere, app.py lives one folder up
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from app import database, ship_outbox_batch
+
+# Send outbox rows to MongoDB again, e.g. after restoring Mongo from a backup
+# Rows keep their outbox id as the Mongo _id, so documents that are already there are skipped rather than duplicated
+parser = argparse.ArgumentParser(description="Replay activity outbox rows to MongoDB")
+parser.add_argument("--since", type=datetime.fromisoformat, help="only rows created at or after this time, e.g. 2026-10-01T00:00:00+00:00")
+parser.add_argument("--from-id", type=int, help="only rows with an outbox id at or above this")
+parser.add_argument("--to-id", type=int, help="only rows with an outbox id at or below this")
+parser.add_argument("--ship", action="store_true", help="ship the rows now instead of leaving them for the app's relay")
+args = parser.parse_args()
+
+with database.begin() as conn:
+    replayed = conn.execute(
+        sqlalchemy.text("""
+            UPDATE activity_outbox SET shipped_at = NULL
+            WHERE shipped_at IS NOT NULL
+            AND (CAST(:since AS TIMESTAMPTZ) IS NULL OR created_at >= :since)
+            AND (CAST(:from_id AS BIGINT) IS NULL OR id >= :from_id)
+            AND (CAST(:to_id AS BIGINT) IS NULL OR id <= :to_id)
+        """),
+        {"since": args.since, "from_id": args.from_id, "to_id": args.to_id},
+    ).rowcount
+
+print(f"Marked {replayed} outbox rows for replay")
+
+if args.ship:
+    shipped = 0
+    while batch := ship_outbox_batch():
+        shipped += batch
+    print(f"Shipped {shipped} rows to MongoDB")
@@ -0,0 +1,78 @@
+import argparse
+import os
+import sys
+import sqlalchemy
+
+# Run from anywhere, app.py lives one folder up
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from app import database, cache, MANAGER_ROLES
+
+# Set user roles and who is on each manager's team, users are given by username
+# Team views are cached for TEAM_CACHE_SECONDS so changes show up in the app within that long
+parser = argparse.ArgumentParser(description="Manage roles and team membership")
+commands = parser.add_subparsers(dest="command", required=True)
+
+role_parser = commands.add_parser("role", help="set a user's role")
+role_parser.add_argument("username")
+role_parser.add_argument("role", choices=("rep",) + MANAGER_ROLES)
+
+for name, help_text in (("add", "add reps to a manager's team"), ("remove", "remove reps from a manager's team")):
+    member_parser = commands.add_parser(name, help=help_text)
+    member_parser.add_argument("manager")
+    member_parser.add_argument("members", nargs="+")
+
+list_parser = commands.add_parser("list", help="list a manager's team")
+list_parser.add_argument("manager")
+
+args = parser.parse_args()
+
+
+def user_id(conn, username: str) -> int:
+    found = conn.execute(sqlalchemy.text("SELECT id FROM users WHERE username = :username"), {"username": username}).scalar()
+    if found is None:
+        sys.exit(f"No user called {username}")
+    return found
+
+
+with database.begin() as conn:
+    match args.command:
+        case "role":
+            target = user_id(conn, args.username)
+            conn.execute(sqlalchemy.text("UPDATE users SET role = :role WHERE id = :id"), {"role": args.role, "id": target})
+            # Drop this process' copy, the app's own copy expires with the session cache
+            cache.delete(f"role:{target}")
+            print(f"{args.username} is now {args.role}")
+
+        case "add":
+            manager_id = user_id(conn, args.manager)
+            for member in args.members:
+                conn.execute(
+                    sqlalchemy.text("""
+                        INSERT INTO team_members (manager_id, member_id) VALUES (:manager_id, :member_id)
+                        ON CONFLICT DO NOTHING
+                    """),
+                    {"manager_id": manager_id, "member_id": user_id(conn, member)},
+                )
+            print(f"Added {len(args.members)} to {args.manager}'s team")
+
+        case "remove":
+            manager_id = user_id(conn, args.manager)
+            for member in args.members:
+                conn.execute(
+                    sqlalchemy.text("DELETE FROM team_members WHERE manager_id = :manager_id AND member_id = :member_id"),
+                    {"manager_id": manager_id, "member_id": user_id(conn, member)},
+                )
+            print(f"Removed {len(args.members)} from {args.manager}'s team")
+
+        case "list":
+            rows = conn.execute(
+                sqlalchemy.text("""
+                    SELECT users.username, users.role FROM team_members
+                    JOIN users ON users.id = team_members.member_id
+                    WHERE team_members.manager_id = :manager_id
+                    ORDER BY users.username
+                """),
+                {"manager_id": user_id(conn, args.manager)},
+            )
+            for username, role in rows:
+                print(f"{username}  {role}")